@@ -0,0 +1,107 @@
+# FILE: bench_tts_normalizer.py
+# Đo tốc độ làm sạch văn bản TTS: bản cũ (mỗi từ viết tắt 1 lần re.sub) so với tts_normalizer.TextNormalizer.
+# Bản cũ được chép NGUYÊN VĂN (kể cả bảng từ, trong đó "sp" khai báo 2 lần nên "sản phẩm" thắng) để so kết quả.
+# Chạy: python bench_tts_normalizer.py   (không cần Streamlit / Supabase)
+import re
+import time
+import random
+
+from tts_normalizer import TextNormalizer, DEFAULT_ABBREVIATIONS
+
+SIZES = [6250, 12500, 25000, 50000]
+REPEAT = 5
+
+# Bảng từ của bản cũ, chép nguyên văn (key trùng: dict literal giữ giá trị sau cùng)
+LEGACY_REPLACEMENTS = {
+    "vn": "Việt Nam",
+    "HT": "Hòa Thượng",
+    "sp": "Sư phụ",
+    "TT": "Thượng Tọa",
+    "ko": "không",
+    "k": "không",
+    "hok": "không",
+    "dc": "được",
+    "đc": "được",
+    "mn": "mọi người",
+    "mng": "mọi người",
+    "acc": "tài khoản",
+    "fb": "Facebook",
+    "zalo": "Za lô",
+    "kg": "ki lô gam",
+    "km": "ki lô mét",
+    "sp": "sản phẩm",
+    "shop": "cửa hàng",
+    "ok": "ô kê"
+}
+
+WORDS = ["Xin", "chào", "mọi", "người", "hôm", "nay", "chúng", "ta", "nói", "về", "nhân", "quả",
+         "và", "sự", "an", "lạc", "trong", "cuộc", "sống", "<b>", "</b>", "https://example.com/x",
+         "​", "\t"] + list(LEGACY_REPLACEMENTS) + list(DEFAULT_ABBREVIATIONS)
+
+
+def legacy_clean_text_for_tts(text):
+    """clean_text_for_tts cũ trong web_app.py, chép nguyên văn (để so sánh)"""
+    if not text: return ""
+    text = str(text)
+    text = re.sub(r'<[^>]+>', '', text)
+    text = re.sub(r'http\S+', '', text)
+    replacements = LEGACY_REPLACEMENTS
+    for k, v in replacements.items():
+        text = re.sub(r'\b' + re.escape(k) + r'\b', v, text, flags=re.IGNORECASE)
+    text = "".join(ch for ch in text if ch.isprintable())
+    text = " ".join(text.split())
+    return text.strip()
+
+
+def make_script(n_chars, seed=0):
+    rng = random.Random(seed)
+    parts, size = [], 0
+    while size < n_chars:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        size += len(word) + 1
+    return " ".join(parts)[:n_chars]
+
+
+def best_of(func, text):
+    best = float("inf")
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    # Cùng bảng từ với bản cũ -> kết quả phải giống hệt; tắt ghi nhớ để đo đúng thời gian xử lý
+    normalizer = TextNormalizer(abbreviations=LEGACY_REPLACEMENTS, cache_size=0)
+    default = TextNormalizer(cache_size=0)
+    cached = TextNormalizer()
+
+    # Khác biệt cố ý của bảng mặc định mới so với bản cũ (chỉ "sp")
+    changed = {k: (LEGACY_REPLACEMENTS.get(k), v) for k, v in DEFAULT_ABBREVIATIONS.items() if LEGACY_REPLACEMENTS.get(k) != v}
+    print(f"Bảng mặc định khác bản cũ: {changed}")
+    sample = "Lời sp dạy"
+    print(f"  '{sample}' -> cũ: '{legacy_clean_text_for_tts(sample)}' | mới: '{default.normalize(sample)}'\n")
+
+    print(f"{'Ký tự':>8} | {'Cũ (ms)':>9} | {'Mới (ms)':>9} | {'Mới µs/1k ký tự':>16} | {'Nhanh hơn':>9}")
+    print("-" * 64)
+    per_k = []
+    for n_chars in SIZES:
+        text = make_script(n_chars)
+        assert normalizer.normalize(text) == legacy_clean_text_for_tts(text), "Kết quả khác bản cũ"
+        old_s = best_of(legacy_clean_text_for_tts, text)
+        new_s = best_of(normalizer.normalize, text)
+        per_k.append(new_s / n_chars * 1000)
+        print(f"{n_chars:>8} | {old_s * 1000:>9.2f} | {new_s * 1000:>9.2f} | {per_k[-1] * 1e6:>16.1f} | {old_s / new_s:>8.1f}x")
+
+    # Tuyến tính: thời gian / ký tự gần như không đổi khi kịch bản dài gấp 8 lần
+    print(f"\nTỉ lệ thời gian/ký tự (50k so với {SIZES[0]}): {per_k[-1] / per_k[0]:.2f} (≈1.0 là tuyến tính)")
+
+    text = make_script(SIZES[-1])
+    cached.normalize(text)
+    print(f"Gọi lại cùng kịch bản 50k (đã ghi nhớ): {best_of(cached.normalize, text) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
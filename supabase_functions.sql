@@ -0,0 +1,506 @@
+-- FILE: supabase_functions.sql
+-- Các hàm / index / bảng phụ mà web_app.py gọi tới trên Supabase.
+-- Cách dùng: mở Supabase > SQL Editor, dán toàn bộ file này và bấm Run (chạy lại nhiều lần không sao).
+-- Các hàm ở đây chỉ cấp quyền cho service_role: app phải dùng key service_role trong secrets (supabase.key).
+-- Dùng key anon thì app in cảnh báo lúc khởi động và tự rơi về cách cũ (chậm hơn).
+
+-- =====================================================================
+-- THỐNG KÊ HÀNG CHỜ (get_queue_snapshot)
+-- Mỗi user đang có đơn Pending/Processing trả về 1 dòng:
+--   email_key   : md5(email) - không trả email thật (app so khớp bằng queue_email_key() trong web_app.py)
+--   my_count    : số đơn đang chờ của user đó
+--   ahead_count : số đơn của người khác tạo TRƯỚC đơn chờ sớm nhất của user
+--   total_count : tổng độ dài hàng chờ
+-- =====================================================================
+create index if not exists orders_queue_idx
+    on public.orders (created_at)
+    where status in ('Pending', 'Processing');
+
+drop function if exists public.get_queue_snapshot(); -- Kiểu trả về đã đổi (email -> email_key)
+
+create or replace function public.get_queue_snapshot()
+returns table (email_key text, my_count integer, ahead_count integer, total_count integer)
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    with q as (
+        select o.email, o.created_at
+        from orders o
+        where o.status in ('Pending', 'Processing')
+    ),
+    per_user as (
+        select q.email, count(*)::int as my_count, min(q.created_at) as first_at
+        from q
+        group by q.email
+    )
+    select md5(p.email),
+           p.my_count,
+           (select count(*)::int from q where q.created_at < p.first_at and q.email <> p.email) as ahead_count,
+           (select count(*)::int from q) as total_count
+    from per_user p;
+$$;
+
+revoke all on function public.get_queue_snapshot() from public, anon, authenticated;
+grant execute on function public.get_queue_snapshot() to service_role;
+
+-- =====================================================================
+-- SỐ LIỆU ƯỚC LƯỢNG THỜI GIAN CHỜ (get_processing_stats)
+-- Trigger ghi lại lúc bắt đầu xử lý (started_at) và lúc xong/lỗi (finished_at).
+-- Hàm trả về trung vị số giây xử lý của 14 ngày gần nhất, chia theo:
+--   kind='video' : video_mode  x  độ dài kịch bản
+--   kind='tts'   : giọng đọc   x  độ dài kịch bản
+-- Các dòng group_key/len_bucket = NULL là dòng tổng hợp (grouping sets).
+-- Ngưỡng độ dài phải khớp với script_length_bucket() trong web_app.py.
+-- =====================================================================
+alter table public.orders add column if not exists started_at timestamptz;
+alter table public.orders add column if not exists finished_at timestamptz;
+alter table public.tts_requests add column if not exists started_at timestamptz;
+alter table public.tts_requests add column if not exists finished_at timestamptz;
+
+create or replace function public.stamp_processing_times()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.status is distinct from old.status then
+        if lower(new.status) = 'processing' then
+            new.started_at := coalesce(new.started_at, now());
+        elsif lower(new.status) in ('done', 'error') then
+            new.finished_at := now();
+        end if;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists orders_stamp_times on public.orders;
+create trigger orders_stamp_times
+    before update of status on public.orders
+    for each row execute function public.stamp_processing_times();
+
+drop trigger if exists tts_requests_stamp_times on public.tts_requests;
+create trigger tts_requests_stamp_times
+    before update of status on public.tts_requests
+    for each row execute function public.stamp_processing_times();
+
+create or replace function public.get_processing_stats()
+returns table (kind text, group_key text, len_bucket text, samples integer,
+               avg_seconds double precision, seconds_per_char double precision)
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    with v as (
+        select coalesce(o.settings->>'video_mode', 'auto') as group_key,
+               case when length(o.content) < 600 then 'short'
+                    when length(o.content) < 1500 then 'medium'
+                    else 'long' end as len_bucket,
+               extract(epoch from o.finished_at - o.started_at)::float8 as secs,
+               greatest(length(o.content), 1) as n_chars
+        from orders o
+        where o.status = 'Done'
+          and o.started_at is not null
+          and o.finished_at > now() - interval '14 days'
+    ),
+    t as (
+        select r.voice_id as group_key,
+               case when length(r.content) < 600 then 'short'
+                    when length(r.content) < 1500 then 'medium'
+                    else 'long' end as len_bucket,
+               extract(epoch from r.finished_at - coalesce(r.started_at, r.created_at))::float8 as secs,
+               greatest(length(r.content), 1) as n_chars
+        from tts_requests r
+        where r.status = 'done'
+          and r.finished_at > now() - interval '14 days'
+    )
+    select 'video', v.group_key, v.len_bucket, count(*)::int,
+           percentile_cont(0.5) within group (order by v.secs),
+           percentile_cont(0.5) within group (order by v.secs / v.n_chars)
+    from v
+    where v.secs > 0
+    group by grouping sets ((v.group_key, v.len_bucket), (v.group_key), ())
+    union all
+    select 'tts', t.group_key, t.len_bucket, count(*)::int,
+           percentile_cont(0.5) within group (order by t.secs),
+           percentile_cont(0.5) within group (order by t.secs / t.n_chars)
+    from t
+    where t.secs > 0
+    group by grouping sets ((t.group_key, t.len_bucket), (t.group_key), ());
+$$;
+
+-- =====================================================================
+-- PHÂN TRANG LỊCH SỬ VIDEO (keyset theo email, created_at, id)
+-- =====================================================================
+create index if not exists orders_email_created_idx
+    on public.orders (email, created_at desc, id desc);
+
+-- =====================================================================
+-- DANH SÁCH LỊCH SỬ GỌN NHẸ (view orders_history)
+-- Chỉ gồm các cột cần để vẽ danh sách + 10 từ đầu của kịch bản (đã giải mã &amp; &lt; &gt;).
+-- Nội dung đầy đủ chỉ được tải khi user mở chi tiết 1 dòng.
+-- =====================================================================
+create or replace view public.orders_history
+with (security_invoker = true)
+as
+select o.id,
+       o.email,
+       o.status,
+       o.created_at,
+       o.result_link,
+       o.audio_link,
+       array_to_string(w.words[1:10], ' ')
+           || case when coalesce(array_length(w.words, 1), 0) > 10 then '...' else '' end as preview
+from public.orders o
+cross join lateral (
+    select regexp_split_to_array(
+               btrim(replace(replace(replace(coalesce(o.content, ''), '&lt;', '<'), '&gt;', '>'), '&amp;', '&')),
+               '\s+'
+           ) as words
+) w;
+
+-- =====================================================================
+-- TÌM KIẾM TOÀN VĂN THƯ VIỆN KỊCH BẢN (search_library)
+-- vn_fold(): bỏ dấu (unaccent) + chữ thường, dùng cho chỉ mục/tìm kiếm. unaccent KHÔNG giữ nguyên độ dài
+-- (ký tự ghép "ﬁ", "…" -> nhiều ký tự) nên vị trí cắt trích đoạn tính trên vn_fold_keep_len():
+-- chỉ thay từng chữ cái tiếng Việt có dấu bằng 1 chữ không dấu -> vị trí khớp với bản gốc.
+-- search_tsv: cột sinh tự động (đã bỏ dấu, tách từ) + chỉ mục GIN -> không phải quét cả bảng.
+-- =====================================================================
+create extension if not exists unaccent with schema extensions;
+
+create or replace function public.vn_fold(t text)
+returns text
+language sql
+immutable
+parallel safe
+set search_path = public, extensions
+as $$
+    select lower(extensions.unaccent('extensions.unaccent'::regdictionary,
+                                     replace(replace(coalesce(t, ''), 'đ', 'd'), 'Đ', 'D')));
+$$;
+
+create or replace function public.vn_fold_keep_len(t text)
+returns text
+language sql
+immutable
+parallel safe
+as $$
+    select translate(lower(coalesce(t, '')),
+                     'àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ',
+                     'aaaaaaaaaaaaaaaaaeeeeeeeeeeeiiiiiooooooooooooooooouuuuuuuuuuuyyyyyd');
+$$;
+
+alter table public.library
+    add column if not exists search_tsv tsvector
+    generated always as (to_tsvector('simple', public.vn_fold(content))) stored;
+
+create index if not exists library_search_idx on public.library using gin (search_tsv);
+
+create or replace function public.search_library(p_query text, p_limit integer default 20)
+returns table (content text, audio_url text, category text, rank real, snippet text)
+language sql
+stable
+security definer
+set search_path = public, extensions
+as $$
+    with q as (
+        select websearch_to_tsquery('simple', public.vn_fold(p_query)) as tsq,
+               split_part(public.vn_fold_keep_len(btrim(p_query)), ' ', 1) as first_term
+    )
+    select l.content,
+           l.audio_url,
+           l.category,
+           ts_rank_cd(l.search_tsv, q.tsq) as rank,
+           case when s.start > 1 then '...' else '' end
+               || substring(l.content from s.start for 110)
+               || case when s.start + 110 <= length(l.content) then '...' else '' end as snippet
+    from public.library l
+    cross join q
+    cross join lateral (
+        select greatest(1, strpos(public.vn_fold_keep_len(l.content), q.first_term) - 30) as start
+    ) s
+    where l.search_tsv @@ q.tsq
+    order by rank desc, length(l.content)
+    limit least(greatest(coalesce(p_limit, 20), 1), 100);
+$$;
+
+-- =====================================================================
+-- ĐỒNG BỘ THƯ VIỆN TỪ GOOGLE SHEET THEO KIỂU TĂNG DẦN
+-- fingerprint = md5 của kịch bản (đã sanitize) sau khi gộp khoảng trắng (space, \t \n \r \f \v, NBSP) rồi cắt 2 đầu,
+-- phải khớp TỪNG KÝ TỰ với library_fingerprint() trong web_app.py (_FINGERPRINT_SPACE_RE).
+-- library_sync_state: mốc của từng sheet (số dòng + md5 của dãy fingerprint) -> sheet không đổi thì bỏ qua,
+-- sheet chỉ thêm dòng ở cuối thì chỉ ghi phần mới.
+-- =====================================================================
+alter table public.library add column if not exists fingerprint text;
+
+create or replace function public.library_fingerprint(t text)
+returns text
+language sql
+immutable
+parallel safe
+as $$
+    select md5(btrim(regexp_replace(coalesce(t, ''), '[ \t\n\r\f\v\u00a0]+', ' ', 'g'), ' '));
+$$;
+
+-- Các bản sync cũ có thể đã chèn trùng (kịch bản chứa & < >, hoặc chỉ khác khoảng trắng) -> giữ dòng có id nhỏ nhất
+-- trước khi (tính lại) fingerprint và tạo unique index
+delete from public.library l
+ using public.library d
+ where l.category = d.category
+   and l.id > d.id
+   and public.library_fingerprint(l.content) = public.library_fingerprint(d.content);
+
+-- Tính lại cả những dòng đã có fingerprint theo công thức cũ (btrim + \s không khớp cách app gộp khoảng trắng)
+update public.library
+   set fingerprint = public.library_fingerprint(content)
+ where fingerprint is distinct from public.library_fingerprint(content);
+
+create unique index if not exists library_category_fingerprint_key
+    on public.library (category, fingerprint);
+
+create table if not exists public.library_sync_state (
+    category   text primary key,
+    row_count  integer not null,
+    digest     text not null
+);
+
+-- =====================================================================
+-- XEM DANH MỤC THƯ VIỆN NGẪU NHIÊN (sample_library)
+-- Thứ tự "ngẫu nhiên" = md5(id || seed): cùng seed luôn ra cùng kết quả nên app cache được theo (danh mục, seed).
+-- Xem theo trang dùng thẳng bảng library (order by id + range), chỉ mục bên dưới giúp cả 2 cách.
+-- =====================================================================
+create index if not exists library_category_id_idx on public.library (category, id);
+
+create or replace function public.sample_library(p_category text, p_seed text, p_limit integer default 50)
+returns table (content text, audio_url text, category text)
+language sql
+stable
+security definer
+set search_path = public
+as $$
+    select l.content, l.audio_url, l.category
+    from public.library l
+    where l.category = p_category
+    order by md5(l.id::text || coalesce(p_seed, ''))
+    limit least(greatest(coalesce(p_limit, 50), 1), 200);
+$$;
+
+-- =====================================================================
+-- BẢNG TỪ VIẾT TẮT KHI ĐỌC TTS (tts_abbreviations)
+-- Các dòng ở đây được cộng thêm vào bảng mặc định trong tts_normalizer.py (trùng từ thì dòng ở đây thắng).
+-- enabled = false: bỏ hẳn từ đó (kể cả từ có sẵn trong bảng mặc định). Không phân biệt hoa thường.
+-- =====================================================================
+create table if not exists public.tts_abbreviations (
+    abbr       text primary key,
+    expansion  text not null default '',
+    enabled    boolean not null default true
+);
+
+-- =====================================================================
+-- TTS CHIA ĐOẠN (tts_requests.parent_id / chunk_index)
+-- Kịch bản dài được chia theo câu: dòng cha có status = 'split' (máy TTS KHÔNG được nhận, chỉ nhận 'pending'),
+-- mỗi đoạn là 1 dòng con 'pending' trỏ về dòng cha. App ghép các đoạn khi xong hết ('stitching' -> 'done').
+-- stitching_started_at: lúc giành quyền ghép; dòng 'stitching' quá 5 phút (TTS_STITCH_LEASE_SECONDS) được giành lại.
+-- Kiểu của parent_id lấy theo kiểu của cột id hiện có.
+-- =====================================================================
+do $$
+declare
+    id_type text;
+begin
+    select format_type(a.atttypid, a.atttypmod) into id_type
+    from pg_attribute a
+    where a.attrelid = 'public.tts_requests'::regclass and a.attname = 'id';
+
+    execute format('alter table public.tts_requests add column if not exists parent_id %s references public.tts_requests (id) on delete cascade', id_type);
+end
+$$;
+
+alter table public.tts_requests add column if not exists chunk_index integer;
+alter table public.tts_requests add column if not exists stitching_started_at timestamptz;
+
+create index if not exists tts_requests_parent_idx
+    on public.tts_requests (parent_id, chunk_index)
+    where parent_id is not null;
+
+-- =====================================================================
+-- CHỐNG TẢI TRÙNG FILE AUDIO (audio_uploads)
+-- sha256 của file gốc user gửi -> link Cloudinary đã tải + thông tin audio sau khi chuẩn hóa (codec, thời lượng...).
+-- =====================================================================
+create table if not exists public.audio_uploads (
+    sha256      text primary key,
+    secure_url  text not null,
+    audio_info  jsonb,
+    created_at  timestamptz not null default now()
+);
+
+-- =====================================================================
+-- GIỮ CHỖ / HOÀN QUOTA NGUYÊN TỬ (reserve_quota / refund_quota)
+-- reserve_quota: kiểm tra hạn mức và cộng lượt video + ký tự TTS trong CÙNG 1 câu update
+--   -> 2 phiên bấm cùng lúc không thể cùng vượt hạn mức. Luôn trả về 1 dòng số liệu mới nhất,
+--   ok = false (và không cộng gì) nếu không đủ hạn mức.
+-- refund_quota: trả lại phần đã giữ khi tạo đơn / yêu cầu TTS thất bại (máy xử lý cũng gọi được khi job lỗi).
+-- Mặc định quota_max = 10, tts_limit = 10000 phải khớp với QUOTA_DEFAULTS trong web_app.py.
+-- =====================================================================
+create or replace function public.reserve_quota(p_user_id public.users.id%type,
+                                                p_videos integer default 0,
+                                                p_tts_chars integer default 0)
+returns table (ok boolean, quota_used integer, quota_max integer, tts_usage integer, tts_limit integer)
+language sql
+volatile
+security definer
+set search_path = public
+as $$
+    with r as (
+        update public.users u
+           set quota_used = coalesce(u.quota_used, 0) + greatest(coalesce(p_videos, 0), 0),
+               tts_usage  = coalesce(u.tts_usage, 0) + greatest(coalesce(p_tts_chars, 0), 0)
+         where u.id = p_user_id
+           and (coalesce(p_videos, 0) <= 0
+                or coalesce(u.quota_used, 0) + p_videos <= coalesce(u.quota_max, 10))
+           and (coalesce(p_tts_chars, 0) <= 0
+                or coalesce(u.tts_usage, 0) + p_tts_chars <= coalesce(u.tts_limit, 10000))
+        returning u.quota_used, u.quota_max, u.tts_usage, u.tts_limit
+    )
+    select true, r.quota_used::int, coalesce(r.quota_max, 10)::int, r.tts_usage::int, coalesce(r.tts_limit, 10000)::int
+    from r
+    union all
+    select false, coalesce(u.quota_used, 0)::int, coalesce(u.quota_max, 10)::int,
+           coalesce(u.tts_usage, 0)::int, coalesce(u.tts_limit, 10000)::int
+    from public.users u
+    where u.id = p_user_id
+      and not exists (select 1 from r);
+$$;
+
+create or replace function public.refund_quota(p_user_id public.users.id%type,
+                                               p_videos integer default 0,
+                                               p_tts_chars integer default 0)
+returns table (quota_used integer, quota_max integer, tts_usage integer, tts_limit integer)
+language sql
+volatile
+security definer
+set search_path = public
+as $$
+    update public.users u
+       set quota_used = greatest(coalesce(u.quota_used, 0) - greatest(coalesce(p_videos, 0), 0), 0),
+           tts_usage  = greatest(coalesce(u.tts_usage, 0) - greatest(coalesce(p_tts_chars, 0), 0), 0)
+     where u.id = p_user_id
+    returning u.quota_used::int, coalesce(u.quota_max, 10)::int, u.tts_usage::int, coalesce(u.tts_limit, 10000)::int;
+$$;
+
+-- Chỉ server (key service_role trong secrets của app) được gọi: nhận p_user_id bất kỳ nên không mở cho key public
+revoke all on function public.reserve_quota(public.users.id%type, integer, integer) from public, anon, authenticated;
+revoke all on function public.refund_quota(public.users.id%type, integer, integer) from public, anon, authenticated;
+grant execute on function public.reserve_quota(public.users.id%type, integer, integer) to service_role;
+grant execute on function public.refund_quota(public.users.id%type, integer, integer) to service_role;
+
+-- =====================================================================
+-- GỬI ĐƠN TẠO VIDEO TRONG 1 LẦN GỌI (submit_order)
+-- Trong 1 giao dịch: khóa dòng user -> chống spam (đơn gần nhất < p_min_interval_seconds giây thì từ chối)
+-- -> giữ chỗ 1 lượt video (chỉ với đơn 'Pending') -> insert đơn -> tính vị trí trong hàng chờ như get_queue_snapshot.
+-- result: 'ok' | 'rate_limited' | 'no_quota'. Gọi lại với cùng id (thử lại sau lỗi mạng) thì không tạo / trừ thêm lần nữa.
+-- =====================================================================
+create or replace function public.submit_order(p_user_id public.users.id%type,
+                                               p_order jsonb,
+                                               p_min_interval_seconds integer default 5)
+returns table (result text, order_id text,
+               quota_used integer, quota_max integer, tts_usage integer, tts_limit integer,
+               my_count integer, ahead_count integer, total_count integer)
+language plpgsql
+volatile
+security definer
+set search_path = public
+as $$
+#variable_conflict use_column
+declare
+    u public.users%rowtype;
+    o public.orders%rowtype;
+    v_first_at timestamptz;
+begin
+    select * into u from public.users where id = p_user_id for update;
+    if not found then
+        raise exception 'submit_order: user % not found', p_user_id;
+    end if;
+
+    o := jsonb_populate_record(null::public.orders, p_order);
+    order_id := o.id::text;
+    result := 'ok';
+
+    if exists (select 1 from public.orders x where x.id = o.id) then
+        if not exists (select 1 from public.orders x where x.id = o.id and x.email = u.email) then
+            raise exception 'submit_order: duplicate order id %', o.id;
+        end if;
+        -- Lần gọi trước đã ghi được đơn (chỉ mất phản hồi): trả kết quả, không trừ quota lần nữa
+    elsif coalesce(p_min_interval_seconds, 0) > 0
+          and exists (select 1 from public.orders x
+                      where x.email = u.email
+                        and x.created_at > now() - make_interval(secs => p_min_interval_seconds)) then
+        result := 'rate_limited';
+    elsif coalesce(o.status, 'Pending') = 'Pending'
+          and coalesce(u.quota_used, 0) + 1 > coalesce(u.quota_max, 10) then
+        result := 'no_quota';
+    else
+        if coalesce(o.status, 'Pending') = 'Pending' then
+            update public.users x
+               set quota_used = coalesce(x.quota_used, 0) + 1
+             where x.id = p_user_id
+            returning * into u;
+        end if;
+
+        insert into public.orders (id, created_at, email, source, content, audio_link, status, result_link, settings)
+        values (o.id, now(), u.email, o.source, o.content, o.audio_link,
+                coalesce(o.status, 'Pending'), coalesce(o.result_link, ''), o.settings);
+    end if;
+
+    quota_used := coalesce(u.quota_used, 0);
+    quota_max := coalesce(u.quota_max, 10);
+    tts_usage := coalesce(u.tts_usage, 0);
+    tts_limit := coalesce(u.tts_limit, 10000);
+
+    select min(x.created_at) into v_first_at
+    from public.orders x
+    where x.email = u.email and x.status in ('Pending', 'Processing');
+
+    select count(*) filter (where x.email = u.email)::int,
+           count(*) filter (where x.email <> u.email and x.created_at < v_first_at)::int,
+           count(*)::int
+      into my_count, ahead_count, total_count
+    from public.orders x
+    where x.status in ('Pending', 'Processing');
+
+    return next;
+end;
+$$;
+
+revoke all on function public.submit_order(public.users.id%type, jsonb, integer) from public, anon, authenticated;
+grant execute on function public.submit_order(public.users.id%type, jsonb, integer) to service_role;
+
+-- =====================================================================
+-- GHI LINK GIỌNG ĐỌC TTS NGẦM VÀO ĐƠN HÀNG LOẠT (set_order_audio_links)
+-- p_rows: [{"id": mã đơn, "audio_link": link thật}, ...] -> 1 câu update duy nhất, CHỈ đổi cột audio_link
+-- của các đơn thuộc p_email còn đang giữ link tạm 'pending_tts_...'. Trả về số đơn đã cập nhật.
+-- jsonb_populate_recordset ép kiểu theo đúng bảng orders nên so khớp id vẫn dùng được khóa chính.
+-- =====================================================================
+create or replace function public.set_order_audio_links(p_email text, p_rows jsonb)
+returns integer
+language sql
+volatile
+security definer
+set search_path = public
+as $$
+    with changed as (
+        update public.orders o
+           set audio_link = v.audio_link
+          from jsonb_populate_recordset(null::public.orders, p_rows) v
+         where o.id = v.id
+           and o.email = p_email
+           and o.audio_link like 'pending\_tts\_%'
+           and coalesce(v.audio_link, '') <> ''
+        returning 1
+    )
+    select count(*)::int from changed;
+$$;
+
+revoke all on function public.set_order_audio_links(text, jsonb) from public, anon, authenticated;
+grant execute on function public.set_order_audio_links(text, jsonb) to service_role;
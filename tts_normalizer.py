@@ -0,0 +1,146 @@
+# FILE: tts_normalizer.py
+# Làm sạch kịch bản trước khi đọc TTS. Không phụ thuộc Streamlit/Supabase để chạy được benchmark độc lập.
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Bảng từ viết tắt mặc định (dùng khi chưa có / không đọc được bảng tts_abbreviations trên Supabase)
+# Lưu ý: bản cũ khai báo "sp" 2 lần nên "Sư phụ" bị "sản phẩm" ghi đè -> giữ "Sư phụ" cho đúng nội dung kênh
+DEFAULT_ABBREVIATIONS = {
+    "vn": "Việt Nam",
+    "HT": "Hòa Thượng",
+    "sp": "Sư phụ",
+    "TT": "Thượng Tọa",
+    "ko": "không",
+    "k": "không",
+    "hok": "không",
+    "dc": "được",
+    "đc": "được",
+    "mn": "mọi người",
+    "mng": "mọi người",
+    "acc": "tài khoản",
+    "fb": "Facebook",
+    "zalo": "Za lô",
+    "kg": "ki lô gam",
+    "km": "ki lô mét",
+    "shop": "cửa hàng",
+    "ok": "ô kê"
+}
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_LINK_RE = re.compile(r'http\S+')
+
+
+class _PrintableTable(dict):
+    """Bảng translate: ký tự không in được -> xóa. Ghi nhớ từng ký tự đã gặp nên chỉ gọi isprintable() 1 lần/ký tự"""
+    def __missing__(self, codepoint):
+        value = None if not chr(codepoint).isprintable() else codepoint
+        self[codepoint] = value
+        return value
+
+_PRINTABLE_TABLE = _PrintableTable()
+
+
+class TextNormalizer:
+    """Bảng từ viết tắt được biên dịch 1 lần thành 1 regex duy nhất (tra từ điển khi thay),
+    kết quả được ghi nhớ theo mã băm nội dung. Có thể nạp lại bảng từ DB qua `loader`."""
+
+    def __init__(self, abbreviations=None, loader=None, reload_seconds=300, cache_size=256):
+        self._lock = threading.Lock()
+        self._reload_guard = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._loader = loader
+        self._reload_seconds = reload_seconds
+        self._last_load = 0.0
+        self.version = 0
+        self.set_abbreviations(DEFAULT_ABBREVIATIONS if abbreviations is None else abbreviations)
+        if loader is not None:
+            self._start_background_reload()
+
+    def set_abbreviations(self, abbreviations):
+        lookup = {str(k).lower(): v for k, v in abbreviations.items() if k}
+        if lookup:
+            # Từ dài đứng trước để nhánh ngắn không "ăn" mất (vd. "mng" trước "mn")
+            alternation = "|".join(re.escape(k) for k in sorted(lookup, key=len, reverse=True))
+            # \b nghĩa là "ranh giới từ" -> Chỉ thay khi từ đứng một mình; IGNORECASE -> VN hay vn đều thay
+            pattern = re.compile(r'\b(?:' + alternation + r')\b', re.IGNORECASE)
+        else:
+            pattern = None
+        with self._lock:
+            self._compiled = (pattern, lookup) # Gán 1 lần -> luồng khác không bao giờ thấy bảng dở dang
+            self.version += 1
+            self._cache.clear()
+
+    @property
+    def abbreviations(self):
+        return dict(self._compiled[1])
+
+    def reload(self):
+        """Đọc lại bảng từ `loader`. Lỗi thì giữ bảng đang dùng. Trả về True nếu nạp được"""
+        self._last_load = time.time()
+        if self._loader is None:
+            return False
+        try:
+            abbreviations = self._loader()
+        except Exception as e:
+            print(f"Lỗi nạp bảng từ viết tắt TTS, giữ bảng cũ: {e}")
+            return False
+        if abbreviations is None:
+            return False
+        self.set_abbreviations(abbreviations)
+        return True
+
+    def _maybe_reload(self):
+        if self._loader is None or time.time() - self._last_load < self._reload_seconds:
+            return
+        self._start_background_reload()
+
+    def _start_background_reload(self):
+        # Nạp ở luồng nền, lượt gọi hiện tại dùng tạm bảng đang có (không bắt user chờ DB). Chỉ 1 luồng đi nạp
+        if not self._reload_guard.acquire(blocking=False):
+            return
+        self._last_load = time.time() # Các lượt gọi trong lúc đang nạp không khởi động thêm luồng
+
+        def _run():
+            try:
+                self.reload()
+            finally:
+                self._reload_guard.release()
+        threading.Thread(target=_run, name="tts-abbr-reload", daemon=True).start()
+
+    def _normalize(self, text):
+        # 1. Xóa các thẻ HTML & Link rác
+        text = _TAG_RE.sub('', text)
+        text = _LINK_RE.sub('', text)
+
+        # 2. Thay từ viết tắt: 1 lần quét cho cả bảng
+        pattern, lookup = self._compiled
+        if pattern is not None:
+            text = pattern.sub(lambda m: lookup.get(m.group(0).lower(), m.group(0)), text)
+
+        # 3. Xóa ký tự điều khiển lạ & Chuẩn hóa khoảng trắng
+        text = text.translate(_PRINTABLE_TABLE)
+        return " ".join(text.split())
+
+    def normalize(self, text):
+        if not text: return ""
+        text = str(text)
+        self._maybe_reload()
+        if not self._cache_size:
+            return self._normalize(text)
+
+        key = (self.version, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        result = self._normalize(text)
+        with self._lock:
+            self._cache[key] = result
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return result
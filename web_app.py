@@ -4,7 +4,7 @@ import requests
 import json
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import bcrypt
 import time
 import html  # <--- Thêm thư viện này để xử lý ký tự đặc biệt
@@ -13,8 +13,21 @@ from supabase import create_client, Client
 from streamlit_mic_recorder import mic_recorder
 import extra_streamlit_components as stx # <--- Thư viện Cookie
 import uuid # <--- Để tạo mã Token ngẫu nhiên
+import hashlib # <--- [MỚI] Dấu vân tay nội dung kịch bản khi đồng bộ thư viện
 import struct # <--- [MỚI] Để xử lý file âm thanh WAV
 import base64 # <--- [QUAN TRỌNG] Thêm dòng này để giải mã âm thanh
+import threading # <--- [MỚI] Khóa dùng chung cho các cache toàn server
+import os
+import sys
+import queue # <--- [MỚI] Hàng đợi ghi log chạy nền
+import atexit
+import gzip
+import unicodedata # <--- [MỚI] Bỏ dấu tiếng Việt cho chỉ mục tìm kiếm
+import bisect
+from collections import Counter
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tts_normalizer import TextNormalizer, DEFAULT_ABBREVIATIONS # <--- [MỚI] Bộ làm sạch văn bản TTS
 
 
 # --- DANH SÁCH GIỌNG VIENEU-TTS ---
@@ -31,15 +44,122 @@ VIENEU_VOICES = [
 # --- THÊM ĐOẠN NÀY VÀO SAU CÁC DÒNG IMPORT ---
 # Hàm này giúp kết nối Supabase và giữ kết nối không bị ngắt
 # Dùng cache_resource cho KẾT NỐI (Database, ML models...)
+def supabase_key_role(key):
+    """Vai trò của key Supabase: 'service_role' / 'anon' / ... (None nếu không đọc được)"""
+    key = str(key or "")
+    if key.startswith("sb_secret_"):
+        return "service_role"
+    if key.startswith("sb_publishable_"):
+        return "anon"
+    try:
+        payload = key.split(".")[1]
+        return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))).get("role")
+    except Exception:
+        return None
+
+@st.cache_resource
+def _logged_once():
+    return set()
+
+def log_once(tag, message):
+    """In lỗi / cảnh báo 1 lần cho cả tiến trình (tránh in lặp lại ở mỗi lượt chạy)"""
+    seen = _logged_once()
+    if tag not in seen:
+        seen.add(tag)
+        print(message)
+
 @st.cache_resource
 def init_supabase():
     url = st.secrets["supabase"]["url"]
     key = st.secrets["supabase"]["key"]
+    # Các RPC trong supabase_functions.sql (hàng chờ, quota, gửi đơn...) chỉ cấp quyền cho service_role:
+    # dùng key anon thì app vẫn chạy nhưng rơi về cách cũ (chậm hơn, nhiều lệnh gọi hơn)
+    role = supabase_key_role(key)
+    if role != "service_role":
+        print(f"CẢNH BÁO: supabase.key trong secrets có vai trò '{role}', cần key service_role để dùng các RPC trong supabase_functions.sql")
     return create_client(url, key)
 
 # Khởi tạo kết nối ngay lập tức
 supabase = init_supabase()
 
+# --- [NEW] HTTP CLIENT DÙNG CHUNG CHO MỌI LỆNH GỌI RA NGOÀI (Cloudinary, HuggingFace, link audio...) ---
+# 1 Session cho cả server: giữ kết nối (keep-alive) theo từng host -> không phải DNS + bắt tay TLS lại mỗi lần.
+# Lỗi mạng / 5xx / 429 được thử lại với thời gian chờ tăng dần + ngẫu nhiên (có Retry-After thì theo).
+# Mỗi host có giới hạn số request chạy cùng lúc để luồng nền không dội cả server đích.
+_HTTP_CONF = st.secrets.get("http", {})
+HTTP_CONNECT_TIMEOUT = float(_HTTP_CONF.get("connect_timeout", 5))
+HTTP_READ_TIMEOUT = float(_HTTP_CONF.get("read_timeout", 30))
+HTTP_MAX_RETRIES = int(_HTTP_CONF.get("max_retries", 3))
+HTTP_RETRY_BASE_SECONDS = 0.5
+HTTP_RETRY_MAX_SECONDS = 8
+HTTP_POOL_SIZE = 16 # Số kết nối giữ sẵn cho mỗi host
+HTTP_HOST_CONCURRENCY = int(_HTTP_CONF.get("host_concurrency", 8))
+HTTP_HOST_LIMITS = {"api.cloudinary.com": 4} # Host cần giới hạn chặt hơn mặc định
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class HttpClient:
+    def __init__(self):
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._host_slots = {}
+
+    def _slots(self, url):
+        from urllib.parse import urlsplit
+        host = (urlsplit(url).hostname or "").lower()
+        with self._lock:
+            slots = self._host_slots.get(host)
+            if slots is None:
+                slots = self._host_slots[host] = threading.BoundedSemaphore(HTTP_HOST_LIMITS.get(host, HTTP_HOST_CONCURRENCY))
+        return slots
+
+    @staticmethod
+    def _retry_delay(attempt, response=None):
+        import random
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_RETRY_MAX_SECONDS)
+        return min(HTTP_RETRY_BASE_SECONDS * (2 ** attempt), HTTP_RETRY_MAX_SECONDS) + random.uniform(0, HTTP_RETRY_BASE_SECONDS)
+
+    def request(self, method, url, timeout=None, retries=HTTP_MAX_RETRIES, **kwargs):
+        """Như requests.request. Lưu ý: dữ liệu gửi đi phải đọc lại được (bytes, không phải luồng) nếu cho thử lại"""
+        timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        slots = self._slots(url)
+        attempt = 0
+        while True:
+            try:
+                with slots:
+                    response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+            else:
+                if response.status_code not in HTTP_RETRY_STATUSES or attempt >= retries:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                response.close()
+                time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, retries=0, **kwargs):
+        # POST mặc định KHÔNG thử lại: hết thời gian chờ có thể đến sau khi server đã nhận -> tạo trùng file/việc.
+        # Chỉ truyền retries khi lệnh gửi lại được an toàn (vd. khúc upload có X-Unique-Upload-Id + Content-Range)
+        return self.request("POST", url, retries=retries, **kwargs)
+
+@st.cache_resource
+def get_http_client():
+    return HttpClient()
+
 # --- [NEW] QUẢN LÝ COOKIE ---
 # [ĐÃ SỬA] Bỏ @st.cache_resource vì CookieManager là Widget, không được cache
 def get_cookie_manager():
@@ -49,9 +169,11 @@ def get_cookie_manager():
 cookie_manager = get_cookie_manager()
 
 # --- [NEW] RATE LIMIT (CHỐNG SPAM) BẰNG DATABASE ---
-def check_rate_limit(user_email):
+ORDER_RATE_LIMIT_SECONDS = 5 # Phải khớp p_min_interval_seconds mặc định của RPC submit_order
+
+def db_rate_limited(user_email, seconds=ORDER_RATE_LIMIT_SECONDS):
+    """BẢO VỆ LỚP 1: KIỂM TRA TRÊN DATABASE (Không thể lách luật). True nếu đơn gần nhất mới tạo chưa quá `seconds` giây"""
     try:
-        # 1. BẢO VỆ LỚP 1: KIỂM TRA TRÊN DATABASE (Không thể lách luật)
         # Lấy thời gian của video gần nhất mà user này vừa bấm tạo
         res = supabase.table('orders').select('created_at').eq('email', user_email).order('created_at', desc=True).limit(1).execute()
         
@@ -66,18 +188,24 @@ def check_rate_limit(user_email):
             diff_seconds = (now_time - last_time).total_seconds()
             
             # Nếu chưa qua 5 giây -> Chặn ngay lập tức
-            if diff_seconds < 5:
-                return False
+            if diff_seconds < seconds:
+                return True
                 
     except Exception as e:
         print(f"Lỗi hệ thống chống Spam DB: {e}")
+    return False
+
+def check_rate_limit(user_email, check_db=True):
+    # check_db=False: chỉ kiểm tra trên trình duyệt (submit_order đã tự kiểm tra trên DB trong cùng lần gọi)
+    if check_db and db_rate_limited(user_email):
+        return False
 
     # 2. BẢO VỆ LỚP 2: KIỂM TRA TRÊN TRÌNH DUYỆT (Giữ nguyên như cũ để phòng hờ)
     last_req_key = f"last_req_{user_email}"
     current_time = time.time()
     
     if last_req_key in st.session_state:
-        if current_time - st.session_state[last_req_key] < 5:
+        if current_time - st.session_state[last_req_key] < ORDER_RATE_LIMIT_SECONDS:
             return False
             
     st.session_state[last_req_key] = current_time
@@ -138,12 +266,89 @@ def verify_password(plain_text_password, hashed_password):
 
 
 
-# --- [NEW] CẬP NHẬT QUOTA ---
-def update_user_usage_supabase(user_id, current_used):
+# --- [NÂNG CẤP] GIỮ CHỖ / HOÀN QUOTA NGUYÊN TỬ TRÊN SERVER ---
+# RPC reserve_quota (xem supabase_functions.sql) kiểm tra hạn mức và cộng lượt dùng (video + ký tự TTS) trong 1 câu lệnh,
+# nên 2 phiên bấm cùng lúc không thể cùng vượt hạn mức, và không còn ghi đè bằng số quota_used cũ trong session.
+# Giữ chỗ TRƯỚC khi tạo đơn; tạo đơn lỗi thì refund_quota trả lại đúng phần đã giữ.
+QUOTA_DEFAULTS = {"quota_max": 10, "tts_limit": 10000}
+
+def rpc_missing(error):
+    """True nếu lỗi là do RPC chưa được tạo trên Supabase (chỉ khi đó mới được chạy cách cũ).
+    Lỗi khác (timeout, mất phản hồi...) có thể xảy ra SAU khi server đã ghi -> không được làm lại bằng cách cũ"""
+    return "PGRST202" in str(error) or "Could not find the function" in str(error)
+
+def _change_quota_legacy(user_id, videos, tts_chars, refund=False):
+    # Phòng hờ khi chưa tạo RPC: đọc rồi chỉ ghi nếu số liệu chưa bị phiên khác đổi (so khớp giá trị cũ), lệch thì đọc lại
+    for _ in range(3):
+        res = supabase.table('users').select("quota_used, quota_max, tts_usage, tts_limit").eq('id', user_id).execute()
+        if not res.data:
+            return None
+        row = res.data[0]
+        totals = {
+            "ok": True,
+            "quota_used": row.get('quota_used') or 0,
+            "quota_max": row.get('quota_max') or QUOTA_DEFAULTS['quota_max'],
+            "tts_usage": row.get('tts_usage') or 0,
+            "tts_limit": row.get('tts_limit') or QUOTA_DEFAULTS['tts_limit']
+        }
+        if not refund and ((videos > 0 and totals['quota_used'] + videos > totals['quota_max']) or
+                           (tts_chars > 0 and totals['tts_usage'] + tts_chars > totals['tts_limit'])):
+            return dict(totals, ok=False)
+
+        changes = {}
+        if videos: changes['quota_used'] = max(0, totals['quota_used'] - videos) if refund else totals['quota_used'] + videos
+        if tts_chars: changes['tts_usage'] = max(0, totals['tts_usage'] - tts_chars) if refund else totals['tts_usage'] + tts_chars
+        if not changes:
+            return totals
+        query = supabase.table('users').update(changes).eq('id', user_id)
+        for col in changes:
+            query = query.is_(col, 'null') if row.get(col) is None else query.eq(col, row[col])
+        if query.execute().data:
+            return dict(totals, **changes)
+    return None
+
+def reserve_quota(user_id, videos=0, tts_chars=0):
+    """Giữ chỗ `videos` lượt video + `tts_chars` ký tự TTS nếu còn đủ hạn mức.
+    Trả về {'ok', 'quota_used', 'quota_max', 'tts_usage', 'tts_limit'} (số liệu mới nhất),
+    None nếu không có user / không ghi được sau vài lần thử; lỗi DB thì raise"""
+    videos, tts_chars = max(0, int(videos or 0)), max(0, int(tts_chars or 0))
     try:
-        supabase.table('users').update({"quota_used": current_used + 1}).eq('id', user_id).execute()
+        res = supabase.rpc('reserve_quota', {"p_user_id": user_id, "p_videos": videos, "p_tts_chars": tts_chars}).execute()
+        return res.data[0] if res.data else None
     except Exception as e:
-        print(f"Lỗi update quota: {e}")
+        if not rpc_missing(e):
+            raise
+        print(f"Chưa có RPC reserve_quota, dùng cách cũ: {e}")
+    return _change_quota_legacy(user_id, videos, tts_chars)
+
+def refund_quota(user_id, videos=0, tts_chars=0):
+    """Trả lại phần quota đã giữ (tạo đơn / yêu cầu TTS thất bại). Trả về số liệu mới hoặc None; lỗi DB thì raise"""
+    videos, tts_chars = max(0, int(videos or 0)), max(0, int(tts_chars or 0))
+    if not videos and not tts_chars:
+        return None
+    try:
+        res = supabase.rpc('refund_quota', {"p_user_id": user_id, "p_videos": videos, "p_tts_chars": tts_chars}).execute()
+        return res.data[0] if res.data else None
+    except Exception as e:
+        if not rpc_missing(e):
+            raise
+        print(f"Chưa có RPC refund_quota, dùng cách cũ: {e}")
+    return _change_quota_legacy(user_id, videos, tts_chars, refund=True)
+
+def apply_quota_totals(user, totals):
+    """Chép số liệu quota mới nhất từ DB vào user trong session (thay cho việc += 1 trên số cũ)"""
+    if not totals:
+        return
+    for key in ('quota_used', 'quota_max', 'tts_usage', 'tts_limit'):
+        if totals.get(key) is not None:
+            user[key] = totals[key]
+
+def release_quota(user, videos=0, tts_chars=0):
+    """Hoàn quota khi đang xử lý 1 lỗi khác: lỗi hoàn chỉ được ghi log để lỗi gốc vẫn được báo cho user"""
+    try:
+        apply_quota_totals(user, refund_quota(user['id'], videos=videos, tts_chars=tts_chars))
+    except Exception as e:
+        print(f"Lỗi hoàn quota cho {user.get('email')}: {e}")
 
 
 # --- [NEW] QUẢN LÝ GIỚI HẠN TTS GEMINI ---
@@ -166,29 +371,11 @@ def check_tts_quota(user_data, text_to_speak):
     
     return True, char_count
 
-def update_tts_usage_supabase(user_id, added_chars):
-    """Cộng dồn số ký tự đã dùng vào Database"""
-    try:
-        # Lấy số liệu mới nhất từ DB để cộng cho chính xác (tránh race condition)
-        res = supabase.table('users').select("tts_usage").eq('id', user_id).execute()
-        if res.data:
-            current_val = res.data[0]['tts_usage'] or 0
-            new_val = current_val + added_chars
-            supabase.table('users').update({"tts_usage": new_val}).eq('id', user_id).execute()
-            return new_val
-    except Exception as e:
-        print(f"Lỗi update TTS: {e}")
-    return None
-
 
 def create_order_logic(user, status, audio_link, content, settings):
     import random
     try:
-        # 1. Kiểm tra Quota (Nếu là tạo video)
-        if status == "Pending":
-            if user['quota_used'] >= user['quota_max']:
-                st.error("⚠️ Bạn đã hết lượt tạo video!")
-                return
+        # 1. Quota (Nếu là tạo video) được kiểm tra + trừ ngay khi gửi đơn (submit_order)
 
         # 2. Tạo ID đơn hàng
         now_vn = datetime.utcnow() + timedelta(hours=7)
@@ -213,14 +400,18 @@ def create_order_logic(user, status, audio_link, content, settings):
             "settings": final_settings
         }
 
-        # 4. Gửi lên Supabase
-        supabase.table('orders').insert(order_data).execute()
+        # 4. Gửi lên Supabase (chống spam chỉ áp dụng cho đơn tạo video)
+        result = submit_order(user, order_data, min_interval=ORDER_RATE_LIMIT_SECONDS if status == "Pending" else 0)
+        if result['status'] == "no_quota":
+            st.error("⚠️ Bạn đã hết lượt tạo video!")
+            return
+        if result['status'] == "rate_limited":
+            st.error("⚠️ Thao tác quá nhanh! Vui lòng đợi 5 giây giữa mỗi lần gửi.")
+            return
+        remember_new_order(user['email'], order_data) # Cập nhật cache lịch sử từ chính dòng vừa ghi
 
         # 5. Xử lý sau khi lưu
         if status == "Pending":
-            # Trừ quota video
-            update_user_usage_supabase(user['id'], user['quota_used'])
-            st.session_state['user_info']['quota_used'] += 1
             st.success(f"✅ Đã gửi yêu cầu tạo video! (Mã: {order_id})")
         else:
             st.toast("✅ Đã lưu bản thu vào lịch sử!", icon="💾")
@@ -333,17 +524,15 @@ def load_draft_from_supabase(email):
     return ""
 
 # --- [NEW] HÀM QUẢN LÝ LỊCH SỬ TTS (ĐỂ KHÔNG MẤT KHI F5) ---
+# [NÂNG CẤP] Không ghi ngay trong lượt của user: đẩy vào hàng đợi ghi nền (gộp nhiều dòng / 1 lệnh insert)
 def save_tts_log(email, content, audio_link, voice_info):
-    try:
-        data = {
-            "email": email,
-            "content": content,
-            "audio_link": audio_link,
-            "voice_info": voice_info
-        }
-        supabase.table('tts_logs').insert(data).execute()
-    except Exception as e:
-        print(f"Lỗi lưu TTS log: {e}")
+    data = {
+        "email": email,
+        "content": content,
+        "audio_link": audio_link,
+        "voice_info": voice_info
+    }
+    get_write_behind().insert_row('tts_logs', data)
 
 # --- [NEW] HÀM DỌN DẸP LOGS CŨ (TỰ ĐỘNG) ---
 def cleanup_old_tts_logs(days=7):
@@ -384,6 +573,68 @@ def get_pending_local_ai_request(email, content):
         print(f"Lỗi check request: {e}")
     return None
 
+# --- [NEW] THEO DÕI TIẾN ĐỘ TTS KHÔNG CHẶN LUỒNG (THAY VÒNG LẶP 40 x 3 GIÂY) ---
+# Fragment tự chạy lại mỗi giây nhưng chỉ hỏi Supabase khi tới hẹn -> luồng được trả lại cho server giữa các lần
+TTS_POLL_SCHEDULE = [2, 2, 3, 3, 5, 5, 8, 8, 10] # Số giây chờ giữa các lần hỏi: mới gửi hỏi nhanh, càng lâu càng thưa
+TTS_POLL_MAX_INTERVAL = 15 # Khoảng cách tối đa giữa 2 lần hỏi
+TTS_POLL_MAX_SECONDS = 180 # Quá 3 phút thì dừng hỏi, user bấm "Kiểm tra lại" hoặc F5 sau
+TTS_POLL_TICK_SECONDS = 1
+
+def start_tts_poll(req_id):
+    now = time.time()
+    st.session_state['tts_poll'] = {"req_id": req_id, "started_at": now, "checks": 0, "next_at": now, "gave_up": False}
+
+def _next_tts_poll_delay(check_count):
+    if check_count < len(TTS_POLL_SCHEDULE):
+        return TTS_POLL_SCHEDULE[check_count]
+    return TTS_POLL_MAX_INTERVAL
+
+@st.fragment(run_every=TTS_POLL_TICK_SECONDS)
+def tts_progress_poller(req_id):
+    """Hiện tiến độ & tự chuyển sang kết quả khi yêu cầu TTS chuyển sang done/error"""
+    poll = st.session_state.get('tts_poll')
+    if not poll or poll.get('req_id') != req_id:
+        start_tts_poll(req_id)
+        poll = st.session_state['tts_poll']
+
+    now = time.time()
+    elapsed = now - poll['started_at']
+
+    # Chạm trần thời gian -> Tải lại cả trang để tắt fragment (không hỏi DB nữa)
+    if elapsed > TTS_POLL_MAX_SECONDS:
+        poll['gave_up'] = True
+        st.rerun()
+
+    if now >= poll['next_at']:
+        poll['next_at'] = now + _next_tts_poll_delay(poll['checks'])
+        poll['checks'] += 1
+        try:
+            quick_check = supabase.table('tts_requests').select("status, audio_link, output_path, voice_id").eq('id', req_id).execute()
+        except Exception as e:
+            print(f"Lỗi kiểm tra tiến độ TTS: {e}")
+            quick_check = None
+
+        if quick_check and quick_check.data:
+            current_status = quick_check.data[0]['status']
+            if current_status == 'done':
+                st.session_state['local_ai_audio_link'] = quick_check.data[0]['audio_link']
+                st.session_state['local_ai_info'] = f"Voice: {quick_check.data[0]['voice_id']}"
+                del st.session_state['pending_tts_id']
+                st.session_state.pop('tts_poll', None)
+                st.rerun() # Tải lại trang, lúc này nó sẽ nhảy sang Nhánh 1
+            elif current_status == 'error':
+                st.session_state['tts_error_message'] = "❌ Quá trình tạo giọng bị lỗi từ máy chủ. Vui lòng thử lại."
+                del st.session_state['pending_tts_id']
+                st.session_state.pop('tts_poll', None)
+                # Dọn dẹp bộ nhớ tự động nếu có lỗi
+                if 'auto_create_video_settings' in st.session_state:
+                    del st.session_state['auto_create_video_settings']
+                    del st.session_state['auto_create_video_script']
+                st.rerun()
+
+    wait_left = max(0, int(poll['next_at'] - time.time()))
+    st.caption(f"🔄 Đã kiểm tra {poll['checks']} lần ({int(elapsed)} giây). Lần kiểm tra tiếp theo sau {wait_left} giây... Tự động hiện kết quả khi xong.")
+
 # --- [NEW] HÀM CALLBACK ĐỂ AUTO-SAVE ---
 def auto_save_callback():
     # Kiểm tra xem đã đăng nhập chưa
@@ -398,45 +649,647 @@ def auto_save_callback():
         # Hiện thông báo nhỏ góc dưới (Toast) để người dùng yên tâm
         st.toast("Đã tự động lưu nháp! ✅")
 
-# --- [UPDATE] HÀM LẤY LỊCH SỬ TỪ SHEET ORDERS ---
-# [ĐÃ SỬA] Thêm Cache để không gọi API liên tục (ttl=300 nghĩa là lưu cache 300 giây/5 phút)
-# Sửa st.cache_data thành st.cache (để chạy được trên server cũ)
+# --- [UPDATE] HÀM LẤY LỊCH SỬ TỪ SUPABASE (CÓ CACHE THEO USER) ---
+# Cache dùng chung toàn server, mỗi email 1 mục kèm mã phiên bản (version).
+# Mọi chỗ tự ghi vào orders sẽ tăng version -> lần đọc sau biết cache đã cũ.
+# Sau khi tự insert đơn, ta chèn luôn dòng vừa ghi vào cache nên KHÔNG phải tải lại.
+HISTORY_CACHE_TTL = 300 # 5 phút
+HISTORY_CACHE_TTL_PENDING = 30 # Còn đơn đang chạy thì làm mới nhanh hơn để thấy trạng thái đổi
+# [PHÂN TRANG] Lần đầu chỉ tải đúng số dòng hiển thị, bấm "Xem thêm" mới tải trang kế tiếp (keyset theo created_at, id)
+HISTORY_FIRST_PAGE = int(st.secrets.get("history", {}).get("first_page", 3))
+HISTORY_PAGE_SIZE = int(st.secrets.get("history", {}).get("page_size", 10))
+
+@st.cache_resource
+def _history_cache():
+    return {"lock": threading.Lock(), "entries": {}, "versions": {}}
+
+def bump_history_version(email):
+    store = _history_cache()
+    with store['lock']:
+        store['versions'][email] = store['versions'].get(email, 0) + 1
+        return store['versions'][email]
+
+# [TẢI LƯỜI] Danh sách chỉ lấy các cột nhẹ + đoạn tóm tắt tính sẵn trên server (view orders_history).
+# Toàn bộ kịch bản chỉ tải khi user mở chi tiết đúng dòng đó (get_order_detail).
+HISTORY_LIST_COLUMNS = "id, email, status, created_at, result_link, audio_link"
+
+def _make_preview(content, max_words=10):
+    try:
+        words = html.unescape(str(content or "")).split()
+        return " ".join(words[:max_words]) + "..." if len(words) > max_words else " ".join(words)
+    except:
+        return "Kịch bản..."
+
+def _build_history_entry(rows, version, fetched_at, has_more=False):
+    # Dòng tự ghi (hoặc dữ liệu phòng hờ) còn kèm nội dung đầy đủ -> tự tính tóm tắt rồi bỏ cột nặng khỏi cache
+    if any('content' in item or 'settings' in item for item in rows):
+        rows = [{k: v for k, v in dict(item, preview=item.get('preview') or _make_preview(item.get('content'))).items()
+                 if k not in ('content', 'settings')} for item in rows]
+    df = pd.DataFrame(rows)
+    if not df.empty:
+        # Đổi tên cột cho khớp với giao diện hiển thị
+        df = df.rename(columns={
+            'created_at': 'NgayTao', 
+            'result_link': 'LinkKetQua', 
+            'status': 'TrangThai',
+            'id': 'ID',
+            'audio_link': 'LinkGiongNoi',
+            'preview': 'TomTat'
+        })
+    has_pending = any(item.get('status') in ('Pending', 'Processing') for item in rows)
+    return {
+        "rows": rows, "df": df, "version": version, "fetched_at": fetched_at, "has_more": has_more,
+        "ttl": HISTORY_CACHE_TTL_PENDING if has_pending else HISTORY_CACHE_TTL
+    }
+
+def _fetch_history_page(email, limit, cursor_row=None):
+    """Lấy 1 trang (mới -> cũ). Xin thừa 1 dòng để biết còn trang sau hay không"""
+    def run(table_name, columns):
+        query = supabase.table(table_name).select(columns).eq('email', email)
+        if cursor_row:
+            # Keyset: (created_at, id) nhỏ hơn dòng cuối đã có -> Dùng được index, không phải bỏ qua N dòng như offset
+            c_time, c_id = cursor_row['created_at'], cursor_row['id']
+            query = query.or_(f'created_at.lt."{c_time}",and(created_at.eq."{c_time}",id.lt."{c_id}")')
+        return query.order('created_at', desc=True).order('id', desc=True).limit(limit + 1).execute()
+
+    try:
+        response = run('orders_history', HISTORY_LIST_COLUMNS + ", preview")
+    except Exception as e:
+        # Phòng hờ khi chưa tạo view trên Supabase: lấy thêm content để tự tính tóm tắt
+        print(f"Lỗi đọc view orders_history, dùng bảng orders: {e}")
+        response = run('orders', HISTORY_LIST_COLUMNS + ", content")
+    rows = response.data or []
+    return rows[:limit], len(rows) > limit
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _load_order_detail(order_id, email):
+    # Lỗi thì raise -> cache_data không lưu, lần mở sau tải lại
+    res = supabase.table('orders').select("content").eq('id', order_id).eq('email', email).limit(1).execute()
+    return res.data[0] if res.data else {}
+
+def get_order_detail(order_id, email):
+    """Chỉ gọi cho dòng lịch sử user đang mở (kèm điều kiện email để không đọc được đơn người khác)"""
+    try:
+        return _load_order_detail(order_id, email)
+    except Exception as e:
+        print(f"Lỗi tải chi tiết đơn {order_id}: {e}")
+        return {}
+
+def toggle_history_row(order_id):
+    """Gọi từ on_click của nút tiêu đề dòng lịch sử (chạy trước lượt vẽ lại -> không cần st.rerun)"""
+    st.session_state['history_open_id'] = None if st.session_state.get('history_open_id') == order_id else order_id
+
 def get_user_history(email):
+    """Trả về DataFrame lịch sử (DÙNG CHUNG giữa các phiên -> chỉ đọc, muốn sửa thì .copy())"""
+    store = _history_cache()
+    with store['lock']:
+        version = store['versions'].get(email, 0)
+        entry = store['entries'].get(email)
+    if entry and entry['version'] == version and time.time() - entry['fetched_at'] < entry['ttl']:
+        return entry['df']
+
     try:
         # Gọi trực tiếp Supabase, chỉ lấy dữ liệu của user đó (Bảo mật hơn)
-        # Chỉ lấy tối đa 15 video gần nhất để đảm bảo tốc độ tải trang
-        response = supabase.table('orders').select("*").eq('email', email).order('created_at', desc=True).limit(15).execute()        
-        if response.data:
-            df = pd.DataFrame(response.data)
-            # Đổi tên cột cho khớp với giao diện hiển thị
-            df = df.rename(columns={
-                'created_at': 'NgayTao', 
-                'result_link': 'LinkKetQua', 
-                'status': 'TrangThai',
-                'id': 'ID',
-                'audio_link': 'LinkGiongNoi',
-                'content': 'NoiDung'
-            })
-            return df
+        # Tải lại đủ số dòng đã mở trước đó để user không bị mất các trang cũ đang xem
+        limit = max(HISTORY_FIRST_PAGE, len(entry['rows']) if entry else 0)
+        rows, has_more = _fetch_history_page(email, limit)
+        entry = _build_history_entry(rows, version, time.time(), has_more)
+        with store['lock']:
+            store['entries'][email] = entry
+        return entry['df']
     except Exception as e:
         print(f"Lỗi tải lịch sử Supabase: {e}")
     
     # Trả về bảng rỗng nếu có lỗi hoặc không có dữ liệu
     return pd.DataFrame()
 
+def _as_db_timestamp(value):
+    """Đưa created_at tự ghi (utcnow().isoformat(), không múi giờ) về đúng dạng timestamptz DB trả về.
+    Dòng cuối cache làm mốc keyset -> lệch dạng/múi giờ là trang sau bị sót hoặc lặp đơn"""
+    try:
+        dt_obj = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return value
+    if dt_obj.tzinfo is None:
+        dt_obj = dt_obj.replace(tzinfo=timezone.utc) # Các chỗ ghi đơn đều dùng giờ UTC
+    return dt_obj.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+def remember_new_order(email, order_row):
+    """Gọi ngay sau khi insert vào orders: tăng version và chèn dòng vừa ghi lên đầu cache"""
+    version = bump_history_version(email)
+    order_row = dict(order_row)
+    if order_row.get('created_at'):
+        order_row['created_at'] = _as_db_timestamp(order_row['created_at'])
+    store = _history_cache()
+    with store['lock']:
+        entry = store['entries'].get(email)
+        if entry is None:
+            return # Chưa có cache -> lần đọc sau tự tải
+        rows = [order_row] + [item for item in entry['rows'] if item.get('id') != order_row.get('id')]
+        store['entries'][email] = _build_history_entry(rows, version, entry['fetched_at'], entry['has_more'])
+
+def patch_history_cache(email, updates):
+    """Sửa vài cột của các đơn đã có trong cache. updates = {mã đơn: {cột DB: giá trị}}"""
+    store = _history_cache()
+    with store['lock']:
+        entry = store['entries'].get(email)
+        if entry is None:
+            return
+        rows = [dict(item, **updates[item.get('id')]) if item.get('id') in updates else item for item in entry['rows']]
+        store['entries'][email] = _build_history_entry(rows, entry['version'], entry['fetched_at'], entry['has_more'])
+
+def history_has_more(email):
+    store = _history_cache()
+    with store['lock']:
+        entry = store['entries'].get(email)
+        return bool(entry and entry['has_more'])
+
+def load_more_history(email):
+    """Tải đúng 1 trang kế tiếp và nối vào cuối cache (các trang trước giữ nguyên, không tải lại)"""
+    store = _history_cache()
+    with store['lock']:
+        entry = store['entries'].get(email)
+    if not entry or not entry['has_more'] or not entry['rows']:
+        return False
+    try:
+        rows, has_more = _fetch_history_page(email, HISTORY_PAGE_SIZE, cursor_row=entry['rows'][-1])
+    except Exception as e:
+        print(f"Lỗi tải thêm lịch sử: {e}")
+        return False
+    with store['lock']:
+        current = store['entries'].get(email) or entry
+        known_ids = {item.get('id') for item in current['rows']}
+        merged = current['rows'] + [item for item in rows if item.get('id') not in known_ids]
+        store['entries'][email] = _build_history_entry(merged, current['version'], current['fetched_at'], has_more)
+    return True
+
+# --- [NEW] CHIA KỊCH BẢN DÀI THÀNH NHIỀU ĐOẠN ĐỂ MÁY TTS ĐỌC SONG SONG ---
+# Dòng cha (status 'split') giữ toàn bộ kịch bản, máy TTS bỏ qua. Mỗi đoạn là 1 dòng con 'pending' (parent_id, chunk_index).
+# Khi mọi đoạn xong, app ghép thành 1 file WAV, tải lên Cloudinary rồi chuyển dòng cha sang 'done'.
+TTS_CHUNK_MAX_CHARS = 500
+_SENTENCE_BREAK_RE = re.compile(r'(?<=[.!?…])\s+|\s*\n+\s*')
+_CLAUSE_BREAK_RE = re.compile(r'(?<=[,;:])\s+')
+
+def _split_long_sentence(sentence, max_chars):
+    """Câu dài quá mức: cắt ở dấu phẩy/chấm phẩy, vẫn dài thì cắt ở khoảng trắng"""
+    parts = []
+    for clause in _CLAUSE_BREAK_RE.split(sentence):
+        while len(clause) > max_chars:
+            cut = clause.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            parts.append(clause[:cut].strip())
+            clause = clause[cut:].strip()
+        if clause:
+            parts.append(clause)
+    return parts
+
+def split_tts_chunks(text, max_chars=TTS_CHUNK_MAX_CHARS):
+    """Chia kịch bản theo ranh giới câu thành các đoạn <= max_chars (gộp nhiều câu ngắn vào 1 đoạn)"""
+    pieces = []
+    for sentence in _SENTENCE_BREAK_RE.split(str(text or "")):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        pieces.extend([sentence] if len(sentence) <= max_chars else _split_long_sentence(sentence, max_chars))
+
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def enqueue_chunked_tts_request(insert_data):
+    """Gửi 1 yêu cầu TTS dạng nhiều đoạn. Trả về id dòng cha (dùng như id yêu cầu thường)"""
+    chunks = split_tts_chunks(insert_data['content'])
+    if len(chunks) < 2:
+        res = supabase.table('tts_requests').insert(insert_data).execute()
+        return res.data[0]['id'] if res.data else None
+
+    res = supabase.table('tts_requests').insert(dict(insert_data, status="split")).execute()
+    if not res.data:
+        return None
+    parent_id = res.data[0]['id']
+    try:
+        supabase.table('tts_requests').insert([
+            dict(insert_data, content=chunk, parent_id=parent_id, chunk_index=i)
+            for i, chunk in enumerate(chunks)
+        ]).execute()
+    except Exception as e:
+        # DB chưa có cột parent_id/chunk_index -> trả dòng cha về hàng chờ như 1 yêu cầu thường
+        print(f"Lỗi tạo các đoạn TTS, gửi nguyên kịch bản: {e}")
+        supabase.table('tts_requests').update({"status": "pending"}).eq('id', parent_id).execute()
+    return parent_id
+
+TTS_CHUNK_GAP_SECONDS = 0.15 # Khoảng lặng chèn giữa 2 đoạn khi ghép
+
+def stitch_wav_chunks(wav_blobs, fileobj, gap_seconds=TTS_CHUNK_GAP_SECONDS):
+    """Ghép nhiều file WAV (cùng định dạng, bytes hoặc file-like) vào fileobj, đọc/ghi từng khối nhỏ"""
+    import io
+    import wave
+    writer, fmt = None, None
+    for blob in wav_blobs:
+        with wave.open(io.BytesIO(blob) if isinstance(blob, (bytes, bytearray)) else blob, 'rb') as reader:
+            params = (reader.getnchannels(), reader.getsampwidth(), reader.getframerate())
+            if writer is None:
+                fmt = params
+                writer = StreamingWavWriter(fileobj, sample_rate=fmt[2], num_channels=fmt[0], bits_per_sample=fmt[1] * 8)
+            elif params != fmt:
+                raise ValueError(f"Các đoạn WAV khác định dạng: {params} != {fmt}")
+            else:
+                writer.write_silence(gap_seconds)
+            frames_per_block = max(1, WAV_IO_BLOCK // writer.block_align)
+            while True:
+                frames = reader.readframes(frames_per_block)
+                if not frames:
+                    break
+                writer.write(frames)
+    if writer is None:
+        raise ValueError("Không có đoạn WAV nào để ghép")
+    writer.close()
+    return fileobj
+
+# Ghép + tải file chạy ở luồng nền của server (không phụ thuộc user có mở lịch sử hay không): luồng quét
+# tts_stitch_sweeper cứ TTS_STITCH_SWEEP_SECONDS giây tìm các yêu cầu nhiều đoạn đã xong hết rồi giao việc ghép.
+# Dòng cha đang 'stitching' quá TTS_STITCH_LEASE_SECONDS giây (server chết giữa chừng, lỗi khi trả về 'split'...)
+# thì được giành lại để ghép lại.
+TTS_STITCH_LEASE_SECONDS = 300
+TTS_STITCH_WORKERS = 2
+TTS_STITCH_SWEEP_SECONDS = 15
+TTS_STITCH_SWEEP_BATCH = 50
+
+@st.cache_resource
+def _tts_stitch_executor():
+    """Luồng ghép dùng chung + các id cha đang ghép trong tiến trình này (không gửi trùng việc)"""
+    return {"pool": ThreadPoolExecutor(max_workers=TTS_STITCH_WORKERS, thread_name_prefix="tts-stitch"),
+            "lock": threading.Lock(), "running": set()}
+
+def _stitch_chunked_tts(parent_id, children):
+    """Chạy ở luồng nền, KHÔNG gọi st.*: giành quyền ghép, tải các đoạn, ghép, tải lên rồi đánh dấu 'done'"""
+    import tempfile
+    stale_before = (datetime.utcnow() - timedelta(seconds=TTS_STITCH_LEASE_SECONDS)).isoformat()
+    # Giành quyền ghép (chỉ 1 nơi làm việc này): dòng 'split', hoặc dòng 'stitching' đã quá hạn
+    claimed = supabase.table('tts_requests').update({"status": "stitching", "stitching_started_at": datetime.utcnow().isoformat()}) \
+        .eq('id', parent_id) \
+        .or_(f"status.eq.split,and(status.eq.stitching,stitching_started_at.lt.{stale_before}),and(status.eq.stitching,stitching_started_at.is.null)") \
+        .execute()
+    if not claimed.data:
+        return
+    try:
+        def _download(url):
+            r = get_http_client().get(url)
+            r.raise_for_status()
+            return r.content
+        # Tải lần lượt từng đoạn (generator) và ghi ra file tạm -> RAM chỉ giữ 1 đoạn tại 1 thời điểm
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as stitched:
+            stitch_wav_chunks((_download(child['audio_link']) for child in children), stitched)
+            stitched.seek(0)
+            audio_link, error = cloudinary_upload(stitched, resume_key=f"tts_stitch:{parent_id}")
+        if not audio_link:
+            raise RuntimeError(f"Không tải được file ghép lên Cloudinary: {error}")
+        supabase.table('tts_requests').update({"status": "done", "audio_link": audio_link}).eq('id', parent_id).execute()
+    except Exception as e:
+        # Trả về 'split' để lần đối soát sau thử ghép lại (lỗi cả bước này thì chờ hết hạn giữ quyền)
+        print(f"Lỗi ghép các đoạn TTS {parent_id}: {e}")
+        try:
+            supabase.table('tts_requests').update({"status": "split"}).eq('id', parent_id).eq('status', 'stitching').execute()
+        except Exception as e2:
+            print(f"Lỗi trả yêu cầu TTS {parent_id} về 'split': {e2}")
+
+def _start_stitch(parent_id, children):
+    store = _tts_stitch_executor()
+    with store["lock"]:
+        if parent_id in store["running"]:
+            return
+        store["running"].add(parent_id)
+    def _job():
+        try:
+            _stitch_chunked_tts(parent_id, children)
+        except Exception as e:
+            print(f"Lỗi giành quyền ghép TTS {parent_id}: {e}")
+        finally:
+            with store["lock"]:
+                store["running"].discard(parent_id)
+    store["pool"].submit(_job)
+
+def _load_tts_children(parent_ids):
+    """{id cha: [các dòng con theo thứ tự đoạn]}"""
+    res = supabase.table('tts_requests').select("id, parent_id, chunk_index, status, audio_link") \
+        .in_('parent_id', list(parent_ids)).execute()
+    children_by_parent = {}
+    for item in res.data or []:
+        children_by_parent.setdefault(str(item['parent_id']), []).append(item)
+    return {str(parent_id): sorted(children_by_parent.get(str(parent_id), []), key=lambda c: c['chunk_index'])
+            for parent_id in parent_ids}
+
+def advance_chunked_tts_requests(parent_ids):
+    """Chỉ chạy ở luồng quét nền: đánh dấu lỗi các yêu cầu có đoạn lỗi, giao việc ghép cho yêu cầu đã xong hết"""
+    for parent_id, children in _load_tts_children(parent_ids).items():
+        if any(c['status'] == 'error' for c in children):
+            try:
+                supabase.table('tts_requests').update({"status": "error"}).eq('id', parent_id).execute()
+            except Exception as e:
+                print(f"Lỗi đánh dấu yêu cầu TTS {parent_id} bị lỗi: {e}")
+        elif children and all(c['status'] == 'done' and c.get('audio_link') for c in children):
+            _start_stitch(parent_id, children)
+
+def chunked_tts_states(parent_ids):
+    """Chỉ đọc (dùng khi vẽ lịch sử): {id cha: {"status", "audio_link"}} theo cùng dạng với 1 dòng tts_requests.
+    Dòng cha chưa 'done' thì còn đang chạy / chờ ghép, trừ khi đã có đoạn lỗi"""
+    try:
+        children_by_parent = _load_tts_children(parent_ids)
+    except Exception as e:
+        print(f"Lỗi tải các đoạn TTS: {e}")
+        return {}
+    return {parent_id: {"status": "error" if any(c['status'] == 'error' for c in children) else "processing", "audio_link": None}
+            for parent_id, children in children_by_parent.items()}
+
+def _sweep_chunked_tts(stop_event):
+    cursor = None # Quét xoay vòng theo id: nhiều yêu cầu đang chạy dở không chặn mãi các yêu cầu phía sau
+    while not stop_event.wait(TTS_STITCH_SWEEP_SECONDS):
+        try:
+            query = supabase.table('tts_requests').select("id").in_('status', ['split', 'stitching'])
+            if cursor is not None:
+                query = query.gt('id', cursor)
+            res = query.order('id').limit(TTS_STITCH_SWEEP_BATCH).execute()
+            parent_ids = [str(item['id']) for item in res.data or []]
+            cursor = res.data[-1]['id'] if len(parent_ids) == TTS_STITCH_SWEEP_BATCH else None
+            if parent_ids:
+                advance_chunked_tts_requests(parent_ids)
+        except Exception as e:
+            cursor = None
+            print(f"Lỗi quét các yêu cầu TTS nhiều đoạn: {e}")
+
+@st.cache_resource
+def tts_stitch_sweeper():
+    """1 luồng quét cho cả server, khởi động ở lượt chạy đầu tiên của app"""
+    stop_event = threading.Event()
+    worker = threading.Thread(target=_sweep_chunked_tts, args=(stop_event,), name="tts-stitch-sweep", daemon=True)
+    worker.start()
+    atexit.register(stop_event.set)
+    return stop_event
+
+tts_stitch_sweeper()
+
+# --- [NEW] ĐỐI SOÁT HÀNG LOẠT CÁC BẢN LƯU GIỌNG ĐANG CHỜ TTS NGẦM ---
+def reconcile_pending_tts_rows(history_df):
+    """Gom mọi dòng VoiceOnly có link 'pending_tts_' -> 1 câu in_ vào tts_requests + 1 lần RPC ghi link vào orders.
+    Trả về (bảng lịch sử đã thay link thật, dict {mã đơn: trạng thái TTS})"""
+    tts_states = {}
+    if history_df.empty or 'LinkGiongNoi' not in history_df.columns:
+        return history_df, tts_states
+
+    links = history_df['LinkGiongNoi'].fillna("").astype(str)
+    mask = (history_df['TrangThai'] == 'VoiceOnly') & links.str.startswith("pending_tts_")
+    if not mask.any():
+        return history_df, tts_states
+
+    # Mã yêu cầu TTS -> danh sách vị trí dòng trong bảng
+    req_to_rows = {}
+    for idx in history_df.index[mask]:
+        req_id = links[idx].replace("pending_tts_", "")
+        req_to_rows.setdefault(req_id, []).append(idx)
+
+    try:
+        check_tts = supabase.table('tts_requests').select('id, status, audio_link').in_('id', list(req_to_rows.keys())).execute()
+    except Exception as e:
+        print(f"Lỗi đối soát TTS ngầm: {e}")
+        return history_df, {history_df.at[idx, 'ID']: 'unknown' for idx in history_df.index[mask]}
+
+    history_df = history_df.copy()
+    finished_rows = []
+    found = {str(item['id']): item for item in (check_tts.data or [])}
+    # Yêu cầu chia đoạn: trạng thái thật nằm ở các dòng con (việc ghép file do luồng quét nền làm, ở đây chỉ đọc)
+    split_ids = [req_id for req_id, item in found.items() if item['status'] in ('split', 'stitching')]
+    if split_ids:
+        found.update(chunked_tts_states(split_ids))
+    for req_id, row_indexes in req_to_rows.items():
+        item = found.get(req_id)
+        tts_status = item['status'] if item else 'unknown'
+        real_link = str(item.get('audio_link') or "") if item else ""
+        if tts_status == 'done' and not real_link:
+            tts_status = 'error'
+
+        for idx in row_indexes:
+            order_id = history_df.at[idx, 'ID']
+            tts_states[order_id] = tts_status
+            if tts_status == 'done':
+                history_df.at[idx, 'LinkGiongNoi'] = real_link
+                finished_rows.append({"id": order_id, "email": history_df.at[idx, 'email'], "audio_link": real_link})
+
+    # Ghi ngược link thật vào orders bằng 1 lần gọi RPC set_order_audio_links (1 câu update, chỉ cột audio_link)
+    if finished_rows:
+        email = finished_rows[0]['email']
+        try:
+            supabase.rpc('set_order_audio_links', {
+                "p_email": email,
+                "p_rows": [{"id": item['id'], "audio_link": item['audio_link']} for item in finished_rows]
+            }).execute()
+        except Exception as e:
+            if not rpc_missing(e):
+                print(f"Lỗi ghi link TTS vào đơn: {e}")
+            else:
+                # Phòng hờ khi chưa tạo RPC trên Supabase: cập nhật từng dòng như trước
+                for item in finished_rows:
+                    try:
+                        supabase.table('orders').update({"audio_link": item['audio_link']}).eq('id', item['id']).execute()
+                    except Exception as e2:
+                        print(f"Lỗi cập nhật link TTS {item['id']}: {e2}")
+
+        # Sửa luôn trong cache lịch sử để lần vẽ sau không phải đối soát lại
+        patch_history_cache(email, {item['id']: {"audio_link": item['audio_link']} for item in finished_rows})
+
+    return history_df, tts_states
+
+# --- [NEW] THỐNG KÊ HÀNG CHỜ TÍNH SẴN TRÊN SERVER (DÙNG CHUNG CHO MỌI PHIÊN) ---
+# RPC get_queue_snapshot (xem supabase_functions.sql) trả về mỗi user đang có đơn chờ đúng 1 dòng:
+# số đơn của họ, số đơn người khác xếp trước và tổng độ dài hàng chờ.
+# Dòng được đánh dấu bằng md5(email) (email_key) thay vì email thật để bản chụp không lộ email của ai.
+QUEUE_STATS_TTL = 10 # Giây. Cả server dùng chung 1 bản chụp thay vì mỗi phiên tải cả hàng chờ
+
+def queue_email_key(email):
+    """Phải khớp md5(email) trong get_queue_snapshot"""
+    return hashlib.md5(str(email).encode('utf-8')).hexdigest()
+
+@st.cache_data(ttl=QUEUE_STATS_TTL, show_spinner=False)
+def get_queue_snapshot():
+    try:
+        res = supabase.rpc('get_queue_snapshot').execute()
+        return res.data or []
+    except Exception as e:
+        # Hàm chạy lại mỗi QUEUE_STATS_TTL giây -> chỉ in 1 lần (thường do thiếu RPC hoặc key không phải service_role)
+        log_once("queue_snapshot_fallback", f"Lỗi RPC hàng chờ, dùng cách đếm cũ (key: {supabase_key_role(st.secrets['supabase']['key'])}): {e}")
+
+    # Phòng hờ khi chưa tạo RPC trên Supabase: đếm bằng Python như trước (lỗi ở đây sẽ không bị cache)
+    res = supabase.table('orders').select('email, created_at').in_('status', ['Pending', 'Processing']).execute()
+    rows = res.data or []
+    first_at = {}
+    counts = {}
+    for item in rows:
+        counts[item['email']] = counts.get(item['email'], 0) + 1
+        if item['email'] not in first_at or item['created_at'] < first_at[item['email']]:
+            first_at[item['email']] = item['created_at']
+    return [{
+        "email_key": queue_email_key(q_email),
+        "my_count": q_count,
+        "ahead_count": sum(1 for item in rows if item['email'] != q_email and item['created_at'] < first_at[q_email]),
+        "total_count": len(rows)
+    } for q_email, q_count in counts.items()]
+
+def get_queue_stats(email):
+    """Trả về {'total', 'mine', 'others', 'ahead'} của user, hoặc None nếu không đọc được hàng chờ"""
+    try:
+        snapshot = get_queue_snapshot()
+    except Exception as e:
+        print(f"Lỗi đọc hàng chờ: {e}")
+        return None
+
+    total = snapshot[0]['total_count'] if snapshot else 0
+    mine, ahead = 0, 0
+    email_key = queue_email_key(email)
+    for item in snapshot:
+        if item['email_key'] == email_key:
+            mine, ahead = item['my_count'], item['ahead_count']
+            break
+    # Chưa có đơn nào trong hàng chờ -> đơn mới sẽ xếp sau toàn bộ hàng
+    if mine == 0:
+        ahead = total
+    return {"total": total, "mine": mine, "others": total - mine, "ahead": ahead}
+
+# --- [NEW] GỬI ĐƠN TRONG 1 LẦN GỌI (RPC submit_order, xem supabase_functions.sql) ---
+# Chống spam + giữ chỗ quota + insert đơn + vị trí hàng chờ chạy trong 1 giao dịch trên server,
+# thay cho 5 lệnh tuần tự (đọc quota, đọc đơn gần nhất, insert, đọc hàng chờ, trừ quota).
+def _submit_order_legacy(user, order_data, min_interval):
+    # Phòng hờ khi chưa tạo RPC: chạy lần lượt từng bước như trước
+    if min_interval and db_rate_limited(user['email'], min_interval):
+        return {"status": "rate_limited", "order_id": order_data['id'], "queue": None}
+
+    reserve = 1 if order_data.get('status') == "Pending" else 0
+    if reserve:
+        totals = reserve_quota(user['id'], videos=1)
+        apply_quota_totals(user, totals)
+        if not totals:
+            raise Exception("Không kiểm tra được Quota, vui lòng thử lại!")
+        if not totals['ok']:
+            return {"status": "no_quota", "order_id": order_data['id'], "queue": None}
+
+    try:
+        try:
+            supabase.table('orders').insert(order_data).execute()
+        except Exception as e:
+            # Nếu lỗi 500, chờ 1 giây rồi thử lại 1 lần nữa (Cơ chế Retry)
+            if "500" not in str(e):
+                raise
+            time.sleep(1)
+            supabase.table('orders').insert(order_data).execute()
+    except Exception:
+        if reserve: # Không lưu được đơn -> trả lại lượt đã giữ
+            release_quota(user, videos=1)
+        raise
+
+    get_queue_snapshot.clear()
+    return {"status": "ok", "order_id": order_data['id'], "queue": get_queue_stats(user['email'])}
+
+def submit_order(user, order_data, min_interval=ORDER_RATE_LIMIT_SECONDS):
+    """Gửi 1 đơn vào bảng orders. Đơn 'Pending' được trừ 1 lượt video (hết lượt thì không tạo đơn).
+    Trả về {'status': 'ok' | 'rate_limited' | 'no_quota', 'order_id', 'queue': {'total', 'mine', 'others', 'ahead'}};
+    lỗi DB thì raise. Số liệu quota mới nhất được chép vào `user`."""
+    params = {"p_user_id": user['id'], "p_order": order_data, "p_min_interval_seconds": int(min_interval or 0)}
+    for attempt in range(2):
+        try:
+            res = supabase.rpc('submit_order', params).execute()
+            break
+        except Exception as e:
+            if rpc_missing(e):
+                print(f"Chưa có RPC submit_order, gửi đơn theo cách cũ: {e}")
+                return _submit_order_legacy(user, order_data, min_interval)
+            # Lỗi 500: thử lại 1 lần (RPC nhận ra đơn đã ghi theo id nên không tạo / trừ quota 2 lần)
+            if "500" not in str(e) or attempt:
+                raise
+            time.sleep(1)
+
+    if not res.data:
+        raise Exception("submit_order không trả về kết quả")
+    row = res.data[0]
+    apply_quota_totals(user, row)
+    if row['result'] != "ok":
+        return {"status": row['result'], "order_id": row['order_id'], "queue": None}
+
+    get_queue_snapshot.clear() # Vừa thêm đơn nên bỏ bản chụp hàng chờ cũ
+    mine, total = row['my_count'], row['total_count']
+    return {
+        "status": "ok",
+        "order_id": row['order_id'],
+        "queue": {"total": total, "mine": mine, "others": total - mine, "ahead": row['ahead_count'] if mine else total}
+    }
+
+# --- [NEW] ƯỚC LƯỢNG THỜI GIAN CHỜ TỪ DỮ LIỆU THỰC TẾ ---
+# RPC get_processing_stats tính trung vị thời gian xử lý của các đơn/yêu cầu TTS gần đây
+# (theo video_mode / giọng đọc và độ dài kịch bản). Bảng số liệu được tính lại mỗi 15 phút.
+ETA_REFRESH_SECONDS = 900
+ETA_MIN_SAMPLES = 5 # Nhóm nào ít mẫu quá thì bỏ qua, dùng nhóm tổng quát hơn
+DEFAULT_VIDEO_SECONDS = 300 # 5 phút/video như cách tính cũ
+DEFAULT_TTS_CHARS_PER_SECOND = 15
+
+def script_length_bucket(n_chars):
+    # Phải khớp với ngưỡng trong get_processing_stats (supabase_functions.sql)
+    if n_chars < 600: return "short"
+    if n_chars < 1500: return "medium"
+    return "long"
+
+@st.cache_data(ttl=ETA_REFRESH_SECONDS, show_spinner=False)
+def load_eta_model():
+    model = {"video": {}, "tts": {}}
+    try:
+        res = supabase.rpc('get_processing_stats').execute()
+        for item in res.data or []:
+            if (item.get('samples') or 0) < ETA_MIN_SAMPLES or item.get('kind') not in model:
+                continue
+            # Dòng tổng hợp (grouping sets) có giá trị NULL -> đánh dấu '*'
+            key = (item.get('group_key') or "*", item.get('len_bucket') or "*")
+            model[item['kind']][key] = item
+    except Exception as e:
+        print(f"Lỗi tải số liệu ETA, dùng giá trị mặc định: {e}")
+    return model
+
+def _lookup_eta_stat(kind, group_key, n_chars):
+    stats = load_eta_model()[kind]
+    bucket = script_length_bucket(n_chars) if n_chars else "*"
+    for key in [(group_key or "*", bucket), (group_key or "*", "*"), ("*", bucket), ("*", "*")]:
+        if key in stats:
+            return stats[key]
+    return None
+
+def estimate_video_seconds(video_mode=None, n_chars=None):
+    stat = _lookup_eta_stat("video", video_mode, n_chars)
+    if stat and stat.get('avg_seconds'):
+        return float(stat['avg_seconds'])
+    return DEFAULT_VIDEO_SECONDS
+
+def estimate_queue_wait_minutes(ahead_count, my_count, video_mode=None, n_chars=None):
+    """Số phút chờ = đơn người khác xếp trước (thời gian trung bình chung) + đơn của mình (theo kiểu video & độ dài)"""
+    total_seconds = ahead_count * estimate_video_seconds() + my_count * estimate_video_seconds(video_mode, n_chars)
+    return max(1, int(round(total_seconds / 60)))
+
+def estimate_tts_seconds(text, voice_name=None):
+    n_chars = len(text or "")
+    stat = _lookup_eta_stat("tts", voice_name, n_chars)
+    if stat and stat.get('seconds_per_char'):
+        return n_chars * float(stat['seconds_per_char'])
+    return n_chars / DEFAULT_TTS_CHARS_PER_SECOND
+
 def update_user_usage(user_row, current_used):
     try:
-        gc = get_gspread_client()
-        ws = gc.open(DB_SHEET_NAME).worksheet("users")
-        ws.update_cell(user_row, 5, current_used + 1)
+        get_sheets().run(lambda sheets: sheets.worksheet("users", name=DB_SHEET_NAME).update_cell(user_row, 5, current_used + 1), idempotent=True)
     except: pass
 
 def log_history(order_id, email, link, date):
-    try:
-        gc = get_gspread_client()
-        ws = gc.open(DB_SHEET_NAME).worksheet("history")
-        ws.append_row([order_id, email, link, date])
-    except: pass
+    get_write_behind().append_sheet_row(DB_SHEET_NAME, "history", [order_id, email, link, date])
 
 # --- CẤU HÌNH & SETUP ---
 st.set_page_config(page_title="hạt bụi nhỏ - làm video", page_icon="📻", layout="centered")
@@ -646,36 +1499,127 @@ def get_app_style():
     """
 
 
-# --- [UPDATED] HÀM KIỂM TRA LINK (MẠNH HƠN) ---
-@st.cache_data(ttl=86400) # Lưu kết quả kiểm tra trong 24 giờ
+# --- [NÂNG CẤP] KIỂM TRA LINK AUDIO: SONG SONG, DÙNG LẠI KẾT NỐI, TRẢ KẾT QUẢ CŨ NGAY & KIỂM TRA LẠI Ở NỀN ---
+# Link sống được nhớ lâu, link chết nhớ ngắn (để file vừa được up lại sớm hiện ra), lỗi mạng chỉ nhớ 1 phút
+# (trước đây lỗi mạng bị nhớ là "có file" suốt 24 giờ). Quá hạn thì vẫn trả kết quả cũ ngay và kiểm tra lại ở luồng nền.
+LINK_OK_TTL = 6 * 3600
+LINK_BAD_TTL = 10 * 60
+LINK_ERROR_TTL = 60
+LINK_MAX_STALE = 24 * 3600 # Cũ hơn mức này thì không dùng nữa, phải kiểm tra lại ngay
+LINK_CHECK_TIMEOUT = 5
+LINK_CHECK_WORKERS = 8
+LINK_CACHE_MAX = 5000 # Số link nhớ tối đa (bỏ link kiểm tra lâu nhất trước)
+LINK_CHECK_HEADERS = {
+    # Giả danh trình duyệt thật (User-Agent) để không bị chặn
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+class LinkHealthChecker:
+    def __init__(self, http):
+        self.lock = threading.Lock()
+        from collections import OrderedDict
+        self.results = OrderedDict() # url -> {"ok": True/False/None (lỗi mạng), "checked_at": ...}, cũ nhất đứng đầu
+        self.inflight = {} # url -> Future đang kiểm tra
+        self.pool = ThreadPoolExecutor(max_workers=LINK_CHECK_WORKERS, thread_name_prefix="link-health")
+        self.http = http
+
+    def _probe(self, url):
+        """True: có file, False: không có, None: lỗi mạng (không kết luận được)"""
+        try:
+            # allow_redirects=True: Rất quan trọng với link HuggingFace/Drive
+            # Kiểm tra sức khỏe link thì không thử lại: lỗi mạng được nhớ ngắn và kiểm tra lại sau
+            response = self.http.head(url, headers=LINK_CHECK_HEADERS, allow_redirects=True, timeout=LINK_CHECK_TIMEOUT, retries=0)
+            # Nếu mã trả về là 200 (OK) hoặc 302 (Chuyển hướng thành công) thì là có file
+            if response.status_code in [200, 302]:
+                return True
+            # [PHÒNG HỜ] Nếu head thất bại, thử gọi get nhẹ 1 cái (stream=True để không tải hết file)
+            if response.status_code in [403, 405]:
+                with self.http.get(url, headers=LINK_CHECK_HEADERS, stream=True, timeout=LINK_CHECK_TIMEOUT, retries=0) as r2:
+                    return r2.status_code == 200
+            return False
+        except Exception as e:
+            print(f"Lỗi check link: {e}")
+            return None
+
+    def _run(self, url):
+        ok = self._probe(url)
+        now = time.time()
+        with self.lock:
+            self.results[url] = {"ok": ok, "checked_at": now}
+            self.results.move_to_end(url)
+            # Dọn đầu danh sách: link quá hạn dùng (LINK_MAX_STALE) hoặc vượt số lượng tối đa
+            while self.results:
+                oldest = next(iter(self.results.values()))
+                if len(self.results) <= LINK_CACHE_MAX and now - oldest['checked_at'] < LINK_MAX_STALE:
+                    break
+                self.results.popitem(last=False)
+            self.inflight.pop(url, None)
+        return ok
+
+    def _submit(self, url):
+        with self.lock:
+            future = self.inflight.get(url)
+            if future is None:
+                future = self.inflight[url] = self.pool.submit(self._run, url)
+        return future
+
+    def _cached(self, url):
+        """(kết quả, còn hạn?, còn dùng tạm được?)"""
+        with self.lock:
+            entry = self.results.get(url)
+        if entry is None:
+            return None, False, False
+        age = time.time() - entry['checked_at']
+        ttl = LINK_OK_TTL if entry['ok'] else (LINK_BAD_TTL if entry['ok'] is False else LINK_ERROR_TTL)
+        return entry['ok'], age < ttl, age < LINK_MAX_STALE
+
+    def check(self, url, wait=True):
+        ok, fresh, usable = self._cached(url)
+        if fresh:
+            return ok
+        if usable:
+            self._submit(url) # Trả kết quả cũ ngay, kiểm tra lại ở nền
+            return ok
+        future = self._submit(url)
+        if not wait:
+            return None
+        try:
+            return future.result(timeout=LINK_CHECK_TIMEOUT * 2 + 1)
+        except Exception:
+            return None
+
+    def check_many(self, urls, wait=True):
+        """Kiểm tra nhiều link cùng lúc. wait=False: chỉ khởi động kiểm tra ở nền (làm nóng cache)"""
+        urls = [u for u in dict.fromkeys(urls) if u and str(u).startswith("http")]
+        pending = {}
+        results = {}
+        for url in urls:
+            ok, fresh, usable = self._cached(url)
+            if fresh or usable:
+                results[url] = ok
+                if not fresh:
+                    self._submit(url)
+            else:
+                pending[url] = self._submit(url)
+        if not wait:
+            return results
+        deadline = time.time() + LINK_CHECK_TIMEOUT * 2 + 1
+        for url, future in pending.items():
+            try:
+                results[url] = future.result(timeout=max(0.0, deadline - time.time()))
+            except Exception:
+                results[url] = None
+        return results
+
+@st.cache_resource
+def get_link_health():
+    return LinkHealthChecker(get_http_client())
+
 def check_link_exists(url):
     if not url: return False
-    try:
-        # 1. Giả danh trình duyệt thật (User-Agent) để không bị chặn
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        # 2. Tăng thời gian chờ lên 5 giây (phòng khi mạng chậm)
-        # 3. allow_redirects=True: Rất quan trọng với link HuggingFace/Drive
-        response = requests.head(url, headers=headers, allow_redirects=True, timeout=5)
-        
-        # Nếu mã trả về là 200 (OK) hoặc 302 (Chuyển hướng thành công) thì là có file
-        if response.status_code in [200, 302]:
-            return True
-            
-        # [PHÒNG HỜ] Nếu head thất bại, thử gọi get nhẹ 1 cái (stream=True để không tải hết file)
-        if response.status_code in [403, 405]:
-            r2 = requests.get(url, headers=headers, stream=True, timeout=5)
-            r2.close() # Đóng kết nối ngay
-            return r2.status_code == 200
-            
-        return False
-    except Exception as e:
-        print(f"Lỗi check link: {e}")
-        # [QUAN TRỌNG] Nếu lỗi mạng (không kết nối được), 
-        # TẠM THỜI TRẢ VỀ TRUE để thà hiện player còn hơn là mất tính năng
-        return True
+    ok = get_link_health().check(url)
+    # [QUAN TRỌNG] Nếu lỗi mạng (không kết nối được), TRẢ VỀ TRUE để thà hiện player còn hơn là mất tính năng
+    return ok is not False
 
 # Inject CSS ngay lập tức (Không cần tham số nữa)
 st.markdown(get_app_style(), unsafe_allow_html=True)
@@ -696,14 +1640,244 @@ def get_creds():
         return ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
     return ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
 
-def get_gspread_client(): return gspread.authorize(get_creds())
+def sheets_error_retryable(error):
+    """Lỗi chắc chắn xảy ra TRƯỚC khi Google nhận lệnh: token hết hạn / làm mới token lỗi, không kết nối được"""
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(getattr(error, "response", None), "status_code", None) == 401
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    return type(error).__name__ in ("HttpAccessTokenRefreshError", "AccessTokenRefreshError", "RefreshError")
+
+# Mã lỗi Postgres/PostgREST kiểu "tạm thời" (mất kết nối DB, deadlock, quá tải, hết thời gian câu lệnh);
+# bản postgrest-py không đọc được JSON lỗi thì để mã HTTP trong code (vd. "503")
+DB_RETRY_CODE_PREFIXES = ("08", "40", "53", "57", "PGRST00")
+
+def db_error_retryable(error):
+    """Lỗi Supabase ghi lại được: không kết nối được (chưa gửi gì) hoặc lỗi tạm thời/5xx/429 (lệnh đã bị từ chối cả lô).
+    Lỗi dữ liệu (vi phạm ràng buộc, sai kiểu, 4xx...) thì ghi lại bao nhiêu lần cũng vẫn lỗi"""
+    name = type(error).__name__
+    if name in ("ConnectError", "ConnectTimeout"):
+        return True
+    if name != "APIError":
+        return False
+    code = str(getattr(error, "code", "") or "")
+    if code.isdigit():
+        return int(code) in HTTP_RETRY_STATUSES
+    return code.startswith(DB_RETRY_CODE_PREFIXES)
+
+# [NÂNG CẤP] 1 client Google Sheets dùng chung cả server: chỉ xác thực 1 lần, token hết hạn mới làm mới,
+# các spreadsheet/worksheet đã mở được nhớ lại (mở theo TÊN file phải tìm qua Drive, rất tốn).
+class SheetsClient:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._gc = None
+        self._spreadsheets = {} # ("key"|"name", giá trị) -> Spreadsheet
+        self._worksheets = {} # (khóa spreadsheet, tên tab) -> Worksheet
+
+    def client(self):
+        with self.lock:
+            if self._gc is None:
+                self._gc = gspread.authorize(get_creds())
+            else:
+                # Bản gspread dùng oauth2client không tự làm mới token; bản mới (google-auth) tự làm khi gửi request
+                auth = getattr(self._gc, "auth", None)
+                if auth is not None and getattr(auth, "access_token_expired", False) and hasattr(self._gc, "login"):
+                    self._gc.login()
+            return self._gc
+
+    def spreadsheet(self, key=None, name=None):
+        cache_key = ("key", key) if key else ("name", name)
+        with self.lock:
+            sh = self._spreadsheets.get(cache_key)
+            if sh is None:
+                gc = self.client()
+                sh = gc.open_by_key(key) if key else gc.open(name)
+                self._spreadsheets[cache_key] = sh
+            return sh
+
+    def worksheet(self, title, key=None, name=None):
+        cache_key = (("key", key) if key else ("name", name), title)
+        with self.lock:
+            ws = self._worksheets.get(cache_key)
+            if ws is None:
+                ws = self.spreadsheet(key, name).worksheet(title)
+                self._worksheets[cache_key] = ws
+            return ws
+
+    def reset(self):
+        """Quên hết handle đã nhớ (gọi khi thao tác lỗi: file bị đổi tên/xóa tab, mất quyền...)"""
+        with self.lock:
+            self._gc = None
+            self._spreadsheets.clear()
+            self._worksheets.clear()
+
+    def run(self, action, idempotent=False):
+        """Chạy action(self); lỗi thì quên handle cũ và thử lại 1 lần với handle mới.
+        Lệnh ghi thêm (append_row/append_rows) chỉ thử lại khi chắc Google CHƯA nhận lệnh (sheets_error_retryable),
+        vì lỗi kiểu hết thời gian chờ có thể đến sau khi dòng đã được ghi -> thử lại là ghi trùng.
+        idempotent=True (đọc, ghi đè 1 ô...): thử lại với mọi lỗi"""
+        try:
+            return action(self)
+        except Exception as e:
+            self.reset()
+            if not idempotent and not sheets_error_retryable(e):
+                raise
+            print(f"Lỗi Google Sheets, mở lại kết nối: {e}")
+            return action(self)
+
+@st.cache_resource
+def get_sheets():
+    return SheetsClient()
+
+def get_gspread_client(): return get_sheets().client()
+
+# --- [NEW] HÀNG ĐỢI GHI NỀN CHO CÁC LOG KHÔNG QUAN TRỌNG (lịch sử Sheet, tts_logs, admin_logs...) ---
+# User không phải chờ Google Sheets / Supabase: dòng log được đẩy vào hàng đợi, 1 luồng nền gom lại và ghi theo lô
+# (Sheets: append_rows 1 lần / tab, Supabase: insert nhiều dòng / bảng) khi đủ WRITE_BEHIND_BATCH dòng
+# hoặc dòng cũ nhất đã chờ WRITE_BEHIND_FLUSH_SECONDS giây.
+# Hàng đợi có giới hạn: đầy thì chờ 1 chút, vẫn đầy thì ghi thẳng (chậm nhưng không mất), lỗi thì thử lại rồi mới báo lỗi.
+WRITE_BEHIND_MAX_PENDING = 2000
+WRITE_BEHIND_BATCH = 100
+WRITE_BEHIND_FLUSH_SECONDS = 5.0
+WRITE_BEHIND_PUT_TIMEOUT = 2.0
+WRITE_BEHIND_MAX_ATTEMPTS = 3
+
+class WriteBehindQueue:
+    def __init__(self, sheets, db):
+        self.sheets = sheets
+        self.db = db
+        self.queue = queue.Queue(maxsize=WRITE_BEHIND_MAX_PENDING)
+        self.lock = threading.Lock()
+        self.stats = {"queued": 0, "flushed": 0, "failed": 0, "retried": 0, "direct": 0, "batches": 0}
+        self.last_error = None
+        self._stopping = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data["last_error"] = self.last_error
+        data["pending"] = self.queue.qsize()
+        return data
+
+    # --- PHÍA USER: chỉ đẩy vào hàng đợi ---
+    def append_sheet_row(self, sheet_name, tab, row):
+        return self._enqueue(("sheet", sheet_name, tab), list(row))
+
+    def insert_row(self, table, row):
+        return self._enqueue(("table", table), dict(row))
+
+    def _enqueue(self, target, row):
+        item = (target, row, 1)
+        try:
+            self.queue.put(item, timeout=WRITE_BEHIND_PUT_TIMEOUT)
+            self._count("queued")
+            return True
+        except queue.Full:
+            pass
+        # Hàng đợi đầy (luồng nền tắc / đích ghi đang lỗi): ghi thẳng trong lượt này thay vì bỏ dòng log
+        print(f"Hàng đợi ghi nền đầy ({WRITE_BEHIND_MAX_PENDING}), ghi trực tiếp vào {target}")
+        self._count("direct")
+        return self._write_group(target, [item])
+
+    # --- PHÍA LUỒNG NỀN ---
+    def _write(self, target, rows):
+        if target[0] == "sheet":
+            _, sheet_name, tab = target
+            self.sheets.run(lambda sheets: sheets.worksheet(tab, name=sheet_name).append_rows(rows))
+        else:
+            self.db.table(target[1]).insert(rows).execute()
+
+    @staticmethod
+    def _retryable(target, error):
+        # Chỉ ghi lại khi chắc lô trước CHƯA được ghi (lỗi kiểu hết thời gian chờ có thể đến sau khi đã ghi -> ghi trùng)
+        if target[0] == "sheet":
+            return sheets_error_retryable(error)
+        return db_error_retryable(error)
+
+    def _write_rows_one_by_one(self, target, items):
+        # Supabase từ chối cả lô vì dữ liệu (APIError 4xx) -> lô chưa ghi dòng nào: ghi lẻ từng dòng
+        # để chỉ (các) dòng hỏng bị bỏ, các dòng hợp lệ vẫn được ghi
+        print(f"Tách lô ghi nền {target} ({len(items)} dòng) để ghi từng dòng")
+        ok = True
+        for item in items:
+            ok = self._write_group(target, [item]) and ok
+        return ok
+
+    def _write_group(self, target, items):
+        try:
+            self._write(target, [row for _, row, _ in items])
+            self._count("flushed", len(items))
+            self._count("batches")
+            return True
+        except Exception as e:
+            with self.lock:
+                self.last_error = f"{datetime.now().strftime('%H:%M:%S')} {target}: {e}"
+            print(f"Lỗi ghi nền {target} ({len(items)} dòng): {e}")
+            retryable = self._retryable(target, e)
+            if not retryable and len(items) > 1 and target[0] == "table" and type(e).__name__ == "APIError":
+                return self._write_rows_one_by_one(target, items)
+
+        retry = [(t, row, attempt + 1) for t, row, attempt in items if retryable and attempt < WRITE_BEHIND_MAX_ATTEMPTS]
+        gave_up = [row for _, row, attempt in items if not retryable or attempt >= WRITE_BEHIND_MAX_ATTEMPTS]
+        for n, item in enumerate(retry):
+            try:
+                self.queue.put_nowait(item)
+                self._count("retried")
+            except queue.Full:
+                gave_up.extend(row for _, row, _ in retry[n:])
+                break
+        if gave_up:
+            self._count("failed", len(gave_up))
+            # In ra nội dung để còn chép tay lại được, không âm thầm mất
+            print(f"Bỏ {len(gave_up)} dòng ghi nền vào {target} (dữ liệu bị từ chối, có thể đã ghi, hoặc đã lỗi {WRITE_BEHIND_MAX_ATTEMPTS} lần): {gave_up}")
+        return False
+
+    def _flush(self, items):
+        groups = {}
+        for item in items:
+            groups.setdefault(item[0], []).append(item)
+        for target, group in groups.items():
+            self._write_group(target, group)
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            batch = [first]
+            deadline = time.time() + (0 if self._stopping.is_set() else WRITE_BEHIND_FLUSH_SECONDS)
+            while len(batch) < WRITE_BEHIND_BATCH:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+            if any(attempt > 1 for _, _, attempt in batch) and not self._stopping.is_set():
+                time.sleep(1.0) # Vừa có lô lỗi -> nghỉ 1 chút trước khi thử lại
+
+    def close(self, timeout=10.0):
+        """Tắt server: ghi nốt phần còn trong hàng đợi"""
+        self._stopping.set()
+        self._worker.join(timeout)
+
+@st.cache_resource
+def get_write_behind():
+    return WriteBehindQueue(get_sheets(), supabase)
 
 @st.cache_data(ttl=3600)
 def get_library_structure():
     try:
-        gc = get_gspread_client()
-        sh = gc.open_by_key(LIBRARY_SHEET_ID)
-        all_sheets = sh.worksheets()
+        all_sheets = get_sheets().run(lambda sheets: sheets.spreadsheet(key=LIBRARY_SHEET_ID).worksheets(), idempotent=True)
         WANTED_TABS = ["duoi_60s", "duoi_90s", "duoi_180s", "tren_180s"] 
         final_list = []
         for ws in all_sheets:
@@ -712,170 +1886,840 @@ def get_library_structure():
     except Exception as e: return [f"Lỗi: {str(e)}"]
 
 # --- ĐÃ SỬA ĐỂ HỖ TRỢ PHÂN QUYỀN STOCK ---
+# [NÂNG CẤP] Xem theo trang hoặc ngẫu nhiên, mỗi (danh mục, trang) / (danh mục, lượt ngẫu nhiên) có cache riêng
+LIBRARY_PAGE_SIZE = 50
+LIBRARY_RANDOM_SEEDS = 20 # Số "bộ ngẫu nhiên" khác nhau mỗi danh mục -> cache dùng chung được giữa các user
+
 @st.cache_data(ttl=600) # Chỉ giữ cache 10 phút để tiết kiệm RAM
-def get_scripts_from_supabase_by_category(category_name, limit=50):
+def get_scripts_from_supabase_by_category(category_name, limit=50, page=0):
+    """Trả về (các dòng của trang, còn trang sau hay không)"""
     try:
-        # Chỉ lấy 50 bản ghi thay vì 1000 để giảm tải RAM cho Streamlit
-        response = supabase.table('library').select("*").eq('category', category_name).limit(limit).execute()
-        return response.data
+        # Chỉ lấy 1 trang (lấy dư 1 dòng để biết còn trang sau) thay vì 1000 để giảm tải RAM cho Streamlit
+        start = page * limit
+        response = supabase.table('library').select("content, audio_url, category") \
+            .eq('category', category_name).order('id').range(start, start + limit).execute()
+        rows = response.data or []
+        return rows[:limit], len(rows) > limit
     except Exception as e:
         print(f"Lỗi load kịch bản: {e}")
-        return []
+        return [], False
+
+@st.cache_data(ttl=600)
+def get_random_scripts_by_category(category_name, seed, limit=50):
+    """Lấy ngẫu nhiên `limit` kịch bản của danh mục. Cùng seed -> cùng kết quả (để cache được)"""
+    try:
+        response = supabase.rpc('sample_library', {"p_category": category_name, "p_seed": str(seed), "p_limit": limit}).execute()
+        return response.data or []
+    except Exception as e:
+        # Phòng hờ khi chưa tạo RPC: lấy danh sách id (rất nhẹ), bốc ngẫu nhiên rồi tải nội dung các id đó
+        print(f"Lỗi RPC sample_library, bốc ngẫu nhiên tại app: {e}")
+        import random
+        try:
+            ids = [r['id'] for r in supabase.table('library').select("id").eq('category', category_name).execute().data or []]
+            picked = random.Random(f"{category_name}:{seed}").sample(ids, min(limit, len(ids)))
+            if not picked:
+                return []
+            return supabase.table('library').select("content, audio_url, category").in_('id', picked).execute().data or []
+        except Exception as e2:
+            print(f"Lỗi load kịch bản ngẫu nhiên: {e2}")
+            return []
 
 # [NEW] TÌM KIẾM TRONG DATABASE (Nhanh hơn Sheet rất nhiều)
+# [NÂNG CẤP] Dùng RPC search_library: chỉ mục toàn văn (GIN) trên nội dung đã bỏ dấu,
+# nên gõ "nhan qua" vẫn ra "nhân quả", có xếp hạng độ liên quan và trích đoạn chứa từ khóa.
+SEARCH_RESULT_LIMIT = 20
+
 def search_global_library(keyword):
     try:
         keyword = keyword.strip()
         if not keyword: return []
-        
-        # TỐI ƯU: Chỉ lấy các cột cần thiết để nhẹ dung lượng truyền tải
-        # Sử dụng .or_ để tìm cả trong nội dung và danh mục
-        response = supabase.table('library') \
-            .select("content, audio_url, category") \
-            .ilike('content', f'%{keyword}%') \
-            .limit(20) \
-            .execute()
+
+        # Ưu tiên chỉ mục trong RAM (không tốn lượt gọi mạng), chưa nạp xong thì hỏi Supabase
+        index = ensure_library_index()
+        if index:
+            return [{
+                "content": item['content'],
+                "audio": item['audio_url'],
+                "source_sheet": item['category'],
+                "snippet": item['snippet']
+            } for item in index.search(keyword, SEARCH_RESULT_LIMIT)]
+
+        try:
+            response = supabase.rpc('search_library', {"p_query": keyword, "p_limit": SEARCH_RESULT_LIMIT}).execute()
+        except Exception as e:
+            # Phòng hờ khi chưa tạo RPC trên Supabase: quay về cách tìm cũ (không dùng được index, phân biệt dấu)
+            print(f"Lỗi RPC search_library, dùng ilike: {e}")
+            response = supabase.table('library') \
+                .select("content, audio_url, category") \
+                .ilike('content', f'%{keyword}%') \
+                .limit(SEARCH_RESULT_LIMIT) \
+                .execute()
         
         results = []
         for item in response.data:
             results.append({
                 "content": item['content'],
                 "audio": item['audio_url'],
-                "source_sheet": item['category']
+                "source_sheet": item['category'],
+                "snippet": item.get('snippet')
             })
         return results
     except Exception as e:
         st.error(f"Lỗi tìm kiếm: {e}")
         return []
 
+# --- [NEW] CHỈ MỤC THƯ VIỆN TRONG BỘ NHỚ (DÙNG CHUNG MỌI PHIÊN CỦA SERVER) ---
+# Thư viện chỉ đổi khi admin bấm đồng bộ, nên cả server giữ 1 bản trong RAM:
+# danh sách theo danh mục + chỉ mục từ khóa (đã bỏ dấu) -> duyệt & tìm không phải gọi Supabase.
+# Bản chụp được lưu ra file để server khởi động lại chỉ cần tải phần kịch bản mới (id lớn hơn).
+LIBRARY_SNAPSHOT_PATH = os.path.join(".cache", "library_index.json.gz")
+LIBRARY_REFRESH_SECONDS = 600 # Định kỳ hỏi xem có kịch bản mới (thường là 0 dòng, rất nhẹ)
+LIBRARY_REBUILD_SECONDS = 6 * 3600 # Định kỳ tải lại cả bảng để thấy cả dòng bị sửa/xóa (làm mới thường chỉ thấy dòng mới)
+LIBRARY_FETCH_PAGE = 1000
+LIBRARY_RESCORE_FACTOR = 5 # Tìm kiếm: chỉ bỏ dấu lại nội dung của (limit x hệ số này) bài điểm sơ bộ cao nhất
+_TOKEN_RE = re.compile(r"\w+")
+
+class _FoldTable(dict):
+    """Bảng translate bỏ dấu + chữ thường. Mỗi ký tự -> đúng 1 ký tự nên vị trí trong chuỗi được giữ nguyên"""
+    def __missing__(self, codepoint):
+        ch = chr(codepoint)
+        folded = 'd' if ch in 'đĐ' else unicodedata.normalize('NFD', ch)[0].lower()
+        if len(folded) != 1:
+            folded = ch
+        self[codepoint] = folded
+        return folded
+
+_FOLD_TABLE = _FoldTable()
+
+def fold_vietnamese(text):
+    return str(text or "").translate(_FOLD_TABLE)
+
+class LibraryIndex:
+    # Các trường dữ liệu được thay cùng lúc khi tải lại cả bảng (rebuild)
+    _DATA_FIELDS = ("ids", "contents", "audio_urls", "categories", "by_category", "postings", "term_counts", "pos_by_id", "max_id")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = []
+        self.contents = [] # Chỉ giữ bản gốc; bản bỏ dấu tính lại khi cần cho vài bài đứng đầu kết quả tìm
+        self.audio_urls = []
+        self.categories = [] # Tên danh mục đã intern -> mọi dòng cùng danh mục dùng chung 1 chuỗi
+        self.by_category = {} # danh mục -> array vị trí
+        self.postings = {} # từ (đã bỏ dấu) -> array vị trí, tăng dần
+        self.term_counts = {} # từ -> array số lần xuất hiện, cùng thứ tự với postings (chấm điểm sơ bộ)
+        self.pos_by_id = {}
+        self.max_id = None
+        self.ready = False
+        self.loading = False
+        self.last_refresh = 0.0
+        self.last_rebuild = 0.0
+
+    def add_rows(self, rows):
+        """Thêm/cập nhật các dòng của bảng library. Trả về số dòng mới"""
+        added = 0
+        with self.lock:
+            for item in rows:
+                row_id = item.get('id')
+                category = sys.intern(str(item.get('category') or ""))
+                if row_id in self.pos_by_id:
+                    # Dòng đã có (upsert) -> nội dung không đổi, chỉ cập nhật link/danh mục
+                    pos = self.pos_by_id[row_id]
+                    self.audio_urls[pos] = item.get('audio_url')
+                    continue
+
+                content = unicodedata.normalize('NFC', str(item.get('content') or ""))
+                pos = len(self.ids)
+                self.ids.append(row_id)
+                self.contents.append(content)
+                self.audio_urls.append(item.get('audio_url'))
+                self.categories.append(category)
+                self.by_category.setdefault(category, array('I')).append(pos)
+                for token, count in Counter(_TOKEN_RE.findall(fold_vietnamese(content))).items():
+                    postings = self.postings.get(token)
+                    if postings is None:
+                        token = sys.intern(token)
+                        postings = self.postings[token] = array('I')
+                        self.term_counts[token] = array('H')
+                    postings.append(pos)
+                    self.term_counts[token].append(min(count, 65535))
+                self.pos_by_id[row_id] = pos
+                if row_id is not None and (self.max_id is None or row_id > self.max_id):
+                    self.max_id = row_id
+                added += 1
+        return added
+
+    def _row(self, pos, snippet=None):
+        return {"content": self.contents[pos], "audio_url": self.audio_urls[pos], "category": self.categories[pos], "snippet": snippet}
+
+    def category_rows(self, category, limit=50, page=0):
+        with self.lock:
+            positions = self.by_category.get(category, [])
+            start = page * limit
+            return [self._row(pos) for pos in positions[start:start + limit]], len(positions) > start + limit
+
+    def sample_category(self, category, seed, limit=50):
+        import random
+        with self.lock:
+            positions = self.by_category.get(category, [])
+            picked = random.Random(f"{category}:{seed}").sample(range(len(positions)), min(limit, len(positions)))
+            return [self._row(positions[i]) for i in picked]
+
+    def search(self, keyword, limit=20):
+        tokens = _TOKEN_RE.findall(fold_vietnamese(keyword))
+        if not tokens:
+            return []
+        with self.lock:
+            # Giao các danh sách vị trí, bắt đầu từ từ hiếm nhất cho nhanh
+            terms = sorted(set(tokens), key=lambda t: len(self.postings.get(t, ())))
+            candidates = set(self.postings.get(terms[0], ()))
+            for term in terms[1:]:
+                candidates.intersection_update(self.postings.get(term, ()))
+                if not candidates:
+                    return []
+
+            # Điểm sơ bộ từ chỉ mục (tổng số lần xuất hiện các từ, không cần nội dung) -> chỉ giữ vài bài đứng đầu
+            def _term_count(term, pos):
+                postings = self.postings[term]
+                return self.term_counts[term][bisect.bisect_left(postings, pos)]
+            rough = sorted(candidates, key=lambda pos: (-sum(_term_count(t, pos) for t in tokens), len(self.contents[pos])))
+
+            phrase = " ".join(tokens)
+            scored = []
+            for pos in rough[:limit * LIBRARY_RESCORE_FACTOR]:
+                folded = fold_vietnamese(self.contents[pos])
+                # Điểm: có nguyên cụm từ được cộng nhiều, sau đó đến số lần xuất hiện các từ; bằng điểm thì ưu tiên bài ngắn
+                score = (10 if phrase in folded else 0) + sum(folded.count(t) for t in tokens)
+                scored.append((-score, len(folded), pos, folded))
+            scored.sort(key=lambda item: item[:3])
+
+            results = []
+            for _, _, pos, folded in scored[:limit]:
+                hit = folded.find(tokens[0])
+                start = max(0, hit - 30)
+                content = self.contents[pos]
+                snippet = ("..." if start > 0 else "") + content[start:start + 110] + ("..." if start + 110 < len(content) else "")
+                results.append(self._row(pos, snippet=snippet))
+            return results
+
+    def refresh(self):
+        """Chỉ tải các dòng có id lớn hơn id lớn nhất đang có"""
+        new_rows = []
+        while True:
+            query = supabase.table('library').select("id, content, audio_url, category")
+            if self.max_id is not None:
+                query = query.gt('id', self.max_id)
+            res = query.order('id').limit(LIBRARY_FETCH_PAGE).execute()
+            page = res.data or []
+            self.add_rows(page)
+            new_rows.extend(page)
+            if len(page) < LIBRARY_FETCH_PAGE:
+                break
+        self.last_refresh = time.time()
+        return len(new_rows)
+
+    def rebuild(self):
+        """Tải lại cả bảng vào 1 chỉ mục mới rồi thay 1 lần -> thấy được dòng bị sửa / xóa. Trả về số dòng"""
+        fresh = LibraryIndex()
+        fresh.refresh()
+        with self.lock:
+            for name in self._DATA_FIELDS:
+                setattr(self, name, getattr(fresh, name))
+            self.last_refresh = self.last_rebuild = time.time()
+            return len(self.ids)
+
+    def save_snapshot(self, path=LIBRARY_SNAPSHOT_PATH):
+        try:
+            with self.lock:
+                rows = [[self.ids[i], self.contents[i], self.audio_urls[i], self.categories[i]] for i in range(len(self.ids))]
+                rebuilt_at = self.last_rebuild
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                json.dump({"version": 1, "rebuilt_at": rebuilt_at, "rows": rows}, f, ensure_ascii=False)
+            os.replace(tmp_path, path) # Ghi xong mới thay file cũ -> không bao giờ đọc phải file dở dang
+        except Exception as e:
+            print(f"Lỗi lưu bản chụp thư viện: {e}")
 
-def upload_to_catbox(file_obj, custom_name=None):
-    # [NÂNG CẤP] Sử dụng hạ tầng CLOUDINARY (Siêu nhanh & Ổn định)
+    def load_snapshot(self, path=LIBRARY_SNAPSHOT_PATH):
+        try:
+            if not os.path.exists(path):
+                return 0
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+            self.last_rebuild = float(data.get("rebuilt_at") or 0.0)
+            return self.add_rows([{"id": r[0], "content": r[1], "audio_url": r[2], "category": r[3]} for r in data.get("rows", [])])
+        except Exception as e:
+            print(f"Lỗi đọc bản chụp thư viện, sẽ tải lại từ đầu: {e}")
+            return 0
+
+@st.cache_resource
+def get_library_index():
+    return LibraryIndex()
+
+def _warm_library_index(index):
+    try:
+        if not index.ready:
+            index.load_snapshot()
+        if time.time() - index.last_rebuild > LIBRARY_REBUILD_SECONDS:
+            index.rebuild()
+            index.save_snapshot()
+        elif index.refresh() > 0 or not os.path.exists(LIBRARY_SNAPSHOT_PATH):
+            index.save_snapshot()
+        index.ready = True
+    except Exception as e:
+        print(f"Lỗi nạp chỉ mục thư viện: {e}")
+    finally:
+        index.loading = False
+
+def ensure_library_index():
+    """Trả về chỉ mục nếu đã sẵn sàng, ngược lại trả về None (người gọi tự hỏi Supabase).
+    Việc nạp / làm mới chạy ở luồng nền nên không bắt user phải chờ."""
+    index = get_library_index()
+    with index.lock:
+        need_load = not index.loading and (not index.ready or time.time() - index.last_refresh > LIBRARY_REFRESH_SECONDS)
+        if need_load:
+            index.loading = True
+    if need_load:
+        threading.Thread(target=_warm_library_index, args=(index,), daemon=True).start()
+    return index if index.ready else None
+
+def browse_library_category(category_name, page=0, seed=None, limit=LIBRARY_PAGE_SIZE):
+    """Xem danh mục theo trang (seed=None) hoặc ngẫu nhiên theo seed. Trả về (các dòng, còn trang sau hay không)"""
+    index = ensure_library_index()
+    if seed is not None:
+        rows = index.sample_category(category_name, seed, limit) if index else get_random_scripts_by_category(category_name, seed, limit)
+        return rows, False
+    if index:
+        return index.category_rows(category_name, limit, page)
+    return get_scripts_from_supabase_by_category(category_name, limit, page)
+
+def load_library_browse(category_name, page=0, seed=None):
+    """Nạp 1 trang (hoặc 1 lượt ngẫu nhiên) của danh mục vào session làm kết quả để chọn"""
+    raw_results, has_more = browse_library_category(category_name, page, seed)
+    # Đồng bộ cấu trúc dữ liệu để code bên dưới không bị lỗi khi bấm chọn
+    st.session_state['search_results'] = [{
+        "content": item['content'],
+        "audio": item['audio_url'],
+        "source_sheet": item['category']
+    } for item in raw_results]
+    st.session_state['has_searched'] = True
+    st.session_state['library_browse'] = {"category": category_name, "page": page, "seed": seed, "has_more": has_more}
+    if 'last_picked_idx' in st.session_state:
+        del st.session_state['last_picked_idx']
+
+
+# --- [NEW] CHUẨN HÓA AUDIO TRƯỚC KHI TẢI LÊN (1 ĐỊNH DẠNG GỌN CHO MỌI NGUỒN) ---
+# File thu âm (WAV tới 20MB) và file upload (m4a/ogg/aac...) được chuyển về MP3 mono bằng ffmpeg trên server:
+# tải lên ít byte hơn, Cloudinary lưu ít hơn, máy dựng video chỉ phải giải mã 1 định dạng.
+# Server không có ffmpeg (hoặc chuyển lỗi) thì gửi nguyên file như cũ.
+AUDIO_INGEST_CODEC = "mp3"
+AUDIO_INGEST_SAMPLE_RATE = 24000
+AUDIO_INGEST_BITRATE = "64k"
+AUDIO_INGEST_TIMEOUT = 120 # Giây
+_FFMPEG_DURATION_RE = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+def _wav_duration(data):
     import io
-    
+    import wave
+    try:
+        # Chỉ cần phần đầu file: wave đọc kích thước khối data từ header, không đọc dữ liệu
+        with wave.open(io.BytesIO(data[:65536]), 'rb') as reader:
+            return round(reader.getnframes() / float(reader.getframerate()), 2)
+    except Exception:
+        return None
+
+def prepare_audio_for_upload(file_obj, file_name=None):
+    """Trả về (file-like để upload, thông tin audio để ghi vào settings của đơn).
+    Không gọi st.* -> dùng được cả trong luồng nền"""
+    import io
+    import shutil
+    import subprocess
+    import tempfile
+
+    data = _upload_view(file_obj) # Đọc thẳng bộ đệm, không sao chép file
+    name = file_name or getattr(file_obj, "name", None) or "audio.wav"
+    src_ext = name.rsplit(".", 1)[-1].lower() if "." in name else "wav"
+    info = {"audio_codec": src_ext, "audio_duration": _wav_duration(data) if src_ext == "wav" else None,
+            "audio_bytes_original": len(data), "audio_bytes": len(data), "audio_transcoded": False}
+
+    def _passthrough():
+        # Gửi nguyên file: dùng luôn đối tượng gốc (bytes bọc BytesIO cũng không sao chép)
+        payload = io.BytesIO(file_obj) if isinstance(file_obj, (bytes, bytearray)) else file_obj
+        if isinstance(file_obj, (bytes, bytearray)):
+            payload.name = f"audio.{src_ext}"
+        return payload, info
+
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        data.release()
+        return _passthrough()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            src_path = os.path.join(tmp_dir, f"in.{src_ext}")
+            dst_path = os.path.join(tmp_dir, f"out.{AUDIO_INGEST_CODEC}")
+            with open(src_path, "wb") as f:
+                f.write(data)
+            data.release()
+            # File tạm thay vì pipe: m4a có phần mô tả (moov) ở cuối file, ffmpeg cần tua được
+            proc = subprocess.run(
+                [ffmpeg, "-hide_banner", "-nostdin", "-y", "-i", src_path, "-vn", "-ac", "1",
+                 "-ar", str(AUDIO_INGEST_SAMPLE_RATE), "-b:a", AUDIO_INGEST_BITRATE, dst_path],
+                capture_output=True, timeout=AUDIO_INGEST_TIMEOUT
+            )
+            if proc.returncode != 0 or not os.path.exists(dst_path):
+                raise RuntimeError(proc.stderr.decode("utf-8", "ignore")[-300:])
+            with open(dst_path, "rb") as f:
+                out_data = f.read()
+
+        match = _FFMPEG_DURATION_RE.search(proc.stderr.decode("utf-8", "ignore"))
+        if match:
+            h, m, sec = match.groups()
+            info["audio_duration"] = round(int(h) * 3600 + int(m) * 60 + float(sec), 2)
+        info.update({"audio_codec": AUDIO_INGEST_CODEC, "audio_bytes": len(out_data), "audio_transcoded": True,
+                     "audio_sample_rate": AUDIO_INGEST_SAMPLE_RATE, "audio_channels": 1})
+        payload = io.BytesIO(out_data)
+        payload.name = f"audio.{AUDIO_INGEST_CODEC}"
+        return payload, info
+    except Exception as e:
+        print(f"Lỗi chuyển định dạng audio, gửi nguyên file: {e}")
+        data.release()
+        return _passthrough()
+
+
+# --- [NÂNG CẤP] TẢI LÊN CLOUDINARY THEO TỪNG KHÚC, TỰ THỬ LẠI & TẢI TIẾP ---
+# Mọi file đều gửi theo khúc (X-Unique-Upload-Id + Content-Range, khúc >= 5MB theo yêu cầu Cloudinary), file nhỏ là 1 khúc duy nhất.
+# Khúc lỗi mạng/5xx được thử lại với thời gian chờ tăng dần; hết lượt thử thì nhớ vị trí đã gửi
+# để lần bấm gửi sau (cùng file) tải tiếp từ đó thay vì gửi lại từ đầu.
+CLOUDINARY_CHUNK_BYTES = 6 * 1024 * 1024
+CLOUDINARY_MAX_RETRIES = 4
+CLOUDINARY_TIMEOUT = 60
+
+def _cloudinary_config():
     # --- CẤU HÌNH TỪ SECRETS (BẢO MẬT) ---
     if "cloudinary" in st.secrets:
-        CLOUD_NAME = st.secrets["cloudinary"]["cloud_name"]
-        UPLOAD_PRESET = st.secrets["cloudinary"]["upload_preset"]
-    else:
-        # Giá trị mặc định nếu chưa cấu hình secrets
-        CLOUD_NAME = "nothing" 
-        UPLOAD_PRESET = "nothing"
-    # ----------------------------------------
+        return st.secrets["cloudinary"]["cloud_name"], st.secrets["cloudinary"]["upload_preset"]
+    # Giá trị mặc định nếu chưa cấu hình secrets
+    return "nothing", "nothing"
 
-    try:
-        # API của Cloudinary
-        url = f"https://api.cloudinary.com/v1_1/{CLOUD_NAME}/video/upload"
-        
-        # 1. Xử lý file (Tương tự logic cũ)
-        import uuid
-        # Luôn tạo tên mới ngẫu nhiên để tránh lỗi bảo mật tên file
-        ext = "wav"
-        if hasattr(file_obj, "name") and "." in file_obj.name:
-            ext = file_obj.name.split(".")[-1]
-        
-        filename = f"{uuid.uuid4()}.{ext}"
-            
-        if isinstance(file_obj, bytes):
-            file_stream = io.BytesIO(file_obj)
+@st.cache_resource
+def _upload_resume_state():
+    """resume_key -> {upload_id, offset, total}: các lần tải dở dang (dùng chung trong server)"""
+    return {"lock": threading.Lock(), "uploads": {}}
+
+def _upload_view(file_obj):
+    """memoryview trỏ thẳng vào dữ liệu (bytes / BytesIO / UploadedFile). Chỉ dùng cho file user gửi (cần cả file cho ffmpeg);
+    file lớn tự tạo (file TTS ghép) thì đọc từng khúc qua _UploadSource"""
+    if isinstance(file_obj, (bytes, bytearray, memoryview)):
+        return memoryview(file_obj)
+    if hasattr(file_obj, "getbuffer"):
+        return file_obj.getbuffer()
+    file_obj.seek(0)
+    return memoryview(file_obj.read())
+
+class _UploadSource:
+    """Đọc từng khúc [offset, end) để gửi. bytes / BytesIO / UploadedFile: cắt thẳng trên bộ đệm (memoryview);
+    file khác (vd. SpooledTemporaryFile của file TTS ghép): seek + read đúng 1 khúc -> không nạp cả file vào RAM"""
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.view = None
+        if isinstance(file_obj, (bytes, bytearray, memoryview)):
+            self.view = memoryview(file_obj)
+        elif hasattr(file_obj, "getbuffer"):
+            self.view = file_obj.getbuffer()
+        if self.view is not None:
+            self.total = self.view.nbytes
         else:
-            file_stream = file_obj
+            file_obj.seek(0, os.SEEK_END)
+            self.total = file_obj.tell()
+
+    def read(self, offset, end):
+        if self.view is not None:
+            return self.view[offset:end].tobytes()
+        self.file_obj.seek(offset)
+        return self.file_obj.read(end - offset)
+
+    def release(self):
+        if self.view is not None:
+            self.view.release()
+
+def cloudinary_upload(file_obj, on_progress=None, resume_key=None):
+    """Tải lên Cloudinary, KHÔNG gọi st.* (chạy được trong luồng nền).
+    on_progress(đã_gửi, tổng) được gọi sau mỗi khúc. Trả về (secure_url, None) hoặc (None, thông báo lỗi)"""
+    cloud_name, upload_preset = _cloudinary_config()
+    # API của Cloudinary. Lưu ý: resource_type='video' dùng chung cho cả Audio và Video
+    url = f"https://api.cloudinary.com/v1_1/{cloud_name}/video/upload"
+
+    # Luôn tạo tên mới ngẫu nhiên để tránh lỗi bảo mật tên file
+    ext = "wav"
+    file_label = getattr(file_obj, "name", None)
+    if isinstance(file_label, str) and "." in file_label:
+        ext = file_label.split(".")[-1]
+    filename = f"{uuid.uuid4()}.{ext}"
+
+    source = _UploadSource(file_obj)
+    total = source.total
+    store = _upload_resume_state()
+    with store["lock"]:
+        state = store["uploads"].get(resume_key) if resume_key else None
+        if not state or state["total"] != total:
+            state = {"upload_id": uuid.uuid4().hex, "offset": 0, "total": total}
 
-        # 2. Gửi file lên Cloudinary
-        # Lưu ý: resource_type='video' dùng chung cho cả Audio và Video
-        data = {
-            "upload_preset": UPLOAD_PRESET
-        }
-        files = {
-            "file": (filename, file_stream)
-        }
-        
-        with st.spinner("Đang tải lên Cloudinary Server tốc độ cao..."):
-            r = requests.post(url, data=data, files=files, timeout=60)
-            
-        if r.status_code == 200:
-            # Lấy link bảo mật (https) từ kết quả trả về
-            return r.json()['secure_url']
-        else:
-            st.error(f"Lỗi Cloudinary: {r.text}")
+    try:
+        offset = state["offset"]
+        if on_progress:
+            on_progress(offset, total)
+        while True:
+            end = min(offset + CLOUDINARY_CHUNK_BYTES, total)
+            headers = {}
+            if total:
+                headers = {"X-Unique-Upload-Id": state["upload_id"], "Content-Range": f"bytes {offset}-{end - 1}/{total}"}
+
+            # Client dùng chung tự thử lại khúc bị lỗi mạng/5xx/429 (chờ tăng dần + ngẫu nhiên).
+            # Cloudinary ghép theo X-Unique-Upload-Id + Content-Range nên gửi lại 1 khúc (kể cả file chỉ có 1 khúc) không tạo file trùng.
+            # Chỉ đọc 1 khúc (tối đa CLOUDINARY_CHUNK_BYTES) thành bytes để gửi lại được khi thử lại.
+            last_error = None
+            try:
+                r = get_http_client().post(url, data={"upload_preset": upload_preset},
+                                           files={"file": (filename, source.read(offset, end))},
+                                           headers=headers, timeout=(HTTP_CONNECT_TIMEOUT, CLOUDINARY_TIMEOUT),
+                                           retries=CLOUDINARY_MAX_RETRIES)
+                if r.status_code != 200:
+                    last_error = r.text # Lỗi do dữ liệu/cấu hình, hoặc đã hết lượt thử lại
+            except requests.RequestException as e:
+                last_error = str(e)
+
+            if last_error is not None:
+                if offset > 0 and resume_key:
+                    state["offset"] = offset
+                    with store["lock"]:
+                        store["uploads"][resume_key] = state # Lần sau tải tiếp từ khúc này
+                return None, last_error
+
+            offset = end
+            if on_progress:
+                on_progress(offset, total)
+            if offset >= total:
+                if resume_key:
+                    with store["lock"]:
+                        store["uploads"].pop(resume_key, None)
+                # Lấy link bảo mật (https) từ kết quả trả về
+                return r.json()['secure_url'], None
+    finally:
+        source.release()
+
+def upload_to_catbox(file_obj, custom_name=None, resume_key=None):
+    # [NÂNG CẤP] Sử dụng hạ tầng CLOUDINARY (Siêu nhanh & Ổn định), có thanh tiến độ
+    progress_bar, show_progress = upload_progress_bar("Đang tải lên Cloudinary Server tốc độ cao...")
+    try:
+        link, error = cloudinary_upload(file_obj, on_progress=show_progress, resume_key=resume_key)
+        if link:
+            return link
+        st.error(f"Lỗi Cloudinary: {error}")
             
     except Exception as e:
         print(f"Lỗi upload: {e}")
         st.error(f"Lỗi hệ thống: {e}")
+    finally:
+        progress_bar.empty()
         
     return None
 
 
+# --- [NEW] KHÔNG TẢI LẠI FILE AUDIO ĐÃ CÓ (THEO MÃ BĂM NỘI DUNG) ---
+# Bảng audio_uploads: sha256 của file GỐC -> link Cloudinary + thông tin audio đã chuẩn hóa.
+# Gửi lại cùng bản thu/file (sau khi lỗi, hoặc dùng cho video thứ 2) thì lấy link cũ, không tải/chuyển định dạng lại.
+def audio_sha256(file_obj):
+    if isinstance(file_obj, (bytes, bytearray)):
+        return hashlib.sha256(file_obj).hexdigest()
+    if hasattr(file_obj, "getbuffer"):
+        with file_obj.getbuffer() as view: # Đọc thẳng bộ đệm của BytesIO/UploadedFile, không sao chép
+            return hashlib.sha256(view).hexdigest()
+    digest = hashlib.sha256()
+    file_obj.seek(0)
+    for block in iter(lambda: file_obj.read(WAV_IO_BLOCK), b""):
+        digest.update(block)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+def audio_file_digest(file_obj):
+    """audio_sha256 có nhớ (gọi ở luồng giao diện): mỗi lượt vẽ lại không phải băm lại cả file (tới 20MB).
+    File upload của Streamlit là object mới mỗi lượt nên nhớ theo file_id trong session; object khác nhớ ngay trên object"""
+    if isinstance(file_obj, (bytes, bytearray)):
+        return audio_sha256(file_obj)
+    size = getattr(file_obj, "size", None)
+    if size is None and hasattr(file_obj, "getbuffer"):
+        with file_obj.getbuffer() as view:
+            size = view.nbytes
+    file_id = getattr(file_obj, "file_id", None)
+    if file_id:
+        memo = st.session_state.setdefault('audio_sha256_memo', {})
+        key = (file_id, size)
+        if key not in memo:
+            memo.clear() # Chỉ cần nhớ file đang chọn
+            memo[key] = audio_sha256(file_obj)
+        return memo[key]
+    cached = getattr(file_obj, "_sha256_memo", None)
+    if cached and cached[0] == size:
+        return cached[1]
+    digest = audio_sha256(file_obj)
+    try:
+        file_obj._sha256_memo = (size, digest)
+    except AttributeError:
+        pass
+    return digest
+
+def find_uploaded_audio(sha256):
+    try:
+        res = supabase.table('audio_uploads').select("secure_url, audio_info").eq('sha256', sha256).limit(1).execute()
+        if res.data:
+            return res.data[0]
+    except Exception as e:
+        print(f"Lỗi tra bảng audio_uploads: {e}")
+    return None
+
+def remember_uploaded_audio(sha256, secure_url, audio_info):
+    try:
+        supabase.table('audio_uploads').upsert({"sha256": sha256, "secure_url": secure_url, "audio_info": audio_info}, on_conflict='sha256').execute()
+    except Exception as e:
+        print(f"Lỗi ghi bảng audio_uploads: {e}")
+
+def upload_audio_deduped(file_obj, file_name=None, on_progress=None, sha256=None):
+    """Chuẩn hóa + tải audio lên, bỏ qua nếu đúng file này đã từng tải. Không gọi st.*.
+    Trả về (link hoặc None, thông tin audio, thông báo lỗi hoặc None)"""
+    sha256 = sha256 or audio_sha256(file_obj)
+    known = find_uploaded_audio(sha256)
+    if known and known.get('secure_url'):
+        return known['secure_url'], dict(known.get('audio_info') or {}, audio_dedup_hit=True), None
+
+    payload, audio_info = prepare_audio_for_upload(file_obj, file_name)
+    # Khóa tải tiếp theo file gốc + định dạng đích: gửi lại cùng file thì tải tiếp phần còn thiếu
+    link, error = cloudinary_upload(payload, on_progress=on_progress, resume_key=f"{sha256}:{audio_info['audio_codec']}")
+    if link:
+        remember_uploaded_audio(sha256, link, audio_info)
+    return link, audio_info, error
+
+def upload_progress_bar(label):
+    """Thanh tiến độ dùng làm on_progress cho cloudinary_upload / upload_audio_deduped"""
+    bar = st.progress(0, text=label)
+    def _update(sent, total):
+        bar.progress(min(sent / total, 1.0) if total else 1.0, text=f"{label} {sent / 1048576:.1f}/{total / 1048576:.1f} MB")
+    return bar, _update
+
+
+# --- [NEW] TẢI TRƯỚC AUDIO Ở LUỒNG NỀN NGAY KHI USER CHỌN FILE / THU ÂM XONG ---
+# Future được giữ trong session_state; lúc bấm gửi thường đã có link sẵn nên chỉ còn việc ghi đơn.
+# Luồng nền chỉ gọi upload_audio_deduped (không gọi st.*), tiến độ ghi vào 1 dict để giao diện đọc.
+AUDIO_PREUPLOAD_WORKERS = 4
+
+@st.cache_resource
+def _audio_upload_executor():
+    return ThreadPoolExecutor(max_workers=AUDIO_PREUPLOAD_WORKERS, thread_name_prefix="audio-preupload")
+
+def start_audio_preupload(file_obj, file_name):
+    """Bắt đầu tải trước (1 lần cho mỗi nội dung file). Gọi lại nhiều lần với cùng file không sao"""
+    if file_obj is None:
+        return None
+    sha256 = audio_file_digest(file_obj)
+    current = st.session_state.get('audio_preupload')
+    if current and current['sha256'] == sha256:
+        return current
+    progress = {"sent": 0, "total": 0}
+    def _on_progress(sent, total):
+        progress["sent"], progress["total"] = sent, total
+    future = _audio_upload_executor().submit(upload_audio_deduped, file_obj, file_name, _on_progress, sha256)
+    st.session_state['audio_preupload'] = {"sha256": sha256, "future": future, "progress": progress}
+    return st.session_state['audio_preupload']
+
+def _preupload_result(preupload):
+    try:
+        return preupload['future'].result()
+    except Exception as e:
+        print(f"Lỗi tải trước audio: {e}")
+        return None, {}, str(e)
+
+def finish_audio_upload(file_obj, file_name, label):
+    """Dùng khi bấm gửi: lấy kết quả tải trước (chờ nốt nếu chưa xong), lỗi thì tải lại ngay (tự tải tiếp phần dở).
+    Trả về (link hoặc None, thông tin audio, thông báo lỗi hoặc None)"""
+    if file_obj is None:
+        return None, {}, "Chưa có file âm thanh"
+    sha256 = audio_file_digest(file_obj)
+    preupload = st.session_state.get('audio_preupload')
+    if preupload and preupload['sha256'] == sha256 and preupload['future'].cancel():
+        # Việc tải trước còn đang xếp hàng sau file của người khác -> bỏ hàng, tải thẳng ngay bây giờ
+        st.session_state.pop('audio_preupload', None)
+        preupload = None
+    if preupload and preupload['sha256'] == sha256:
+        progress_bar = st.progress(0, text=label)
+        while not preupload['future'].done():
+            sent, total = preupload['progress']['sent'], preupload['progress']['total']
+            progress_bar.progress(min(sent / total, 1.0) if total else 0.0, text=f"{label} {sent / 1048576:.1f}/{total / 1048576:.1f} MB")
+            time.sleep(0.3)
+        progress_bar.empty()
+        link, audio_info, error = _preupload_result(preupload)
+        if link:
+            return link, audio_info, None
+        print(f"Tải trước thất bại, tải lại: {error}")
+
+    progress_bar, show_progress = upload_progress_bar(label)
+    try:
+        return upload_audio_deduped(file_obj, file_name, show_progress, sha256)
+    finally:
+        progress_bar.empty()
+
+@st.fragment(run_every=1)
+def _audio_preupload_progress():
+    preupload = st.session_state.get('audio_preupload')
+    if not preupload or preupload['future'].done():
+        st.rerun() # Xong rồi -> vẽ lại cả trang để tắt fragment, hiện kết quả tĩnh
+    sent, total = preupload['progress']['sent'], preupload['progress']['total']
+    st.progress(min(sent / total, 1.0) if total else 0.0, text="☁️ Đang tải trước lên máy chủ (bạn cứ tiếp tục các bước khác)...")
+
+def show_audio_preupload_status(file_obj):
+    preupload = st.session_state.get('audio_preupload')
+    if file_obj is None or not preupload or preupload['sha256'] != audio_file_digest(file_obj):
+        return
+    if not preupload['future'].done():
+        _audio_preupload_progress()
+    elif _preupload_result(preupload)[0]:
+        st.caption("☁️ Đã tải sẵn lên máy chủ, bấm gửi là xong ngay.")
+    else:
+        st.caption("⚠️ Tải trước chưa được, hệ thống sẽ tải lại khi bạn bấm gửi.")
+
+
 # --- [NEW] HÀM LÀM SẠCH RIÊNG CHO TTS (BẢN NÂNG CẤP V2) ---
+# [NÂNG CẤP] Bảng từ viết tắt được biên dịch 1 lần (xem tts_normalizer.py), admin sửa trên bảng tts_abbreviations
+# của Supabase thì mỗi server tự nạp lại sau TTS_ABBR_RELOAD_SECONDS giây (hoặc bấm nút nạp lại ở trang Admin).
+TTS_ABBR_RELOAD_SECONDS = 300
+
+def _fetch_tts_abbreviations():
+    """Bảng mặc định + các dòng trong tts_abbreviations (enabled = false -> bỏ từ đó khỏi bảng)"""
+    res = supabase.table('tts_abbreviations').select("abbr, expansion, enabled").execute()
+    abbreviations = dict(DEFAULT_ABBREVIATIONS)
+    for row in res.data or []:
+        abbr = str(row.get('abbr') or "").strip()
+        if not abbr:
+            continue
+        if row.get('enabled') is False:
+            abbreviations = {k: v for k, v in abbreviations.items() if k.lower() != abbr.lower()}
+        else:
+            abbreviations[abbr] = row.get('expansion') or ""
+    return abbreviations
+
+@st.cache_resource
+def get_tts_normalizer():
+    return TextNormalizer(loader=_fetch_tts_abbreviations, reload_seconds=TTS_ABBR_RELOAD_SECONDS)
+
 def clean_text_for_tts(text):
-    if not text: return ""
-    text = str(text)
-    
-    # 1. Xóa các thẻ HTML & Link rác
-    text = re.sub(r'<[^>]+>', '', text)
-    text = re.sub(r'http\S+', '', text)
-    
-    # 2. [NÂNG CẤP] THAY THẾ TỪ VIẾT TẮT (DICT)
-    # Bạn có thể thêm các từ muốn sửa vào danh sách dưới đây:
-    replacements = {
-        "vn": "Việt Nam",
-        "HT": "Hòa Thượng",
-        "sp": "Sư phụ",
-        "TT": "Thượng Tọa",
-        "ko": "không",
-        "k": "không",
-        "hok": "không",
-        "dc": "được",
-        "đc": "được",
-        "mn": "mọi người",
-        "mng": "mọi người",
-        "acc": "tài khoản",
-        "fb": "Facebook",
-        "zalo": "Za lô",
-        "kg": "ki lô gam",
-        "km": "ki lô mét",
-        "sp": "sản phẩm",
-        "shop": "cửa hàng",
-        "ok": "ô kê"
-    }
-    
-    # Vòng lặp thay thế thông minh (Dùng Regex)
-    for k, v in replacements.items():
-        # \b nghĩa là "ranh giới từ" -> Chỉ thay khi từ đứng một mình
-        # re.IGNORECASE -> Không phân biệt hoa thường (VN hay vn đều thay hết)
-        text = re.sub(r'\b' + re.escape(k) + r'\b', v, text, flags=re.IGNORECASE)
-
-    # 3. Xóa ký tự điều khiển lạ & Chuẩn hóa khoảng trắng
-    text = "".join(ch for ch in text if ch.isprintable())
-    text = " ".join(text.split())
-    
-    return text.strip()
+    return get_tts_normalizer().normalize(text)
 
 
 
 # --- [NEW] HÀM GỌI API TTS (CHẤT LƯỢNG CAO - GEMINI) ---
 
-def _convert_to_wav(base64_raw_data):
-    """Hàm phụ: Convert raw PCM từ Gemini sang WAV"""
-    try:
-        sample_rate, num_channels, bits_per_sample = 24000, 1, 16
-        raw_buffer = base64.b64decode(base64_raw_data)
-        
-        byte_rate = sample_rate * num_channels * bits_per_sample // 8
-        block_align = num_channels * bits_per_sample // 8
-        wav_header_size, data_size = 44, len(raw_buffer)
-        file_size = wav_header_size + data_size - 8
-        
-        header = bytearray(wav_header_size)
+# --- [NEW] GHI FILE WAV KIỂU DÒNG CHẢY (KHÔNG GIỮ CẢ FILE TRONG RAM) ---
+WAV_HEADER_SIZE = 44
+WAV_IO_BLOCK = 64 * 1024 # Mỗi lần đọc/ghi tối đa 64KB -> RAM không phụ thuộc độ dài audio
+_WAV_B64_SLICE = WAV_IO_BLOCK // 3 * 4 # Số ký tự base64 giải mã mỗi lần (bội của 4)
+_WAV_SIZE_UNKNOWN = 0xFFFFFFFF # Quy ước cho luồng không tua lại được (không vá được kích thước)
+
+class StreamingWavWriter:
+    """Ghi PCM từng đoạn vào file-like bất kỳ. Header ghi trước với kích thước tạm,
+    close() tua lại vá kích thước RIFF/data (nếu file không tua được thì để 0xFFFFFFFF)."""
+
+    def __init__(self, fileobj, sample_rate=24000, num_channels=1, bits_per_sample=16):
+        self.fileobj = fileobj
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self.bits_per_sample = bits_per_sample
+        self.block_align = num_channels * bits_per_sample // 8
+        self.byte_rate = sample_rate * self.block_align
+        self.data_size = 0
+        self._b64_rest = ""
+        self._closed = False
+        try:
+            # SpooledTemporaryFile bản cũ không có seekable() nhưng vẫn tua được
+            self._start = fileobj.tell() if getattr(fileobj, 'seekable', lambda: True)() else None
+        except (AttributeError, OSError):
+            self._start = None
+        self._write_header(_WAV_SIZE_UNKNOWN - 8, _WAV_SIZE_UNKNOWN)
+
+    def _write_header(self, riff_size, data_size):
+        header = bytearray(WAV_HEADER_SIZE)
         header[0:4] = b'RIFF'
-        struct.pack_into('<I', header, 4, file_size)
+        struct.pack_into('<I', header, 4, riff_size)
         header[8:12] = b'WAVE'
         header[12:16] = b'fmt '
-        struct.pack_into('<IHHIIHH', header, 16, 16, 1, num_channels, sample_rate, byte_rate, block_align, bits_per_sample)
+        struct.pack_into('<IHHIIHH', header, 16, 16, 1, self.num_channels, self.sample_rate, self.byte_rate, self.block_align, self.bits_per_sample)
         header[36:40] = b'data'
         struct.pack_into('<I', header, 40, data_size)
-        
-        return bytes(header) + raw_buffer
+        self.fileobj.write(header)
+
+    def write(self, pcm):
+        """Ghi thẳng 1 đoạn PCM thô (bytes/bytearray/memoryview), không sao chép"""
+        if pcm:
+            self.fileobj.write(pcm)
+            self.data_size += len(pcm)
+
+    def write_base64(self, b64_data):
+        """Giải mã base64 theo từng lát nhỏ. Các đoạn base64 liên tiếp có thể bị cắt ở vị trí bất kỳ"""
+        if isinstance(b64_data, (bytes, bytearray)):
+            b64_data = b64_data.decode('ascii')
+        data = self._b64_rest + b64_data
+        usable = len(data) - len(data) % 4
+        for i in range(0, usable, _WAV_B64_SLICE):
+            self.write(base64.b64decode(data[i:min(i + _WAV_B64_SLICE, usable)]))
+        self._b64_rest = data[usable:]
+
+    def write_silence(self, seconds):
+        total = int(seconds * self.sample_rate) * self.block_align
+        block = bytes(min(total, WAV_IO_BLOCK))
+        while total > 0:
+            n = min(total, len(block))
+            self.write(memoryview(block)[:n])
+            total -= n
+
+    def write_chunks(self, chunks, gap_seconds=0, is_base64=False):
+        """Nối nhiều đoạn PCM (hoặc base64) liên tiếp, chèn khoảng lặng giữa các đoạn nếu cần"""
+        for i, chunk in enumerate(chunks):
+            if i and gap_seconds:
+                self.write_silence(gap_seconds)
+            if is_base64:
+                self.write_base64(chunk)
+            else:
+                self.write(chunk)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._b64_rest:
+            raise ValueError("Dữ liệu base64 bị cụt ở cuối")
+        if self.data_size % 2:
+            self.fileobj.write(b'\0') # Chuẩn RIFF: khối dữ liệu phải chẵn byte
+        if self._start is not None:
+            end = self.fileobj.tell()
+            self.fileobj.seek(self._start)
+            self._write_header(WAV_HEADER_SIZE - 8 + self.data_size + self.data_size % 2, self.data_size)
+            self.fileobj.seek(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+def _convert_to_wav(base64_raw_data, fileobj=None):
+    """Hàm phụ: Convert raw PCM từ Gemini sang WAV.
+    Nhận 1 chuỗi base64 hoặc nhiều đoạn base64 liên tiếp; có fileobj thì ghi thẳng vào đó và trả về fileobj"""
+    import io
+    try:
+        out = fileobj if fileobj is not None else io.BytesIO()
+        chunks = [base64_raw_data] if isinstance(base64_raw_data, (str, bytes, bytearray)) else base64_raw_data
+        with StreamingWavWriter(out, sample_rate=24000, num_channels=1, bits_per_sample=16) as writer:
+            writer.write_chunks(chunks, is_base64=True)
+        return out if fileobj is not None else out.getvalue()
     except Exception as e:
         print(f"Lỗi convert WAV: {e}")
         return None
@@ -898,72 +2742,217 @@ GEMINI_STYLES = {
 
 
 # --- [NEW] HÀM ĐỒNG BỘ TỪ GOOGLE SHEET VỀ SUPABASE ---
+LIBRARY_SYNC_CHUNK = 200
+LIBRARY_SYNC_WORKERS = 4 # Số request ghi Supabase chạy cùng lúc khi đồng bộ
+
+# Đúng tập ký tự của public.library_fingerprint() trong SQL (str.split() của Python còn tách cả các khoảng trắng
+# Unicode khác mà regex của Postgres không coi là khoảng trắng -> lệch mã với dòng đã có)
+_FINGERPRINT_SPACE_RE = re.compile('[ \t\n\r\f\v\u00a0]+')
+
+def library_fingerprint(content):
+    """md5 của kịch bản ĐÃ sanitize, gộp khoảng trắng. Phải khớp với public.library_fingerprint() trong SQL"""
+    normalized = _FINGERPRINT_SPACE_RE.sub(" ", str(content or "")).strip(" ")
+    return hashlib.md5(normalized.encode("utf-8")).hexdigest()
+
+def _rows_digest(fingerprints):
+    return hashlib.md5("\n".join(fingerprints).encode("utf-8")).hexdigest()
+
+def _sheet_row_content(row):
+    # Tìm cột nội dung
+    for k, v in row.items():
+        if "nội dung" in k.lower() or "content" in k.lower():
+            return str(v).strip() # [Fix] Luôn làm sạch chuỗi
+    return ""
+
+def _load_library_sync_state():
+    """{category: {row_count, digest}} - mốc đồng bộ lần trước của từng sheet (1 request cho cả 4 sheet)"""
+    res = supabase.table('library_sync_state').select("category, row_count, digest").execute()
+    return {r['category']: r for r in (res.data or [])}
+
+def _existing_library_fingerprints(sheet_name):
+    """fingerprint -> source_index của 1 danh mục. Chỉ tải 2 cột nhỏ, không tải nội dung"""
+    existing = {}
+    start = 0
+    while True:
+        res = supabase.table('library').select("fingerprint, source_index").eq('category', sheet_name) \
+            .order('id').range(start, start + LIBRARY_FETCH_PAGE - 1).execute()
+        page = res.data or []
+        for item in page:
+            existing.setdefault(item['fingerprint'], item['source_index'])
+        if len(page) < LIBRARY_FETCH_PAGE:
+            return existing
+        start += LIBRARY_FETCH_PAGE
+
+def _plan_library_sheet(sheet_name, data, state, base_url):
+    """Tính các dòng cần ghi của 1 sheet. Trả về (batch_data, mốc mới hoặc None nếu sheet không đổi)"""
+    contents = [sanitize_input(_sheet_row_content(row)) for row in data]
+    fingerprints = [library_fingerprint(c) if c else "" for c in contents]
+    row_count = len(fingerprints)
+    digest = _rows_digest(fingerprints)
+
+    if state and state['row_count'] == row_count and state['digest'] == digest:
+        return [], None # Sheet không đổi -> không đụng tới Supabase
+
+    if state and state['row_count'] <= row_count and _rows_digest(fingerprints[:state['row_count']]) == state['digest']:
+        # Trường hợp thường gặp: chỉ thêm dòng ở cuối sheet -> chỉ xét phần sau mốc cũ
+        seen = set(fingerprints[:state['row_count']])
+        candidates = range(state['row_count'], row_count)
+        existing = {}
+    else:
+        # Sheet bị sửa/chèn/xóa ở giữa (hoặc lần đầu) -> so với fingerprint đang có trong DB
+        seen = set()
+        candidates = range(row_count)
+        existing = _existing_library_fingerprints(sheet_name)
+
+    batch_data = []
+    for i in candidates:
+        fp = fingerprints[i]
+        if not fp or fp in seen:
+            continue # Dòng trống, hoặc trùng kịch bản đứng trước trong cùng sheet
+        seen.add(fp)
+        if existing.get(fp) == i:
+            continue # Đã có và vẫn ở đúng vị trí
+        batch_data.append({
+            "content": contents[i],
+            # [ĐÃ SỬA] Cộng thêm 1 để khớp với tên file (1.mp3, 2.mp3...)
+            "audio_url": f"{base_url}{sheet_name}/{i + 2}.mp3",
+            "category": sheet_name,
+            "source_index": i, # Index thực tế
+            "fingerprint": fp
+        })
+    return batch_data, {"category": sheet_name, "row_count": row_count, "digest": digest}
+
+def _plan_library_sheet_legacy(sheet_name, data, base_url):
+    """Dự phòng khi DB chưa có cột fingerprint: so sánh bằng fingerprint tính tại chỗ"""
+    existing_response = supabase.table('library').select("content").eq('category', sheet_name).execute()
+    existing = {library_fingerprint(item['content']) for item in existing_response.data}
+
+    batch_data = []
+    for i, row in enumerate(data):
+        # So sánh bản ĐÃ sanitize với bản trong DB -> kịch bản có & < > không bị thêm lại mỗi lần sync
+        clean_content = sanitize_input(_sheet_row_content(row))
+        fp = library_fingerprint(clean_content)
+        if clean_content and fp not in existing:
+            existing.add(fp)
+            batch_data.append({
+                "content": clean_content,
+                "audio_url": f"{base_url}{sheet_name}/{i + 2}.mp3",
+                "category": sheet_name,
+                "source_index": i
+            })
+    return batch_data
+
+def _write_library_chunk(sheet_name, chunk, legacy):
+    """Chạy trong thread phụ: ghi 1 cụm dòng, trả về (sheet, các dòng đã ghi, số giây)"""
+    started = time.time()
+    table = supabase.table('library')
+    if legacy:
+        res = table.insert(chunk).execute()
+    else:
+        # Kịch bản đã có (cùng danh mục + fingerprint) thì chỉ cập nhật vị trí/link, không sinh dòng trùng
+        res = table.upsert(chunk, on_conflict='category,fingerprint').execute()
+    return sheet_name, res.data or [], time.time() - started
+
+def _records_from_values(values):
+    """Giống ws.get_all_records(): dòng đầu là tiêu đề, các dòng sau thành dict (ô thiếu ở cuối = "")"""
+    if not values:
+        return []
+    header = [str(h) for h in values[0]]
+    return [dict(zip(header, list(row) + [""] * (len(header) - len(row)))) for row in values[1:]]
+
+def _fetch_library_sheets(sh, sheet_names):
+    """Đọc tất cả các sheet bằng 1 request values_batch_get (sheet không tồn tại thì bỏ qua)"""
+    existing_titles = {ws.title for ws in sh.worksheets()}
+    names = [name for name in sheet_names if name in existing_titles]
+    if not names:
+        return {}
+    res = sh.values_batch_get([f"'{name}'" for name in names])
+    value_ranges = res.get('valueRanges', [])
+    return {name: _records_from_values(vr.get('values', [])) for name, vr in zip(names, value_ranges)}
+
 def sync_sheet_to_supabase():
     try:
-        # Kết nối Google Sheet
-        gc = get_gspread_client()
-        sh = gc.open_by_key(LIBRARY_SHEET_ID)
+        # Kết nối Google Sheet (client + spreadsheet dùng chung, đã xác thực sẵn)
+        sheets = get_sheets()
         target_sheets = ["duoi_60s", "duoi_90s", "duoi_180s", "tren_180s"]
         
         total_synced = 0
+        synced_rows = [] # Các dòng vừa ghi (có id) để cập nhật chỉ mục trong RAM
         status_text = st.empty()
+        timings = {name: {"Sheet": name, "Số dòng": 0, "Cần ghi": 0, "Đã ghi": 0, "Đọc (s)": 0.0, "So sánh (s)": 0.0, "Ghi (s)": 0.0}
+                   for name in target_sheets}
         
         # Lấy Base URL từ secrets
         BASE_URL = st.secrets["huggingface"]["base_url"] if "huggingface" in st.secrets else ""
 
-        for sheet_name in target_sheets:
-            status_text.text(f"⏳ Đang đồng bộ sheet: {sheet_name}...")
-            try:
-                ws = sh.worksheet(sheet_name)
-                data = ws.get_all_records()
-            except: continue # Bỏ qua nếu không tìm thấy sheet
-            
-            # [LOGIC MỚI] 1. Lấy danh sách nội dung ĐÃ CÓ trong Supabase của sheet này
-            # Mục đích: Để so sánh và loại bỏ những cái trùng lặp
-            existing_response = supabase.table('library').select("content").eq('category', sheet_name).execute()
-            
-            # Tạo một tập hợp (set) chứa các nội dung đã tồn tại để tra cứu cho nhanh
-            # Lưu ý: strip() để xóa khoảng trắng thừa đầu đuôi
-            existing_contents = {str(item['content']).strip() for item in existing_response.data}
-            
-            batch_data = []
-            for i, row in enumerate(data):
-                # Tìm cột nội dung
-                content = ""
-                for k, v in row.items():
-                    if "nội dung" in k.lower() or "content" in k.lower():
-                        content = str(v).strip() # [Fix] Luôn làm sạch chuỗi
-                        break
-                
-                # [LOGIC MỚI] 2. Chỉ thêm nếu có nội dung VÀ nội dung đó CHƯA CÓ trong DB
-                if content and content not in existing_contents:
-                    # [BẢO MẬT] Làm sạch nội dung kịch bản trước khi đưa vào DB
-                    clean_content = sanitize_input(content)
-                    
-                    # [ĐÃ SỬA] Cộng thêm 1 để khớp với tên file (1.mp3, 2.mp3...)
-                    audio_link = f"{BASE_URL}{sheet_name}/{i + 2}.mp3"
-                    
-                    # Chuẩn bị dữ liệu
-                    batch_data.append({
-                        "content": clean_content,
-                        "audio_url": audio_link,
-                        "category": sheet_name,
-                        "source_index": i # Index thực tế
-                    })
-            
-            # [LOGIC MỚI] 3. Dùng INSERT thay vì UPSERT
-            # Vì ta đã lọc trùng rồi, nên chỉ cần Insert cái mới thôi
-            if batch_data:
-                chunk_size = 50
-                for k in range(0, len(batch_data), chunk_size):
-                    # Dùng insert để thêm mới (nếu lỡ vẫn còn trùng thì DB sẽ báo lỗi, nhưng ta đã lọc ở trên rồi)
-                    supabase.table('library').insert(batch_data[k:k+chunk_size]).execute()
-                total_synced += len(batch_data)
+        # 1. Đọc cả 4 sheet trong 1 request
+        status_text.text("⏳ Đang đọc Google Sheet...")
+        started = time.time()
+        sheets_data = sheets.run(lambda c: _fetch_library_sheets(c.spreadsheet(key=LIBRARY_SHEET_ID), target_sheets), idempotent=True)
+        fetch_seconds = time.time() - started
+        for name, data in sheets_data.items():
+            timings[name]["Số dòng"] = len(data)
+            timings[name]["Đọc (s)"] = fetch_seconds # Chung 1 request cho mọi sheet
+
+        # Mốc đồng bộ lần trước. Lỗi = DB chưa chạy supabase_functions.sql -> dùng cách cũ
+        try:
+            sync_state = _load_library_sync_state()
+        except Exception as e:
+            print(f"Chưa có bảng library_sync_state, đồng bộ kiểu cũ: {e}")
+            sync_state = None
+        legacy = sync_state is None
+
+        # 2. So sánh từng sheet với mốc / DB
+        status_text.text("⏳ Đang so sánh với dữ liệu đã có...")
+        plans = {}
+        new_states = []
+        for sheet_name, data in sheets_data.items():
+            started = time.time()
+            if legacy:
+                plans[sheet_name] = _plan_library_sheet_legacy(sheet_name, data, BASE_URL)
+            else:
+                plans[sheet_name], new_state = _plan_library_sheet(sheet_name, data, sync_state.get(sheet_name), BASE_URL)
+                if new_state:
+                    new_states.append(new_state)
+            timings[sheet_name]["Cần ghi"] = len(plans[sheet_name])
+            timings[sheet_name]["So sánh (s)"] = time.time() - started
+
+        # 3. Ghi song song, tối đa LIBRARY_SYNC_WORKERS request cùng lúc cho mọi sheet
+        # (thread phụ chỉ gọi Supabase, mọi lệnh st.* vẫn ở thread chính)
+        chunk_size = 50 if legacy else LIBRARY_SYNC_CHUNK
+        jobs = [(name, batch[k:k + chunk_size]) for name, batch in plans.items() for k in range(0, len(batch), chunk_size)]
+        if jobs:
+            with ThreadPoolExecutor(max_workers=LIBRARY_SYNC_WORKERS) as pool:
+                futures = [pool.submit(_write_library_chunk, name, chunk, legacy) for name, chunk in jobs]
+                for done_count, future in enumerate(as_completed(futures), start=1):
+                    sheet_name, rows, seconds = future.result()
+                    synced_rows.extend(rows)
+                    total_synced += len(rows)
+                    timings[sheet_name]["Đã ghi"] += len(rows)
+                    timings[sheet_name]["Ghi (s)"] += seconds
+                    status_text.text(f"⏳ Đang ghi vào Supabase: {done_count}/{len(jobs)} cụm...")
+
+        # Chỉ lưu mốc sau khi đã ghi xong dữ liệu -> lỗi giữa chừng thì lần sau sync lại phần đó
+        if new_states:
+            supabase.table('library_sync_state').upsert(new_states, on_conflict='category').execute()
+
+        # Cập nhật chỉ mục thư viện của server này ngay, không cần quét lại cả bảng
+        library_index = get_library_index()
+        if synced_rows and library_index.ready:
+            library_index.add_rows(synced_rows)
+            # Dòng cũ có thể đã bị sửa/xóa trên Sheet -> lần làm mới tới tải lại cả bảng
+            library_index.last_rebuild = library_index.last_refresh = 0.0
+            library_index.save_snapshot()
 
         if total_synced > 0:
-            status_text.success(f"✅ Đã thêm mới {total_synced} kịch bản vào hệ thống!")
+            status_text.success(f"✅ Đã thêm mới/cập nhật {total_synced} kịch bản vào hệ thống!")
         else:
             status_text.info("✅ Hệ thống đã cập nhật. Không có kịch bản mới nào.")
+
+        # Thời gian từng sheet (Ghi = tổng thời gian các request của sheet đó, chạy song song nên có thể lớn hơn thời gian thực)
+        timing_df = pd.DataFrame(list(timings.values())).round(2)
+        print(f"Sync thư viện: {timing_df.to_dict('records')}")
+        st.dataframe(timing_df, hide_index=True, use_container_width=True)
             
         return True
     except Exception as e:
@@ -1111,6 +3100,14 @@ def admin_dashboard():
         if st.button("🚀 Bắt đầu Đồng bộ ngay"):
             sync_sheet_to_supabase()
 
+        st.divider()
+        st.caption("Bảng từ viết tắt khi đọc TTS (bảng tts_abbreviations trên Supabase) tự nạp lại sau vài phút.")
+        if st.button("🔁 Nạp lại bảng từ viết tắt TTS ngay"):
+            if get_tts_normalizer().reload():
+                st.success(f"✅ Đã nạp {len(get_tts_normalizer().abbreviations)} từ viết tắt.")
+            else:
+                st.error("Không đọc được bảng tts_abbreviations, vẫn dùng bảng cũ.")
+
     with tab3:
         st.subheader("🔎 Tìm và Cập nhật Gói User")
         
@@ -1195,6 +3192,17 @@ def admin_dashboard():
         with c_log2:
             if st.button("🔄 Làm mới logs", use_container_width=True):
                 st.rerun()
+
+        # Tình trạng hàng đợi ghi nền (log lịch sử Sheet, tts_logs...) của tiến trình server này
+        wb_stats = get_write_behind().snapshot()
+        wb1, wb2, wb3, wb4 = st.columns(4)
+        wb1.metric("Đang chờ ghi", wb_stats['pending'])
+        wb2.metric("Đã nhận", wb_stats['queued'])
+        wb3.metric("Đã ghi", wb_stats['flushed'])
+        wb4.metric("Ghi lỗi (bỏ)", wb_stats['failed'])
+        st.caption(f"Ghi lại sau lỗi: {wb_stats['retried']} lượt | Ghi thẳng do hàng đợi đầy: {wb_stats['direct']} dòng | Số lô: {wb_stats['batches']}")
+        if wb_stats['last_error']:
+            st.caption(f"⚠️ Lỗi ghi nền gần nhất: {wb_stats['last_error']}")
             
         try:
             # Lấy 50 log mới nhất (Tăng lên để không bị trôi mất thông tin quan trọng)
@@ -1834,19 +3842,27 @@ else:
 
                     if btn_load_cat:
                         with st.spinner(f"Đang tải kịch bản {selected_cat}..."):
-                            raw_results = get_scripts_from_supabase_by_category(selected_cat)
-                            # Đồng bộ cấu trúc dữ liệu để code bên dưới không bị lỗi khi bấm chọn
-                            formatted_results = []
-                            for item in raw_results:
-                                formatted_results.append({
-                                    "content": item['content'],
-                                    "audio": item['audio_url'],
-                                    "source_sheet": item['category']
-                                })
-                            st.session_state['search_results'] = formatted_results
-                            st.session_state['has_searched'] = True
-                            if 'last_picked_idx' in st.session_state:
-                                del st.session_state['last_picked_idx']
+                            load_library_browse(selected_cat)
+
+                    # Chuyển trang / lấy ngẫu nhiên trong danh mục đang xem
+                    browse = st.session_state.get('library_browse')
+                    if browse and browse['category'] == selected_cat and st.session_state.get('has_searched'):
+                        c_prev, c_page, c_next, c_rand = st.columns([1, 1, 1, 1], vertical_alignment="center")
+                        with c_prev:
+                            if st.button("⬅️ Trang trước", use_container_width=True, disabled=browse['seed'] is not None or browse['page'] == 0):
+                                load_library_browse(selected_cat, page=browse['page'] - 1)
+                                st.rerun()
+                        with c_page:
+                            st.caption("🎲 Ngẫu nhiên" if browse['seed'] is not None else f"Trang {browse['page'] + 1}")
+                        with c_next:
+                            if st.button("Trang sau ➡️", use_container_width=True, disabled=browse['seed'] is not None or not browse['has_more']):
+                                load_library_browse(selected_cat, page=browse['page'] + 1)
+                                st.rerun()
+                        with c_rand:
+                            if st.button("🎲 Ngẫu nhiên", use_container_width=True):
+                                import random
+                                load_library_browse(selected_cat, seed=random.choice([x for x in range(LIBRARY_RANDOM_SEEDS) if x != browse['seed']]))
+                                st.rerun()
 
                 else:
                     # Giao diện tìm kiếm bằng từ khóa (Giữ nguyên như cũ)
@@ -1868,7 +3884,10 @@ else:
                 if st.session_state.get('has_searched'):
                     results = st.session_state.get('search_results', [])
                     if results:
-                        preview_options = [f"[{item['source_sheet']}] {item['content'][:60]}..." for item in results]
+                        # Kiểm tra trước link audio của cả danh sách ở nền -> chọn bài nào cũng có sẵn kết quả
+                        get_link_health().check_many([item.get('audio') for item in results], wait=False)
+                        # Có trích đoạn chứa từ khóa (kết quả tìm kiếm) thì hiện trích đoạn, không thì 60 ký tự đầu
+                        preview_options = [f"[{item['source_sheet']}] {item.get('snippet') or item['content'][:60] + '...'}" for item in results]
                         selected_idx = st.selectbox("Chọn kịch bản phù hợp:", range(len(results)), 
                                                     format_func=lambda x: preview_options[x], key="sb_search_select")
                         
@@ -2117,6 +4136,9 @@ else:
                         st.session_state['temp_upload_file'] = uploaded_file
                         st.session_state['temp_upload_name'] = uploaded_file.name
                         st.success(f"✅ Đã nhận file: {uploaded_file.name} ({uploaded_file.size / (1024*1024):.2f} MB)")
+                        # Tải lên ngay ở luồng nền, không đợi tới lúc bấm gửi
+                        start_audio_preupload(uploaded_file, uploaded_file.name)
+                        show_audio_preupload_status(uploaded_file)
 
                 # CASE 3: THU ÂM TRỰC TIẾP (GIAO DIỆN MÁY NHẮC CHỮ - ĐÃ SỬA KHOẢNG CÁCH)
                 elif voice_method == "🎙️ Thu âm trực tiếp": 
@@ -2203,6 +4225,8 @@ else:
                                             else:
                                                 st.session_state['temp_record_file'] = raw_bytes
                                             st.session_state['temp_record_name'] = f"record_{datetime.now().strftime('%H%M%S')}.wav"
+                                            # Tải lên ngay ở luồng nền, không đợi tới lúc bấm gửi
+                                            start_audio_preupload(st.session_state.get('temp_record_file'), st.session_state['temp_record_name'])
                                             
                                             # Ngủ nhẹ 1 giây để đảm bảo session kịp cập nhật trước khi reload trang
                                             time.sleep(1) 
@@ -2211,6 +4235,7 @@ else:
                                 # Giao diện sau khi thu xong
                                 st.success("✅ Đã thu xong! Hãy nghe lại bên dưới:")
                                 st.audio(st.session_state['temp_record_file'], format="audio/wav")
+                                show_audio_preupload_status(st.session_state['temp_record_file'])
                                 
                                 col_act1, col_act2 = st.columns(2)
                                 with col_act1:
@@ -2327,7 +4352,8 @@ else:
                         with c_loc2:
                             speed_input = st.slider("Tốc độ đọc", 0.5, 2.0, 0.8, 0.1)
 
-                        estimated_time_seconds = len(current_script_local) / 15
+                        # [ETA] Ước lượng theo tốc độ thực tế của giọng đã chọn (thay cho 15 ký tự/giây cố định)
+                        estimated_time_seconds = estimate_tts_seconds(current_script_local, selected_voice_name)
                         tts_long_action = "nghe_thu" 
                         choice = None # <--- [MỚI] Khởi tạo biến choice rỗng để tránh lỗi
                         
@@ -2377,6 +4403,10 @@ else:
                                 auto_topic_name = st.selectbox("Chọn chủ đề mong muốn:", TOPIC_LIST, key="sb_auto_topic")
                             st.markdown("---")
 
+                        # Hiện lỗi do fragment theo dõi tiến độ để lại (trước khi nó tải lại trang)
+                        if st.session_state.get('tts_error_message'):
+                            st.error(st.session_state.pop('tts_error_message'))
+
                         # Khôi phục trạng thái chờ nếu lỡ F5
                         if 'pending_tts_id' not in st.session_state:
                             recovered_id = get_pending_local_ai_request(user['email'], current_script_local)
@@ -2388,40 +4418,16 @@ else:
                             req_id = st.session_state['pending_tts_id']
                             
                             st.info("⏳ AI đang tạo giọng nói... Bạn có thể đợi hoặc đi làm việc khác rồi quay lại xem video ở nút Danh sách video.")
-                            
-                            status_box = st.empty()
-                            is_done = False
-                            for i in range(40):
-                                status_box.caption(f"🔄 Đang kiểm tra tiến độ lần {i+1}/40... Tự động hiện kết quả khi xong.")
-                                quick_check = supabase.table('tts_requests').select("status, audio_link, output_path, voice_id").eq('id', req_id).execute()
-                                
-                                if quick_check.data:
-                                    current_status = quick_check.data[0]['status']
-                                    if current_status == 'done':
-                                        real_audio_link = quick_check.data[0]['audio_link']
-                                        st.session_state['local_ai_audio_link'] = real_audio_link
-                                        st.session_state['local_ai_info'] = f"Voice: {quick_check.data[0]['voice_id']}"
-                                        del st.session_state['pending_tts_id']
-                                        
-                                        # (Đã chuyển logic tạo video sang Backend xử lý ngầm)
-                                            
-                                        is_done = True
-                                        break
-                                    elif current_status == 'error':
-                                        st.error("❌ Quá trình tạo giọng bị lỗi từ máy chủ. Vui lòng thử lại.")
-                                        del st.session_state['pending_tts_id']
-                                        # Dọn dẹp bộ nhớ tự động nếu có lỗi
-                                        if 'auto_create_video_settings' in st.session_state:
-                                            del st.session_state['auto_create_video_settings']
-                                            del st.session_state['auto_create_video_script']
-                                        is_done = True
-                                        break
-                                time.sleep(3) 
-                                
-                            if is_done:
-                                st.rerun() # Tải lại trang, lúc này nó sẽ nhảy sang Nhánh 1
+
+                            # [TỐI ƯU] Không còn time.sleep trong luồng chính, fragment tự hỏi tiến độ theo lịch thưa dần
+                            tts_poll = st.session_state.get('tts_poll')
+                            if tts_poll and tts_poll.get('req_id') == req_id and tts_poll.get('gave_up'):
+                                st.warning("⏳ Máy chủ AI hiện đang xử lý nhiều đơn. File vẫn đang được tạo ngầm, bạn có thể F5 tải lại trang sau nhé!")
+                                if st.button("🔄 Kiểm tra lại", key="btn_tts_poll_retry"):
+                                    start_tts_poll(req_id)
+                                    st.rerun()
                             else:
-                                status_box.warning("⏳ Máy chủ AI hiện đang xử lý nhiều đơn. File vẫn đang được tạo ngầm, bạn có thể F5 tải lại trang sau nhé!")
+                                tts_progress_poller(req_id)
 
                         # CHƯA GỬI -> HIỆN NÚT BẤM
                         else:
@@ -2481,21 +4487,37 @@ else:
                                             if video_settings_payload:
                                                 insert_data["video_settings"] = video_settings_payload
 
-                                            res = supabase.table('tts_requests').insert(insert_data).execute()
+                                            # Giữ chỗ hạn mức TRƯỚC khi đẩy lệnh: ký tự TTS (+ 1 lượt video nếu tạo video luôn)
+                                            reserve_videos = 1 if tts_long_action == "tao_video_luon" else 0
+                                            totals = reserve_quota(user['id'], videos=reserve_videos, tts_chars=msg_or_count)
+                                            apply_quota_totals(user, totals)
+                                            if not totals or not totals['ok']:
+                                                if not totals:
+                                                    st.error("⚠️ Không kiểm tra được hạn mức, vui lòng thử lại!")
+                                                elif reserve_videos and totals['quota_used'] + reserve_videos > totals['quota_max']:
+                                                    st.error("⚠️ Bạn đã hết lượt tạo video!")
+                                                else:
+                                                    st.error(check_tts_quota(user, current_script_local)[1])
+                                                st.stop()
+
+                                            # Kịch bản dài chạy ngầm: chia theo câu thành nhiều yêu cầu con để máy TTS đọc song song
+                                            req_id = None
+                                            try:
+                                                if tts_long_action != "tao_video_luon" and estimated_time_seconds > 30:
+                                                    req_id = enqueue_chunked_tts_request(insert_data)
+                                                else:
+                                                    res = supabase.table('tts_requests').insert(insert_data).execute()
+                                                    req_id = res.data[0]['id'] if res.data else None
+                                            finally:
+                                                if not req_id: # Không tạo được yêu cầu -> trả lại phần đã giữ
+                                                    release_quota(user, videos=reserve_videos, tts_chars=msg_or_count)
                                             
-                                            if res.data:
-                                                req_id = res.data[0]['id']
-                                                new_val = update_tts_usage_supabase(user['id'], msg_or_count)
-                                                if new_val: user['tts_usage'] = new_val
-
-                                                estimated_time_seconds = len(current_script_local) / 15
+                                            if req_id:
+                                                estimated_time_seconds = estimate_tts_seconds(current_script_local, selected_voice_name)
                                                 temp_audio_link = f"pending_tts_{req_id}" 
                                                 
                                                 if tts_long_action == "tao_video_luon":
-                                                    # Trừ Quota video ngay lập tức vì Backend chắc chắn sẽ chạy
-                                                    update_user_usage_supabase(user['id'], user['quota_used'])
-                                                    st.session_state['user_info']['quota_used'] += 1
-                                                    
+                                                    # Lượt video đã được giữ chỗ ở trên cùng với ký tự TTS
                                                     st.success("🚀 Đã đẩy lệnh xuống Server! Quá trình tạo giọng & video sẽ chạy ngầm hoàn toàn. Vui lòng kiểm tra mục 'Xem danh sách video' sau ít phút.")
                                                     st.session_state['show_history_section'] = True
                                                     
@@ -2663,18 +4685,9 @@ else:
 
     if btn_submit_main:
         
-        # [NEW] Kiểm tra spam (Chống bấm liên tục)
-        # [BẢO MẬT] Kiểm tra Quota thực tế từ DB lần nữa trước khi gọi API tốn tiền
-        # Tránh trường hợp Session lưu user['quota_used'] cũ chưa kịp cập nhật
-        current_db_user = supabase.table('users').select("quota_used, quota_max").eq('id', user['id']).execute()
-        if current_db_user.data:
-            real_used = current_db_user.data[0]['quota_used']
-            real_max = current_db_user.data[0]['quota_max']
-            if real_used >= real_max:
-                st.error("⚠️ Hệ thống phát hiện bạn đã hết Quota. Vui lòng nạp thêm!")
-                st.stop()
-
-        if not check_rate_limit(user['email']):
+        # [NEW] Kiểm tra spam (Chống bấm liên tục) - lớp trình duyệt, lớp DB nằm trong submit_order
+        # [BẢO MẬT] Quota thực tế được kiểm tra + giữ chỗ trên DB ngay khi lưu đơn (submit_order)
+        if not check_rate_limit(user['email'], check_db=False):
             st.error("⚠️ Thao tác quá nhanh! Vui lòng đợi 5 giây giữa mỗi lần gửi.")
             st.stop()
         
@@ -2688,12 +4701,14 @@ else:
             ready_to_send = True
         elif voice_method == "📤 Tải file lên" and 'temp_upload_file' in st.session_state:
             with st.spinner("Đang tải file lên server..."):
-                link = upload_to_catbox(st.session_state['temp_upload_file'], st.session_state['temp_upload_name'])
-                if link: final_audio_link_to_send = link; ready_to_send = True
+                link, audio_info, upload_error = finish_audio_upload(st.session_state['temp_upload_file'], st.session_state.get('temp_upload_name'), "Đang tải file lên server...")
+                if link: final_audio_link_to_send = link; ready_to_send = True; settings.update(audio_info)
+                else: st.error(f"Lỗi Cloudinary: {upload_error}")
         elif voice_method == "🎙️ Thu âm trực tiếp" and 'temp_record_file' in st.session_state:
             with st.spinner("Đang xử lý bản thu..."):
-                link = upload_to_catbox(st.session_state['temp_record_file'], st.session_state['temp_record_name'])
-                if link: final_audio_link_to_send = link; ready_to_send = True
+                link, audio_info, upload_error = finish_audio_upload(st.session_state['temp_record_file'], st.session_state.get('temp_record_name'), "Đang tải bản thu lên server...")
+                if link: final_audio_link_to_send = link; ready_to_send = True; settings.update(audio_info)
+                else: st.error(f"Lỗi Cloudinary: {upload_error}")
         # [MỚI] CASE Local AI (SỬA LỖI TÊN GỌI)
         elif voice_method == "🖥️ Giọng AI tiêu chuẩn":
             if st.session_state.get('local_ai_audio_link'):
@@ -2799,37 +4814,27 @@ else:
                     "settings": settings 
                 }
                 
-                # Insert vào bảng orders (Có bắt lỗi 500)
-                try:
-                    supabase.table('orders').insert(order_data).execute()
-                    
-                    # --- [MỚI] TÍNH TOÁN HÀNG CHỜ THÔNG MINH ---
-                    # Lấy email của tất cả đơn đang chờ để phân loại (Của mình vs Người khác)
-                    queue_res = supabase.table('orders').select('email').in_('status', ['Pending', 'Processing']).execute()
-                    
-                    my_q = 0
-                    others_q = 0
-                    if queue_res.data:
-                        for item in queue_res.data:
-                            if item['email'] == user['email']:
-                                my_q += 1
-                            else:
-                                others_q += 1
-                                
+                # Gửi đơn trong 1 lần gọi: chống spam + trừ 1 lượt video + insert + vị trí hàng chờ (Có thử lại khi lỗi 500)
+                result = submit_order(user, order_data)
+                if result['status'] == "rate_limited":
+                    st.error("⚠️ Thao tác quá nhanh! Vui lòng đợi 5 giây giữa mỗi lần gửi.")
+                    st.stop()
+                if result['status'] == "no_quota":
+                    st.error("⚠️ Hệ thống phát hiện bạn đã hết Quota. Vui lòng nạp thêm!")
+                    st.stop()
+
+                # --- [MỚI] TÍNH TOÁN HÀNG CHỜ THÔNG MINH ---
+                # Thống kê hàng chờ trả về cùng lúc với đơn vừa tạo (không phải đọc lại hàng chờ)
+                q_stats = result['queue']
+                if q_stats:
                     st.session_state['queue_info'] = {
-                        "my_orders": my_q if my_q > 0 else 1, # Đảm bảo ít nhất là 1 vì vừa tạo
-                        "other_orders": others_q,
-                        "wait_time": (my_q + others_q) * 5
+                        "my_orders": max(q_stats['mine'], 1), # Đảm bảo ít nhất là 1 vì vừa tạo
+                        "other_orders": q_stats['ahead'],
+                        "wait_time": estimate_queue_wait_minutes(q_stats['ahead'], max(q_stats['mine'], 1), settings.get('video_mode'), len(safe_noidung))
                     }
-                    # --------------------------------
-                    
-                except Exception as e:
-                    # Nếu lỗi 500, chờ 1 giây rồi thử lại 1 lần nữa (Cơ chế Retry)
-                    if "500" in str(e):
-                        time.sleep(1)
-                        supabase.table('orders').insert(order_data).execute()
-                    else:
-                        raise e # Nếu lỗi khác thì báo ra ngoài
+                # --------------------------------
+
+                remember_new_order(user['email'], order_data) # Cập nhật cache lịch sử, không cần tải lại
 
                 # --- GIẢI PHÓNG RAM NGAY LẬP TỨC ---
                 # Xóa dữ liệu file nặng sau khi đã gửi lên Cloudinary và lưu DB thành công
@@ -2837,14 +4842,10 @@ else:
                     st.session_state['temp_record_file'] = None
                 if 'temp_upload_file' in st.session_state:
                     st.session_state['temp_upload_file'] = None
+                st.session_state.pop('audio_preupload', None)
                 # ----------------------------------
                 
-                # [NEW] Trừ Quota (Đã chuyển sang Supabase)
-                # update_user_usage_supabase đã được định nghĩa ở đầu file
-                update_user_usage_supabase(user['id'], user['quota_used'])
-                
-                # Cập nhật session ngay lập tức
-                st.session_state['user_info']['quota_used'] += 1
+                # Quota đã được trừ khi giữ chỗ ở trên (session cũng đã nhận số liệu mới từ DB)
                 st.session_state['submitted_order_id'] = order_id 
                 
                 # GIẢI PHÁP: Tự động bật hiển thị lịch sử video
@@ -2908,10 +4909,8 @@ else:
     # Logic kiểm tra thông minh: Chỉ hiện thông báo nếu CÓ video đang Pending hoặc Processing
     is_processing_real = False
     if not history_df.empty and 'TrangThai' in history_df.columns:
-        # Kiểm tra trong 5 đơn mới nhất xem có đơn nào chưa xong không
-        check_pending = history_df.head(5)[history_df.head(5)['TrangThai'].isin(['Pending', 'Processing'])]
-        if not check_pending.empty:
-            is_processing_real = True
+        # Kiểm tra trên toàn bộ các dòng đã tải (trang đầu chỉ có HISTORY_FIRST_PAGE dòng, không cố định 5)
+        is_processing_real = bool(history_df['TrangThai'].isin(['Pending', 'Processing']).any())
 
     # [FIX] Chỉ hiển thị thông báo khi thực sự có video đang chạy
     if is_processing_real:
@@ -2922,19 +4921,12 @@ else:
         if 7 <= now_check.hour < 23:
             # --- [LOGIC MỚI] TÍNH TOÁN HÀNG CHỜ THÔNG MINH ---
             try:
-                # Lấy danh sách email để phân loại đơn của mình và người khác
-                q_res = supabase.table('orders').select('email').in_('status', ['Pending', 'Processing']).execute()
-                
-                my_q = 0
-                others_q = 0
-                if q_res.data:
-                    for item in q_res.data:
-                        if item['email'] == user['email']:
-                            my_q += 1
-                        else:
-                            others_q += 1
-                
-                q_wait = (my_q + others_q) * 5 # 5 phút/video
+                # Lấy thống kê hàng chờ dùng chung (cache vài giây cho cả server)
+                q_stats = get_queue_stats(user['email'])
+                my_q = q_stats['mine']
+                others_q = q_stats['ahead'] # Số đơn người khác đang xếp TRƯỚC mình
+
+                q_wait = estimate_queue_wait_minutes(others_q, my_q) # Theo thời gian xử lý thực tế gần đây
                 
                 # CÂU VĂN HIỂN THỊ THÔNG MINH
                 if others_q == 0:
@@ -2983,12 +4975,16 @@ else:
             st.subheader("📜 Video của bạn")
         with c_hist2:
             if st.button("🔄 Làm mới", help="Cập nhật danh sách mới nhất"):
-                # get_all_orders_cached.clear() <-- ĐÃ TẮT DÒNG NÀY
+                # Bỏ cache lịch sử của riêng user này để tải trạng thái mới nhất
+                bump_history_version(user['email'])
                 st.rerun()
         
         # 2. Lấy dữ liệu
         history_df = get_user_history(user['email'])
-        
+
+        # [TỐI ƯU] Đối soát 1 lần cho mọi bản lưu giọng đang chờ TTS ngầm, trước khi vẽ từng dòng
+        history_df, pending_tts_states = reconcile_pending_tts_rows(history_df)
+
         # 3. Hiển thị danh sách
         if not history_df.empty:
             status_map = {
@@ -3000,7 +4996,7 @@ else:
                 "": "❓ Không rõ"
             }
             
-            MAX_ITEMS = 3
+            MAX_ITEMS = HISTORY_FIRST_PAGE
             if 'history_expanded' not in st.session_state: st.session_state['history_expanded'] = False
             
             df_display = history_df if st.session_state['history_expanded'] else history_df.head(MAX_ITEMS)
@@ -3012,16 +5008,12 @@ else:
                 raw_status = row.get('TrangThai', 'Pending')
                 order_id = row.get('ID', f'id_{index}')
                 old_audio_link = row.get('LinkGiongNoi', '')
-                old_content_script = row.get('NoiDung', '')
 
                 # [QUAN TRỌNG] Tạo biến vn_status để không bị lỗi
                 vn_status = status_map.get(raw_status, "❓ Chờ xử lý")
 
-                try:
-                    decoded_content = html.unescape(str(old_content_script))
-                    words = decoded_content.split()
-                    script_preview = " ".join(words[:10]) + "..." if len(words) > 10 else decoded_content
-                except: script_preview = "Kịch bản..."
+                # Tóm tắt đã được server tính sẵn (không cần unescape + tách từ mỗi lần vẽ lại)
+                script_preview = row.get('TomTat') or "Kịch bản..."
 
                 try:
                     dt_obj = pd.to_datetime(date_str)
@@ -3034,41 +5026,40 @@ else:
                     display_date = str(date_str)
 
                 # --- HIỂN THỊ CHI TIẾT VIDEO ---
-                with st.expander(f"{display_date} | {vn_status} | 📝 {script_preview}"):
+                # [TẢI LƯỜI] Mỗi dòng chỉ là 1 nút tiêu đề: bấm 1 lần là mở (và đóng dòng đang mở khác) + tải chi tiết ngay,
+                # bấm lại thì đóng. Dòng chưa mở không tải kịch bản / audio / nút tạo lại
+                is_open_row = st.session_state.get('history_open_id') == order_id
+                st.button(f"{'🔽' if is_open_row else '▶️'} {display_date} | {vn_status} | 📝 {script_preview}",
+                          key=f"open_detail_{order_id}_{index}", use_container_width=True,
+                          on_click=toggle_history_row, args=(order_id,))
+                if not is_open_row:
+                    continue
+
+                with st.container(border=True):
+                    old_content_script = get_order_detail(order_id, user['email']).get('content', '')
                     
                     # CASE A: NẾU LÀ "CHỈ LƯU GIỌNG" (VoiceOnly)
                     if raw_status == "VoiceOnly":
                         st.info("💾 Đây là bản lưu giọng nói (Chưa tạo video).")
                         
                         # --- [MỚI] KIỂM TRA TRẠNG THÁI TTS CHẠY NGẦM ---
-                        if old_audio_link and str(old_audio_link).startswith("pending_tts_"):
-                            # Trích xuất ID yêu cầu chạy ngầm
-                            req_id = str(old_audio_link).replace("pending_tts_", "")
-                            
-                            try:
-                                # Hỏi Supabase xem file đã tạo xong chưa
-                                check_tts = supabase.table('tts_requests').select('status, audio_link').eq('id', req_id).execute()
-                                if check_tts.data:
-                                    tts_status = check_tts.data[0]['status']
-                                    if tts_status == 'done':
-                                        real_link = str(check_tts.data[0]['audio_link'])
-                                        # Đã xong -> Cập nhật link thật vào bảng orders
-                                        supabase.table('orders').update({"audio_link": real_link}).eq('id', order_id).execute()
-                                        st.success("✅ Hệ thống đã tạo xong giọng AI ngầm!")
-                                        
-                                        # [BẢO MẬT] Kiểm tra link trước khi phát
-                                        if real_link.startswith("http"):
-                                            st.audio(real_link, format="audio/wav")
-                                        else:
-                                            st.error("⚠️ File âm thanh bị lỗi hoặc chứa đường dẫn không hợp lệ.")
-                                            
-                                        old_audio_link = real_link # Cập nhật biến để hiển thị nút bên dưới
-                                    elif tts_status == 'error':
-                                        st.error("❌ Quá trình tạo giọng AI bị lỗi.")
-                                    else:
-                                        st.warning("⏳ Trí tuệ nhân tạo vẫn đang tạo giọng ngầm. Bạn hãy nhấn 'Làm mới' sau ít phút nhé...")
-                            except Exception as e:
+                        # (Trạng thái đã được đối soát hàng loạt ở reconcile_pending_tts_rows phía trên)
+                        if order_id in pending_tts_states:
+                            tts_status = pending_tts_states[order_id]
+                            if tts_status == 'done':
+                                st.success("✅ Hệ thống đã tạo xong giọng AI ngầm!")
+
+                                # [BẢO MẬT] Kiểm tra link trước khi phát
+                                if str(old_audio_link).startswith("http"):
+                                    st.audio(old_audio_link, format="audio/wav")
+                                else:
+                                    st.error("⚠️ File âm thanh bị lỗi hoặc chứa đường dẫn không hợp lệ.")
+                            elif tts_status == 'error':
+                                st.error("❌ Quá trình tạo giọng AI bị lỗi.")
+                            elif tts_status == 'unknown':
                                 st.error("Lỗi kiểm tra dữ liệu ngầm.")
+                            else:
+                                st.warning("⏳ Trí tuệ nhân tạo vẫn đang tạo giọng ngầm. Bạn hãy nhấn 'Làm mới' sau ít phút nhé...")
                         else:
                             # 1. Hiện Audio Player để nghe lại bình thường (nếu đã có link thật)
                             if old_audio_link and str(old_audio_link).startswith("http"):
@@ -3098,6 +5089,11 @@ else:
                                 queue_msg = "🚀 **Hệ thống đang trực tiếp tạo video của bạn...**"
                             else:
                                 queue_msg = f"🔢 Bạn đang đứng thứ **{pos_in_queue}/{total_pending}** trong hàng chờ xử lý."
+                                # [ETA] Cộng thêm số đơn người khác đang xếp trước để ước lượng giờ xong
+                                hist_q_stats = get_queue_stats(user['email'])
+                                if hist_q_stats:
+                                    eta_min = estimate_queue_wait_minutes(hist_q_stats['ahead'], pos_in_queue)
+                                    queue_msg += f" Dự kiến xong sau khoảng **{eta_min} phút**."
                         except:
                             queue_msg = "⏳ Hệ thống đang xếp hàng xử lý video này..."
 
@@ -3153,7 +5149,7 @@ else:
 
                     # B. Nút Tạo lại (Re-create) - [ĐÃ CẬP NHẬT: THÊM XÁC NHẬN BƯỚC 3]
                     st.markdown('<div style="margin-top: 5px;"></div>', unsafe_allow_html=True) 
-                    if old_audio_link and str(old_audio_link).startswith("http"):
+                    if old_audio_link and str(old_audio_link).startswith("http") and old_content_script:
                         
                         # [LOGIC MỚI] 1. Kiểm tra: Nếu CHƯA bấm nút (hoặc đang bấm nút khác) -> Thì mới hiện nút "Tạo lại"
                         if st.session_state.get('confirm_recreate_id') != order_id:
@@ -3199,16 +5195,19 @@ else:
                                                     "settings": settings # <--- QUAN TRỌNG: Dùng settings hiện tại của UI
                                                 }
                                                 
-                                                # 3. Gửi vào Supabase
-                                                supabase.table('orders').insert(order_data).execute()
-                                                
-                                                # 4. Cập nhật Quota (Trừ lượt dùng)
-                                                update_user_usage_supabase(user['id'], user['quota_used'])
+                                                # 3. Gửi vào Supabase + trừ lượt dùng trong 1 lần gọi
+                                                result = submit_order(user, order_data)
+                                                if result['status'] == "rate_limited":
+                                                    st.error("⚠️ Thao tác quá nhanh! Vui lòng đợi 5 giây giữa mỗi lần gửi.")
+                                                    st.stop()
+                                                if result['status'] == "no_quota":
+                                                    st.error("⚠️ Bạn đã hết lượt tạo video!")
+                                                    st.stop()
+                                                remember_new_order(user['email'], order_data)
                                                 
-                                                # 5. Log & Dọn dẹp
+                                                # 4. Log & Dọn dẹp
                                                 log_history(new_id, user['email'], "", now_vn.strftime("%Y-%m-%d %H:%M:%S"))
                                                 
-                                                st.session_state['user_info']['quota_used'] += 1
                                                 st.session_state['show_wait_message'] = True
                                                 
                                                 # Xóa trạng thái xác nhận để đóng form
@@ -3225,15 +5224,23 @@ else:
                                     st.rerun()
 
             # 4. Nút Xem thêm / Thu gọn
-            if total_items > MAX_ITEMS:
+            can_load_more = history_has_more(user['email'])
+            if total_items > MAX_ITEMS or can_load_more:
                 st.markdown("---")
                 col_c = st.columns([1, 2, 1])[1]
                 with col_c:
-                    if not st.session_state['history_expanded']:
+                    if not st.session_state['history_expanded'] and total_items > MAX_ITEMS:
                         if st.button(f"🔽 Xem thêm ({total_items - MAX_ITEMS} video cũ)", use_container_width=True):
                             st.session_state['history_expanded'] = True
                             st.rerun()
-                    else:
+                    elif can_load_more:
+                        # Chỉ tải trang kế tiếp, các trang đã xem vẫn nằm trong cache
+                        if st.button(f"🔽 Tải thêm {HISTORY_PAGE_SIZE} video cũ hơn", use_container_width=True, key="btn_history_next_page"):
+                            with st.spinner("Đang tải thêm video..."):
+                                load_more_history(user['email'])
+                            st.session_state['history_expanded'] = True
+                            st.rerun()
+                    if st.session_state['history_expanded']:
                         if st.button("🔼 Thu gọn danh sách", use_container_width=True):
                             st.session_state['history_expanded'] = False
                             st.rerun()